@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process FOVs while they are being acquired.
+
+The pipeline needs the whole cell stack before it can start, because the
+phase contrast normalization divides by the mean over every FOV. Here a
+folder is polled for new phase contrast and TIRF images instead, and each FOV
+is segmented, warped onto its TIRF image and measured as soon as both of its
+files are written, using estimates that are updated one image at a time:
+
+- runningMean: the mean_illumination of normAndDenoisePc over the FOVs so
+  far, or ringMedian, the median of the last few, as the background the
+  phase contrast images are divided by
+- streamingHistogram: the histogram of the denoised phase contrast images so
+  far, for a threshold shared by every FOV instead of one per FOV
+
+The camera transform and the TIRF illumination come from the beads, which are
+imaged before the cells, through the pipeline's own (cached) stages. The rows
+of each FOV are appended to a csv file, or a resultstore.resultStore folder,
+as it is done.
+
+    watcher = acquisitionWatcher('/path/to/experiment', 'cells_live.csv')
+    watcher.run(idle_timeout=600)
+
+or from the command line:
+
+    python acquisitionwatch.py /path/to/experiment --out cells_live.csv
+
+A phase contrast image divided by a background made from it alone is flat,
+so the first FOVs are held back until the background has min_background
+images in it and then processed in order. Early FOVs are still normalized
+with estimates from fewer images than the pipeline uses, so rerun the
+pipeline on the finished experiment for the final table.
+Files are paired by their sorted order, as the pipeline pairs them, so the
+names have to sort in acquisition order.
+
+@author: kuhlmanlab
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+import pipeline as mpipe
+
+
+def _imread(path):
+    import skimage.io as skio
+    return skio.imread(path)
+
+
+class runningMean(object):
+    '''
+    Mean of the images added so far, from a running sum. The sum is kept in
+    float64 (or dtype, if that is wider) whatever dtype is, because a float32
+    sum of hundreds of 16 bit images loses the low bits of each new one; only
+    value() is cast to dtype.
+    '''
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.total = None
+        self.count = 0
+
+    def add(self, image):
+        if self.total is None:
+            self.total = np.zeros(np.shape(image),
+                                  dtype=np.result_type(self.dtype, np.float64))
+        self.total += image
+        self.count = self.count + 1
+
+    def value(self):
+        return (self.total / self.count).astype(self.dtype, copy=False)
+
+
+class ringMedian(object):
+    '''
+    Pixelwise median of the last window images added, kept in a ring buffer.
+    '''
+
+    def __init__(self, window=20, dtype=np.float64):
+        self.window = window
+        self.dtype = np.dtype(dtype)
+        self.buffer = None
+        self.count = 0
+
+    def add(self, image):
+        image = np.asarray(image)
+        if self.buffer is None:
+            self.buffer = np.empty((self.window,) + image.shape, image.dtype)
+        self.buffer[self.count % self.window] = image
+        self.count = self.count + 1
+
+    def value(self):
+        filled = min(self.count, self.window)
+        return np.median(self.buffer[:filled], 0).astype(self.dtype,
+                                                         copy=False)
+
+
+class streamingHistogram(object):
+    '''
+    Histogram over fixed bin edges of all the images added so far.
+    '''
+
+    def __init__(self, bins=np.arange(256)):
+        self.edges = np.asarray(bins)
+        self.counts = np.zeros(self.edges.size - 1, dtype=np.int64)
+
+    def add(self, image):
+        self.counts += np.histogram(image, self.edges)[0]
+
+    def threshold(self, comparison_width=5):
+        '''
+        The segmentation.localMinLeftOfGlobalMax cutoff of the accumulated
+        histogram.
+        '''
+        import segmentation as mseg
+        return mseg.thresholdFromHistogram(self.counts, self.edges,
+                                           comparison_width)
+
+
+class acquisitionWatcher(object):
+    '''
+    Polls an experiment folder for new cell FOVs and appends their per-cell
+    rows to out.
+
+    config, cache_dir are as for pipeline.pipeline, which supplies the file
+    patterns, the cell_masks parameters and the bead calibration. background
+    is 'mean' (the running mean of all the phase contrast images, as
+    normAndDenoisePc uses) or 'median' (the median of the last window).
+    threshold is 'fov' to threshold each FOV on its own histogram, as the
+    pipeline does, or 'running' to use the histogram of all the FOVs so far.
+    A file counts as written once it is unchanged between two polls and
+    hasn't been modified for settle_time seconds. FOVs wait until
+    min_background phase contrast images (at least 2) are in the background
+    estimate. out is a csv file, started afresh with the first FOV, or
+    otherwise the folder of a new (or empty) resultStore.
+    '''
+
+    def __init__(self, experiment_dir, out='cells_live.csv', config=None,
+                 cache_dir=None, background='mean', window=20,
+                 threshold='fov', settle_time=1., min_background=3,
+                 verbose=False):
+        if background not in ('mean', 'median'):
+            raise ValueError("background must be 'mean' or 'median'")
+        if threshold not in ('fov', 'running'):
+            raise ValueError("threshold must be 'fov' or 'running'")
+        if min_background < 2:
+            raise ValueError('min_background must be at least 2')
+        self.runner = mpipe.pipeline(experiment_dir, config, cache_dir,
+                                     verbose)
+        self.out = out
+        self.store = None
+        if not out.endswith('.csv'):
+            import resultstore
+            self.store = resultstore.resultStore(out)
+            if len(self.store) > 0:
+                raise ValueError('{} already holds results'.format(out))
+        self.settle_time = settle_time
+        self.min_background = min_background
+        self.verbose = verbose
+        self.dtype = np.dtype(self.runner.config['dtype'])
+        self.params = self.runner.params('cell_masks')
+        if background == 'mean':
+            self.background = runningMean(self.dtype)
+        else:
+            self.background = ringMedian(window, self.dtype)
+        self.histogram = streamingHistogram() if threshold == 'running' \
+            else None
+        self.transform = None
+        self.correction = None
+        self.processed = 0
+        # FOVs in the background estimate but not yet segmented
+        self.queued = []
+        self.latencies = []
+        self.seen = {}
+
+    def calibrate(self):
+        '''
+        Load (or compute) the camera transform and the illumination
+        correction from the beads.
+        '''
+        if self.transform is None:
+            self.transform = \
+                self.runner.result('camera_transform')['transform']
+            self.correction = self.runner.result('illumination')
+
+    def _patterns(self):
+        cells = self.runner.config['cells']
+        return [os.path.join(self.runner.experiment_dir, cells[channel])
+                for channel in ('phase', 'tirf')]
+
+    def poll(self):
+        '''
+        Process every FOV whose files have both appeared and stopped changing,
+        in order, and return the indices of the FOVs processed. A file still
+        being written is picked up on a later poll, and FOVs are queued until
+        the background has min_background images.
+        '''
+        now = time.time()
+        phase, tirf = [sorted(glob.glob(pattern)) for pattern in
+                       self._patterns()]
+        stats = {}
+        for path in phase + tirf:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime)
+        stable = {path for path, stat in stats.items() if
+                  self.seen.get(path) == stat and
+                  now - stat[1] >= self.settle_time}
+        self.seen = stats
+        while True:
+            index = self.processed + len(self.queued)
+            if not (index < min(len(phase), len(tirf)) and
+                    phase[index] in stable and tirf[index] in stable):
+                break
+            self.background.add(_imread(phase[index]))
+            self.queued.append((index, phase[index], tirf[index]))
+        if self.background.count < self.min_background:
+            return []
+        return self.flush()
+
+    def flush(self):
+        '''
+        Process the queued FOVs with the background so far, and return their
+        indices. Used by run at the end for an experiment with fewer than
+        min_background FOVs; with a single image the background would be
+        the image itself, so the FOV is left queued with a warning.
+        '''
+        if self.queued and self.background.count < 2:
+            warnings.warn('FOV {} not processed, there is no other phase '
+                          'contrast image to estimate its background '
+                          'from'.format(self.queued[0][0]))
+            return []
+        done = []
+        while self.queued:
+            index, phase_file, tirf_file = self.queued.pop(0)
+            self.process_fov(index, phase_file, tirf_file)
+            done.append(index)
+        return done
+
+    def process_fov(self, index, phase_file, tirf_file):
+        '''
+        Segment and measure one FOV, whose phase contrast image is already in
+        the background estimate, and append its rows to out.
+        '''
+        import skimage.measure as skme
+        import segmentation as mseg
+        self.calibrate()
+        phase = _imread(phase_file)
+        tirf = _imread(tirf_file)
+        denoised = mseg.denoisePc(np.divide(phase, self.background.value(),
+                                            dtype=self.dtype))
+        threshold = None
+        if self.histogram is not None:
+            self.histogram.add(denoised)
+            threshold = self.histogram.threshold(
+                self.params['comparison_width'])
+        if index in self.params['blank']:
+            mask = np.zeros(np.shape(denoised), dtype=bool)
+        else:
+            mask = mseg.thresholdMask(
+                denoised, comparison_width=self.params['comparison_width'],
+                min_size=self.params['min_size'], threshold=threshold)
+        labels = mseg.warpIm2Im(skme.label(mask), np.zeros(np.shape(tirf)),
+                                self.transform)
+        table = mpipe.measure_cells([labels], [tirf], self.correction,
+                                    self.dtype)
+        table['FOV'] = np.full(len(table['label']), index, dtype=int)
+        if self.store is not None:
+            self.store.append(table)
+        else:
+            mpipe.write_table(table, self.out, append=self.processed > 0)
+        self.processed = self.processed + 1
+        latency = time.time() - max(os.path.getmtime(phase_file),
+                                    os.path.getmtime(tirf_file))
+        self.latencies.append(latency)
+        if self.verbose:
+            print('FOV {}: {} cells, {:.1f} s after acquisition'.format(
+                index, len(table['label']), latency), file=sys.stderr)
+
+    def run(self, poll_interval=1., idle_timeout=None, max_fovs=None):
+        '''
+        Poll until idle_timeout seconds pass without a new FOV, max_fovs
+        FOVs are done or the user interrupts, flush the FOVs still queued and
+        return the number of FOVs done.
+        '''
+        self.calibrate()
+        last_new = time.time()
+        try:
+            while max_fovs is None or self.processed < max_fovs:
+                waiting = len(self.queued)
+                if self.poll() or len(self.queued) > waiting:
+                    last_new = time.time()
+                elif (idle_timeout is not None and
+                      time.time() - last_new > idle_timeout):
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        self.flush()
+        return self.processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Segment and measure the cell FOVs of an experiment '
+                    'folder as they are acquired.')
+    parser.add_argument('experiment_dir')
+    parser.add_argument('--out', default='cells_live.csv',
+                        help='csv file (or results store folder) the '
+                             'per-cell rows are appended to')
+    parser.add_argument('--config', help='json file overriding the defaults')
+    parser.add_argument('--cache-dir', help='where the pipeline keeps the '
+                                            'bead calibration')
+    parser.add_argument('--background', choices=['mean', 'median'],
+                        default='mean')
+    parser.add_argument('--window', type=int, default=20,
+                        help='FOVs in the running median background')
+    parser.add_argument('--threshold', choices=['fov', 'running'],
+                        default='fov')
+    parser.add_argument('--poll', type=float, default=1.,
+                        help='seconds between looks at the folder')
+    parser.add_argument('--settle', type=float, default=1.,
+                        help='seconds a file must be unmodified before it is '
+                             'read')
+    parser.add_argument('--min-background', type=int, default=3,
+                        help='phase contrast images in the background before '
+                             'the first FOV is segmented')
+    parser.add_argument('--idle-timeout', type=float,
+                        help='stop after this many seconds without a new FOV')
+    parser.add_argument('--max-fovs', type=int)
+    args = parser.parse_args(argv)
+    config = None
+    if args.config is not None:
+        with open(args.config) as file:
+            config = json.load(file)
+    watcher = acquisitionWatcher(args.experiment_dir, args.out, config,
+                                 args.cache_dir, args.background, args.window,
+                                 args.threshold, args.settle,
+                                 args.min_background, verbose=True)
+    watcher.run(args.poll, args.idle_timeout, args.max_fovs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
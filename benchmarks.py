@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot functions of the analysis modules on synthetic data.
+
+Inputs are generated from fixed seeds with fovsimulation (bead fields, rod
+shaped cell masks, phase contrast, brightfield and TIRF like images) and
+simple bleaching curves, so every run of a preset times the same work. Each
+benchmark is timed over a few repeats and run once more under tracemalloc for
+its peak memory. The import time of each analysis module is measured in a
+fresh interpreter too, along with whether importing it loaded OpenCV,
+matplotlib or the notebook widgets. Results are written as JSON and can be
+compared against a saved baseline. With --precision float32 the functions
+that take a working dtype are also checked against their float64 results:
+
+    python benchmarks.py --preset small --out baseline.json
+    ... change things ...
+    python benchmarks.py --preset small --baseline baseline.json
+
+which exits with status 1 if any benchmark got slower (or bigger) than the
+baseline by more than the threshold, or if any benchmark or precision check
+raised.
+
+@author: kuhlmanlab
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+PRESETS = {
+    'small': {'image_size': 512, 'fov_count': 10, 'cell_count': 100,
+              'trace_count': 100, 'frame_count': 20},
+    'medium': {'image_size': 1024, 'fov_count': 50, 'cell_count': 400,
+               'trace_count': 10**4, 'frame_count': 50},
+    'large': {'image_size': 2048, 'fov_count': 200, 'cell_count': 1000,
+              'trace_count': 10**5, 'frame_count': 100},
+}
+
+# fields of view actually rendered for the multi-FOV benchmarks; the list
+# handed to the function cycles through them to reach fov_count
+DISTINCT_FOVS = 5
+
+BENCHMARKS = {}
+
+# side of the box evaluateDistsBox is run on: it calls the distance function
+# once per pixel from python, which takes minutes for a whole large frame
+DISTS_BOX_SIZE = 256
+
+# modules whose import time is benchmarked in a fresh interpreter, and the
+# heavy dependencies none of them should load just by being imported
+IMPORT_MODULES = ['segmentation', 'illuminationinterpolation',
+                  'spotfinding_prototype', 'visualization',
+                  'fluorophorecopynumberinference', 'celltraces',
+                  'microscopyimageprocessing']
+HEAVY_MODULES = ['cv2', 'matplotlib', 'ipywidgets', 'IPython']
+
+
+def benchmark(name, repeats=3):
+    '''
+    Register a benchmark. The decorated function takes the preset parameters
+    and a synthetic data source and returns a function of no arguments that
+    does the work to time.
+    '''
+    def register(setup):
+        BENCHMARKS[name] = (setup, repeats)
+        return setup
+    return register
+
+
+class syntheticData(object):
+    '''
+    Deterministic synthetic inputs for one preset, made on first use and kept
+    for the benchmarks that share them.
+    '''
+
+    def __init__(self, params, seed=0):
+        self.params = params
+        self.seed = seed
+        self.made = {}
+
+    def _rng(self, name, index=0):
+        key = [self.seed, index] + [ord(c) for c in name]
+        return np.random.default_rng(key)
+
+    def fov(self, index=0):
+        '''
+        Cell labels, bead labels and phase, brightfield and TIRF images of
+        one field of view.
+        '''
+        key = ('fov', index)
+        if key not in self.made:
+            import fovsimulation as fs
+            rng = self._rng('fov', index)
+            size = self.params['image_size']
+            shape = (size, size)
+            beads = fs.place_beads(shape, 10*size//512, rng=rng)
+            labels = fs.place_rods(shape, self.params['cell_count'], rng=rng,
+                                   occupied=beads > 0)
+            rows, cols = np.ogrid[0:size, 0:size]
+            illumination = np.exp(-((rows - size/2)**2 + (cols - size/2)**2) /
+                                  (2*(size/2)**2))
+            brightness = 100 + 400*(labels > 0) + 2000*(beads > 0)
+            tirf = rng.poisson(illumination*brightness) + 100
+            self.made[key] = {
+                'labels': labels, 'beads': beads,
+                'phase': fs.phase_contrast_image(labels, beads, rng=rng),
+                'brightfield': fs.brightfield_image(beads, rng=rng),
+                'tirf': tirf.astype(np.uint16)}
+        return self.made[key]
+
+    def fovs(self, field):
+        '''
+        fov_count images of one kind, cycling through DISTINCT_FOVS
+        rendered fields of view.
+        '''
+        distinct = min(DISTINCT_FOVS, self.params['fov_count'])
+        return [self.fov(i % distinct)[field] for i in
+                range(self.params['fov_count'])]
+
+    def traces(self):
+        '''
+        (trace_count x frame_count) photobleaching curves with shot noise.
+        '''
+        if 'traces' not in self.made:
+            rng = self._rng('traces')
+            count = self.params['trace_count']
+            frames = self.params['frame_count']
+            t = np.arange(frames)
+            A = rng.uniform(500, 5000, (count, 1))
+            tau = rng.uniform(frames/10, frames/3, (count, 1))
+            C = rng.uniform(100, 500, (count, 1))
+            clean = A*np.exp(-t/tau) + C
+            self.made['traces'] = (t, clean + rng.normal(0, 1, clean.shape) *
+                                   np.sqrt(clean))
+        return self.made['traces']
+
+    def transform(self):
+        import skimage.transform as sktr
+        return sktr.SimilarityTransform(scale=1.02, rotation=.01,
+                                        translation=(3.5, -2.))
+
+
+@benchmark('segmentation.findMedianBg')
+def _findMedianBg(params, data):
+    import segmentation as mseg
+    images = data.fovs('brightfield')
+    return lambda: mseg.findMedianBg(images)
+
+
+@benchmark('segmentation.normAndDenoisePc', repeats=1)
+def _normAndDenoisePc(params, data):
+    import segmentation as mseg
+    images = data.fovs('phase')
+    return lambda: mseg.normAndDenoisePc(images)
+
+
+@benchmark('segmentation.thresholdMask')
+def _thresholdMask(params, data):
+    import segmentation as mseg
+    phase = data.fov()['phase']
+    image = (255*(phase/phase.max())).astype(np.uint8)
+    return lambda: mseg.thresholdMask(image)
+
+
+@benchmark('segmentation.findBeadsBF')
+def _findBeadsBF(params, data):
+    import segmentation as mseg
+    image = data.fov()['brightfield']
+    return lambda: mseg.findBeadsBF(image, .75*np.median(image))
+
+
+@benchmark('segmentation.removeNonCirles')
+def _removeNonCirles(params, data):
+    import segmentation as mseg
+    masks = [beads > 0 for beads in data.fovs('beads')]
+    return lambda: mseg.removeNonCirles(masks, 10)
+
+
+@benchmark('segmentation.findRegionCenters')
+def _findRegionCenters(params, data):
+    import segmentation as mseg
+    mask = data.fov()['beads'] > 0
+    return lambda: mseg.findRegionCenters(mask)
+
+
+@benchmark('segmentation.warpIm2Im')
+def _warpIm2Im(params, data):
+    import segmentation as mseg
+    labels = data.fov()['labels']
+    transform = data.transform()
+    return lambda: mseg.warpIm2Im(labels, labels, transform)
+
+
+@benchmark('segmentation.surroundings')
+def _surroundings(params, data):
+    import segmentation as mseg
+    labels = data.fov()['labels']
+    return lambda: mseg.surroundings(labels, 5, 15)
+
+
+@benchmark('segmentation.subtract_pad_bg')
+def _subtract_pad_bg(params, data):
+    import segmentation as mseg
+    fov = data.fov()
+    return lambda: mseg.subtract_pad_bg(fov['tirf'], fov['labels'], 5, 15)
+
+
+@benchmark('segmentation.properties2list (with regionprops)')
+def _properties2list(params, data):
+    import skimage.measure as skme
+    import segmentation as mseg
+    labels = data.fovs('labels')
+    images = data.fovs('tirf')
+
+    def run():
+        rprops = [skme.regionprops(label, image) for label, image in
+                  zip(labels, images)]
+        return mseg.properties2list(rprops, ['area', 'mean_intensity',
+                                             'centroid'])
+    return run
+
+
+@benchmark('illuminationinterpolation.evaluateDistsBox', repeats=1)
+def _evaluateDistsBox(params, data):
+    import skimage.measure as skme
+    import illuminationinterpolation as illint
+    fov = data.fov()
+    beads = skme.regionprops(fov['beads'], fov['tirf'])
+    centers = np.array([bead.centroid for bead in beads])
+    values = np.array([bead.mean_intensity for bead in beads])
+    dist_func = illint.createGaussianDistFunc(centers, values, 40)
+    size = min(params['image_size'], DISTS_BOX_SIZE)
+    return lambda: illint.evaluateDistsBox(size, size, dist_func)
+
+
+@benchmark('spotfinding_prototype.halfSampleMode')
+def _halfSampleMode(params, data):
+    import spotfinding_prototype as spf
+    rng = np.random.default_rng(1)
+    values = np.sort(rng.gamma(4, 100, 100*params['trace_count']))
+    return lambda: spf.halfSampleMode(values)
+
+
+@benchmark('spotfinding_prototype.spotfindingLabels')
+def _spotfindingLabels(params, data):
+    import spotfinding_prototype as spf
+    masks = [labels > 0 for labels in data.fovs('labels')]
+    target = data.fov()['tirf']
+    transform = data.transform()
+    return lambda: spf.spotfindingLabels(masks, target, transform)
+
+
+@benchmark('fluorophorecopynumberinference.fit_photobleach_rate', repeats=1)
+def _fit_photobleach_rate(params, data):
+    import fluorophorecopynumberinference as fcni
+    t, traces = data.traces()
+    return lambda: [fcni.fit_photobleach_rate(t, trace) for trace in traces]
+
+
+@benchmark('fluorophorecopynumberinference.fit_photobleach_rates')
+def _fit_photobleach_rates(params, data):
+    import fluorophorecopynumberinference as fcni
+    t, traces = data.traces()
+    return lambda: fcni.fit_photobleach_rates(t, traces)
+
+
+@benchmark('celltraces.extract_traces')
+def _extract_traces(params, data):
+    import celltraces
+    fov = data.fov()
+    frames = [fov['tirf']]*params['frame_count']
+    return lambda: celltraces.extract_traces(frames, fov['labels'])
+
+
+def time_function(function, repeats):
+    seconds = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def peak_memory(function):
+    '''
+    Peak bytes allocated (as seen by tracemalloc) during one call.
+    '''
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+    return peak - start
+
+
+def import_time(module, repeats=3):
+    '''
+    Seconds to import module in a fresh interpreter (best and median of
+    repeats) and which of HEAVY_MODULES that loaded.
+    '''
+    code = ('import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'seconds = time.perf_counter() - start\n'
+            'print(json.dumps([seconds, [name for name in {!r} '
+            'if name in sys.modules]]))').format(module, HEAVY_MODULES)
+    here = os.path.dirname(os.path.abspath(__file__))
+    seconds = []
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], cwd=here,
+                                check=True, capture_output=True, text=True)
+        run_seconds, loaded = json.loads(output.stdout.strip().split('\n')[-1])
+        seconds.append(run_seconds)
+    return {'seconds_min': min(seconds),
+            'seconds_median': float(np.median(seconds)),
+            'repeats': len(seconds), 'loaded': loaded}
+
+
+def run_benchmarks(preset='small', names=None, repeats=None, memory=True,
+                   seed=0, verbose=False, imports=True):
+    '''
+    Run the benchmarks (all of them, or those named) on a preset's synthetic
+    data, and time importing each of IMPORT_MODULES ('import module' in
+    names). A benchmark that raises is recorded with its error instead of
+    stopping the run.
+    '''
+    params = PRESETS[preset]
+    data = syntheticData(params, seed)
+    results = {}
+    for module in IMPORT_MODULES if imports else []:
+        name = 'import ' + module
+        if names is not None and name not in names:
+            continue
+        if verbose:
+            print(name, file=sys.stderr)
+        try:
+            results[name] = import_time(module, repeats or 3)
+        except subprocess.CalledProcessError as error:
+            message = ' '.join(error.stderr.split()[-20:])
+            results[name] = {'error': 'CalledProcessError: ' + message}
+    for name, (setup, default_repeats) in BENCHMARKS.items():
+        if names is not None and name not in names:
+            continue
+        if verbose:
+            print(name, file=sys.stderr)
+        try:
+            function = setup(params, data)
+            seconds = time_function(function, repeats or default_repeats)
+            result = {'seconds_min': min(seconds),
+                      'seconds_median': float(np.median(seconds)),
+                      'repeats': len(seconds)}
+            if memory:
+                result['peak_bytes'] = peak_memory(function)
+        except Exception as error:
+            message = ' '.join(str(error).split())
+            result = {'error': '{}: {}'.format(type(error).__name__, message)}
+        results[name] = result
+    return {'meta': {'preset': preset, 'params': params, 'seed': seed,
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'machine': platform.machine(),
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+# how far the reduced precision results may be from the float64 ones
+PRECISION_TOLERANCES = {
+    'findMedianBg max relative error': 1e-5,
+    'normAndDenoisePc fraction of pixels changed': 1e-3,
+    'thresholdMask threshold difference': 1,
+    'thresholdMask fraction of pixels changed': 1e-3,
+    'evaluateDistsBox max relative error': 1e-5,
+    'subtract_pad_bg max difference': 1,
+    'cell mean intensity max relative error': 1e-5,
+}
+
+
+def precision_checks(preset='small', dtype=np.float32, seed=0):
+    '''
+    Run the functions with a working dtype both in float64 and in dtype on a
+    preset's synthetic data and compare the outputs against
+    PRECISION_TOLERANCES. Returns {check: {'value', 'tolerance', 'passed'}},
+    checks whose functions raise get an 'error' instead.
+    '''
+    import illuminationinterpolation as illint
+    import segmentation as mseg
+    params = PRESETS[preset]
+    data = syntheticData(params, seed)
+    fov = data.fov()
+    values = {}
+
+    def check(name, measure):
+        try:
+            values[name] = float(measure())
+        except Exception as error:
+            values[name] = ' '.join(str(error).split())
+
+    def median_bg():
+        images = data.fovs('brightfield')
+        full = mseg.findMedianBg(images)
+        return np.max(np.abs(mseg.findMedianBg(images, dtype=dtype)/full - 1))
+    check('findMedianBg max relative error', median_bg)
+
+    denoised = {}
+
+    def norm_and_denoise():
+        images = data.fovs('phase')
+        denoised['full'] = mseg.normAndDenoisePc(images)
+        denoised['reduced'] = mseg.normAndDenoisePc(images, dtype)
+        return np.mean(denoised['full'][0] != denoised['reduced'][0])
+    check('normAndDenoisePc fraction of pixels changed', norm_and_denoise)
+
+    def threshold_difference():
+        full, reduced = denoised['full'][0], denoised['reduced'][0]
+        return abs(mseg.localMinLeftOfGlobalMax(full, np.arange(256), 5) -
+                   mseg.localMinLeftOfGlobalMax(reduced, np.arange(256), 5))
+    check('thresholdMask threshold difference', threshold_difference)
+
+    def mask_difference():
+        return np.mean(mseg.thresholdMask(denoised['full'][0]) !=
+                       mseg.thresholdMask(denoised['reduced'][0]))
+    check('thresholdMask fraction of pixels changed', mask_difference)
+
+    def dists_box():
+        import skimage.measure as skme
+        beads = skme.regionprops(fov['beads'], fov['tirf'])
+        dist_func = illint.createGaussianDistFunc(
+            np.array([bead.centroid for bead in beads]),
+            np.array([bead.mean_intensity for bead in beads]), 40)
+        # a corner of the frame, the full map is slow to evaluate twice
+        size = min(params['image_size']//4, DISTS_BOX_SIZE)
+        full = illint.evaluateDistsBox(size, size, dist_func)
+        reduced = illint.evaluateDistsBox(size, size, dist_func, dtype)
+        return np.max(np.abs(reduced/full - 1))
+    check('evaluateDistsBox max relative error', dists_box)
+
+    def pad_bg():
+        full = mseg.subtract_pad_bg(fov['tirf'], fov['labels'], 5, 15)
+        reduced = mseg.subtract_pad_bg(fov['tirf'], fov['labels'], 5, 15,
+                                       dtype)
+        return np.max(np.abs(full - reduced))
+    check('subtract_pad_bg max difference', pad_bg)
+
+    def cell_intensities():
+        background = mseg.findMedianBg(data.fovs('tirf'))
+        labels = np.ravel(fov['labels'])
+        area = np.bincount(labels)
+        means = []
+        for working in [np.float64, dtype]:
+            corrected = mseg.correctIllumination(fov['tirf'],
+                                                 background.astype(working),
+                                                 working)
+            sums = np.bincount(labels, weights=np.ravel(corrected))
+            means.append(sums[1:][area[1:] > 0]/area[1:][area[1:] > 0])
+        return np.max(np.abs(means[1]/means[0] - 1))
+    check('cell mean intensity max relative error', cell_intensities)
+
+    checks = {}
+    for name, value in values.items():
+        tolerance = PRECISION_TOLERANCES[name]
+        if isinstance(value, str):
+            checks[name] = {'error': value, 'tolerance': tolerance}
+        else:
+            checks[name] = {'value': value, 'tolerance': tolerance,
+                            'passed': value <= tolerance}
+    return checks
+
+
+def compare(results, baseline, threshold=.2):
+    '''
+    Benchmarks whose minimum time or peak memory grew by more than threshold
+    (a fraction) over the baseline, or imports that now load heavy modules
+    they didn't, as a list of (name, measure, baseline value, new value).
+    '''
+    regressions = []
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None or 'error' in old or 'error' in result:
+            continue
+        for measure in ['seconds_min', 'peak_bytes']:
+            if measure in old and measure in result and \
+                    result[measure] > (1 + threshold)*old[measure]:
+                regressions.append((name, measure, old[measure],
+                                    result[measure]))
+        if not set(result.get('loaded', [])) <= set(old.get('loaded', [])):
+            regressions.append((name, 'loaded', old.get('loaded', []),
+                                result['loaded']))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = []
+    for name, result in results['results'].items():
+        if 'error' in result:
+            lines.append('{:60s} {}'.format(name, result['error']))
+            continue
+        line = '{:60s} {:10.4f} s'.format(name, result['seconds_min'])
+        if 'peak_bytes' in result:
+            line = line + ' {:10.1f} MB'.format(result['peak_bytes']/2**20)
+        if result.get('loaded'):
+            line = line + ' loads ' + ', '.join(result['loaded'])
+        if baseline is not None:
+            old = baseline['results'].get(name, {})
+            if 'seconds_min' in old:
+                line = line + ' {:+7.1%}'.format(
+                    result['seconds_min']/old['seconds_min'] - 1)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time and memory profile the analysis functions on '
+                    'synthetic data.')
+    parser.add_argument('--preset', choices=list(PRESETS), default='small')
+    parser.add_argument('--only', action='append',
+                        choices=list(BENCHMARKS) +
+                        ['import ' + module for module in IMPORT_MODULES],
+                        help='run only this benchmark, may be repeated')
+    parser.add_argument('--repeats', type=int)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc run')
+    parser.add_argument('--no-imports', action='store_true',
+                        help='skip the import time benchmarks')
+    parser.add_argument('--precision', metavar='DTYPE',
+                        help='also check results computed in this working '
+                             'dtype (e.g. float32) against float64')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='json file to write the results to')
+    parser.add_argument('--baseline', help='json results to compare against')
+    parser.add_argument('--threshold', type=float, default=.2,
+                        help='allowed slowdown as a fraction of the baseline')
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.preset, args.only, args.repeats,
+                             not args.no_memory, args.seed, verbose=True,
+                             imports=not args.no_imports)
+    failed = False
+    for name, result in results['results'].items():
+        if 'error' in result:
+            print('FAILED {}: {}'.format(name, result['error']))
+            failed = True
+    if args.precision is not None:
+        results['precision'] = precision_checks(args.preset,
+                                                np.dtype(args.precision),
+                                                args.seed)
+        for name, check in results['precision'].items():
+            if 'error' in check:
+                print('{:60s} {}'.format(name, check['error']))
+                failed = True
+                continue
+            print('{:60s} {:10.3g} {}'.format(
+                name, check['value'], 'ok' if check['passed'] else 'FAILED'))
+            failed = failed or not check['passed']
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print(format_results(results, baseline))
+    if args.out is not None:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=1)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, measure, old, new in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, measure, old,
+                                                     new))
+        if regressions:
+            return 1
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build per-cell intensity traces from time-lapse TIRF images and label images,
+the input single_cell_inference and fit_photobleach_rates expect.
+
+The movie is read one frame at a time, so it can be an ImageCollection or a
+memory mapped stack far larger than memory. Each frame is reduced with a
+single bincount over the label image instead of regionprops.
+
+@author: kuhlmanlab
+"""
+
+import os
+
+import numpy as np
+
+
+def _is_single_label(labels):
+    return isinstance(labels, np.ndarray) and labels.ndim == 2
+
+
+def trace_label_ids(labels):
+    '''
+    The sorted nonzero labels present in a label image or in any of a
+    sequence of label images.
+    '''
+    if _is_single_label(labels):
+        ids = np.unique(labels)
+    else:
+        ids = np.unique(np.concatenate([np.unique(label) for label in
+                                        labels]))
+    return ids[ids > 0]
+
+
+def _trace_arrays(out, cells, frames, dtype, per_frame_area):
+    '''
+    Allocate the output arrays, in memory or as .npy files in directory out.
+    '''
+    shapes = {'sum': (cells, frames), 'mean': (cells, frames),
+              'area': (cells, frames) if per_frame_area else (cells,)}
+    if out is None:
+        return {name: np.zeros(shape, dtype=dtype) for name, shape in
+                shapes.items()}
+    os.makedirs(out, exist_ok=True)
+    return {name: np.lib.format.open_memmap(os.path.join(out, name + '.npy'),
+                                            mode='w+', dtype=dtype,
+                                            shape=shape)
+            for name, shape in shapes.items()}
+
+
+def extract_traces(frames, labels, label_ids=None, out=None,
+                   dtype=np.float32):
+    '''
+    Sum, mean and area of every labeled cell in every frame of a movie.
+
+    Parameters
+    ----------
+    frames : sequence of ndarray
+        The TIRF movie, anything with len() that yields 2-d frames in order
+        (ImageCollection, list, or (frames x rows x columns) memmap).
+    labels : ndarray or sequence of ndarray
+        Either one label image used for every frame, or one label image per
+        frame with the same label for the same cell throughout.
+    label_ids : array of int, optional
+        The labels to make traces for, in the order of the output rows.
+        Defaults to every nonzero label found.
+    out : str, optional
+        A directory to write label.npy, sum.npy, mean.npy and area.npy into.
+        The returned arrays are then memmaps of those files.
+    dtype : dtype
+        Type of the sum, mean and area arrays.
+
+    Returns
+    -------
+    traces : dict
+        'label' holds the label of each row. 'sum' and 'mean' are
+        (cells x frames) arrays of the summed and mean intensity of each cell
+        in each frame. 'area' is the pixel count of each cell, (cells,) for a
+        single label image or (cells x frames) for per-frame labels. Cells
+        missing from a frame get zero sum and area and NaN mean there.
+    '''
+    single_label = _is_single_label(labels)
+    if label_ids is None:
+        label_ids = trace_label_ids(labels)
+    label_ids = np.asarray(label_ids, dtype=np.intp)
+    frame_count = len(frames)
+    traces = _trace_arrays(out, label_ids.size, frame_count, dtype,
+                           not single_label)
+    if out is None:
+        traces['label'] = label_ids
+    else:
+        np.save(os.path.join(out, 'label.npy'), label_ids)
+        traces['label'] = np.load(os.path.join(out, 'label.npy'),
+                                  mmap_mode='r')
+    if single_label:
+        flat_label = np.ravel(labels)
+        length = max(np.max(flat_label), np.max(label_ids, initial=0)) + 1
+        area = np.bincount(flat_label, minlength=length)[label_ids]
+        traces['area'][:] = area
+    for i in range(frame_count):
+        if not single_label:
+            flat_label = np.ravel(labels[i])
+            length = max(np.max(flat_label), np.max(label_ids, initial=0)) + 1
+            area = np.bincount(flat_label, minlength=length)[label_ids]
+            traces['area'][:, i] = area
+        sums = np.bincount(flat_label, weights=np.ravel(frames[i]),
+                           minlength=length)[label_ids]
+        traces['sum'][:, i] = sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            traces['mean'][:, i] = np.where(area > 0, sums/area, np.nan)
+    if out is not None:
+        for name in ['sum', 'mean', 'area']:
+            traces[name].flush()
+    return traces
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Link the cells of consecutive label images of a time-lapse into tracks.
+
+celltraces.extract_traces and the photobleaching inference need the same
+label for the same cell in every frame, but with stage jitter and
+segmentation noise one label image can't be used for the whole movie, and
+segmenting each frame numbers the cells differently. Here each pair of
+consecutive frames is linked by:
+
+- the drift between them, from phase correlation of the images (or of the
+  masks when there are no images)
+- the pixel overlap of every pair of labels, after undoing the drift, counted
+  with one bincount over the pixels labeled in both frames into a sparse
+  matrix
+- the assignment maximizing the intersection over union, solved separately
+  for each group of labels connected by overlaps, which for well separated
+  cells is almost always a single pair
+
+    tracking = track(labels, phase_images)
+    tracked = trackedLabels(labels, tracking['lookups'])
+    traces = celltraces.extract_traces(tirf_frames, tracked)
+
+Cells that appear, or that don't overlap enough with any cell of the previous
+frame, start new tracks.
+
+@author: kuhlmanlab
+"""
+
+import numpy as np
+import scipy.sparse as spsp
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
+
+import compactmasks
+
+# largest (previous x current labels) table counted with a dense bincount,
+# bigger ones are counted with np.unique
+MAX_DENSE_PAIRS = 2**24
+
+
+def estimate_drift(previous_image, current_image, upsample_factor=1):
+    '''
+    The (row, column) shift that moves current_image onto previous_image, by
+    phase correlation.
+    '''
+    try:
+        from skimage.registration import phase_cross_correlation
+    except ImportError:
+        from skimage.feature import register_translation as \
+            phase_cross_correlation
+    return np.asarray(phase_cross_correlation(
+        np.asarray(previous_image, dtype=float),
+        np.asarray(current_image, dtype=float),
+        upsample_factor=upsample_factor)[0])
+
+
+def _overlap_slices(shape, shift):
+    '''
+    The slices of the previous and the current image that line up when the
+    current one is moved by shift (rounded to whole pixels).
+    '''
+    previous_slices = []
+    current_slices = []
+    for size, offset in zip(shape, np.round(shift).astype(int)):
+        offset = int(np.clip(offset, -size, size))
+        if offset >= 0:
+            previous_slices.append(slice(offset, size))
+            current_slices.append(slice(0, size - offset))
+        else:
+            previous_slices.append(slice(0, size + offset))
+            current_slices.append(slice(-offset, size))
+    return tuple(previous_slices), tuple(current_slices)
+
+
+def overlap_matrix(previous, current, shift=(0, 0)):
+    '''
+    Sparse matrix of the number of pixels label i of previous shares with
+    label j of current, once current is moved by shift, at [i, j]. The
+    background (label 0) row and column are empty.
+    '''
+    previous = np.asarray(compactmasks.dense(previous))
+    current = np.asarray(compactmasks.dense(current))
+    shape = (int(np.max(previous, initial=0)) + 1,
+             int(np.max(current, initial=0)) + 1)
+    previous_slices, current_slices = _overlap_slices(previous.shape, shift)
+    previous_pixels = previous[previous_slices].ravel()
+    current_pixels = current[current_slices].ravel()
+    both = (previous_pixels > 0) & (current_pixels > 0)
+    pairs = previous_pixels[both].astype(np.int64)*shape[1] + \
+        current_pixels[both]
+    if shape[0]*shape[1] <= MAX_DENSE_PAIRS:
+        counts = np.bincount(pairs, minlength=shape[0]*shape[1])
+        pairs = np.flatnonzero(counts)
+        counts = counts[pairs]
+    else:
+        pairs, counts = np.unique(pairs, return_counts=True)
+    return spsp.csr_matrix((counts, (pairs // shape[1], pairs % shape[1])),
+                           shape=shape)
+
+
+def link(previous, current, shift=(0, 0), min_iou=.3):
+    '''
+    (matches x 2) array of the labels of previous and of current that are
+    the same cell: the one to one pairing maximizing the total intersection
+    over union (within the overlapping part of the frames) of overlapping
+    labels, once current is moved by shift, keeping the pairs with an
+    intersection over union of at least min_iou.
+    '''
+    previous = np.asarray(compactmasks.dense(previous))
+    current = np.asarray(compactmasks.dense(current))
+    overlap = overlap_matrix(previous, current, shift).tocoo()
+    if overlap.nnz == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    rows = overlap.row.astype(np.int64)
+    cols = overlap.col.astype(np.int64)
+    # areas inside the part of the frames that line up, so cells partly
+    # drifting out of view aren't penalized
+    previous_slices, current_slices = _overlap_slices(previous.shape, shift)
+    previous_area = np.bincount(previous[previous_slices].ravel(),
+                                minlength=overlap.shape[0])
+    current_area = np.bincount(current[current_slices].ravel(),
+                               minlength=overlap.shape[1])
+    iou = overlap.data / (previous_area[rows] + current_area[cols] -
+                          overlap.data)
+    # labels as the nodes of one graph, previous first, joined by overlaps
+    node_count = overlap.shape[0] + overlap.shape[1]
+    graph = spsp.csr_matrix((np.ones(rows.size), (rows, cols +
+                                                  overlap.shape[0])),
+                            shape=(node_count, node_count))
+    edge_component = connected_components(graph, directed=False)[1][rows]
+    edges_per_component = np.bincount(edge_component)
+    single = edges_per_component[edge_component] == 1
+    matches = [np.column_stack([rows[single], cols[single]])[
+        iou[single] >= min_iou]]
+    multiple = np.flatnonzero(~single)
+    multiple = multiple[np.argsort(edge_component[multiple], kind='stable')]
+    bounds = np.flatnonzero(np.diff(edge_component[multiple])) + 1
+    for edges in np.split(multiple, bounds):
+        if edges.size == 0:
+            continue
+        component_rows, row_index = np.unique(rows[edges],
+                                              return_inverse=True)
+        component_cols, col_index = np.unique(cols[edges],
+                                              return_inverse=True)
+        score = np.zeros((component_rows.size, component_cols.size))
+        score[row_index, col_index] = iou[edges]
+        assigned_rows, assigned_cols = linear_sum_assignment(-score)
+        good = score[assigned_rows, assigned_cols] >= min_iou
+        matches.append(np.column_stack([component_rows[assigned_rows[good]],
+                                        component_cols[assigned_cols[good]]]))
+    matches = np.concatenate(matches)
+    return matches[np.argsort(matches[:, 1], kind='stable')]
+
+
+def track(labels, images=None, drift=True, min_iou=.3, upsample_factor=1):
+    '''
+    Link the cells of a sequence of label images (anything with len() that
+    yields 2-d label images, compact ones included) into tracks.
+
+    images are the images the labels were segmented from (e.g. the phase
+    contrast), used to estimate the drift between frames; without them the
+    masks are used. drift=False assumes no drift.
+
+    Returns a dict with 'lookups', for each frame an array giving the track
+    (numbered from 1, 0 for the background) of each of its labels, 'shifts',
+    the (frames x 2) drift of each frame relative to the one before, and
+    'track_count'.
+    '''
+    lookups = []
+    shifts = np.zeros((len(labels), 2))
+    track_count = 0
+    previous = None
+    previous_image = None
+    for i in range(len(labels)):
+        current = np.asarray(compactmasks.dense(labels[i]))
+        lookup = np.zeros(int(np.max(current, initial=0)) + 1, dtype=np.int64)
+        if drift:
+            current_image = current > 0 if images is None else images[i]
+        if previous is not None:
+            if drift:
+                shifts[i] = estimate_drift(previous_image, current_image,
+                                           upsample_factor)
+            matches = link(previous, current, shifts[i], min_iou)
+            lookup[matches[:, 1]] = lookups[-1][matches[:, 0]]
+        present = np.flatnonzero(np.bincount(current.ravel())[1:]) + 1
+        new = present[lookup[present] == 0]
+        lookup[new] = track_count + 1 + np.arange(new.size)
+        track_count = track_count + new.size
+        lookups.append(lookup)
+        previous = current
+        if drift:
+            previous_image = current_image
+    return {'lookups': lookups, 'shifts': shifts, 'track_count': track_count}
+
+
+class trackedLabels(object):
+    '''
+    The label images of a movie relabeled by track, made one frame at a
+    time when indexed, for celltraces.extract_traces.
+    '''
+
+    def __init__(self, labels, lookups):
+        self.labels = labels
+        self.lookups = lookups
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.lookups[index][np.asarray(compactmasks.dense(
+            self.labels[index]))]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -6,9 +6,32 @@ Created on Fri Jun  1 17:01:32 2018
 @author: kuhlmanlab
 """
 
+from collections import OrderedDict
+
 import numpy as np
 
 
+def random_source(rng=None):
+    '''
+    The random number source simulation objects draw from. Pass a
+    numpy.random.Generator for reproducible simulations; None keeps the old
+    behavior of drawing from the global numpy.random state.
+    '''
+    if rng is None:
+        return np.random
+    return rng
+
+
+def spawn_generators(seed, count):
+    '''
+    Make count independent numpy.random.Generator streams from one seed, one
+    for each worker of a parallel simulation. The same seed and count always
+    give the same streams.
+    '''
+    return [np.random.default_rng(seed_sequence) for seed_sequence in
+            np.random.SeedSequence(seed).spawn(count)]
+
+
 def translate(x_0, y_0, z_0, x, y, z):
     '''
     Translate points (x, y, z) by (x_0, y_0, z_0).
@@ -16,19 +39,27 @@ def translate(x_0, y_0, z_0, x, y, z):
     return x - x_0, y - y_0, z - z_0
 
 
-def rotate(u_x, u_y, theta, x, y, z):
+def rotation_matrix(u_x, u_y, theta):
     '''
-    Rotate points (x, y, z) around axis with unit vector (u_x, u_y, u_z) by
+    Matrix of the rotation around axis with unit vector (u_x, u_y, u_z) by
     angle theta (counterclockwise, unit vector always points to positive z).
     '''
     u_z = np.sqrt(1 - u_x**2 - u_y**2)
     u_vector = np.array([u_x, u_y, u_z])
     u_vector_t = np.transpose(np.atleast_2d(u_vector))
-    R = np.cos(theta)*np.identity(3) + \
+    return np.cos(theta)*np.identity(3) + \
         (1 - np.cos(theta))*u_vector*u_vector_t + \
         np.sin(theta) * np.array([[0, -u_z, u_y],
                                   [u_z, 0, -u_x],
                                   [-u_y, u_x, 0]])
+
+
+def rotate(u_x, u_y, theta, x, y, z):
+    '''
+    Rotate points (x, y, z) around axis with unit vector (u_x, u_y, u_z) by
+    angle theta (counterclockwise, unit vector always points to positive z).
+    '''
+    R = rotation_matrix(u_x, u_y, theta)
     return [np.squeeze(x) for x in
             np.vsplit(np.matmul(R, np.vstack((x, y, z))), 3)]
 
@@ -37,10 +68,19 @@ class laser(object):
     '''
     A laser is described by a function which given a position returns the laser
     intensity at that position. Electromagnetic phase is ignored.
+
+    Planes at a single height from intensity_plane are remembered (up to
+    plane_cache_size of them), so asking for the same plane again only costs
+    a copy. If field_intensity broadcasts its x, y and z arguments against
+    each other, set broadcasts so intensity_plane can skip building full
+    coordinate grids.
     '''
 
-    def __init__(self, field_intensity):
+    def __init__(self, field_intensity, plane_cache_size=8, broadcasts=False):
         self.field_intensity = field_intensity
+        self.broadcasts = broadcasts
+        self.plane_cache_size = plane_cache_size
+        self.plane_cache = OrderedDict()
 
     def intensity_at(self, cell):
         return self.field_intensity(*cell.position)
@@ -60,25 +100,67 @@ class laser(object):
         Create a laser beam with a gaussian intensity profile. Center of the
         beam is x_0, y_0, z_0, and it's rotated from the z-axis around the
         (u_x, u_y, u_z) axis by angle theta.
+
+        The translation and rotation are combined into one rigid transform
+        up front, so evaluating the beam is a single affine map of the points
+        (which may be arrays of any broadcastable shapes). The map is written
+        out row by row, which lets broadcast coordinates stay small and is
+        several times faster than np.matmul on stacked (N x 3) points.
         '''
-        def fixed_beam(x, y, z):
-            return cls._gaussian_intensity(I_0, w_0, z_R,
-                                           *rotate(u_x, u_y, theta,
-                                                   *translate(x_0, y_0, z_0,
-                                                              x, y, z)))
-        return cls(fixed_beam)
+        R = rotation_matrix(u_x, u_y, theta)
+        offset = np.matmul(R, np.array([x_0, y_0, z_0]))
 
-    def intensity_plane(self, x_0, x_f, y_0, y_f, z):
+        def fixed_beam(x, y, z):
+            beam_x, beam_y, beam_z = [R[i, 0]*x + R[i, 1]*y +
+                                      (R[i, 2]*z - offset[i])
+                                      for i in range(3)]
+            return cls._gaussian_intensity(I_0, w_0, z_R, beam_x, beam_y,
+                                           beam_z)
+        return cls(fixed_beam, broadcasts=True)
+
+    def intensity_plane(self, x_0, x_f, y_0, y_f, z, dtype=np.float64,
+                        tile_rows=1024):
         '''
         Return a 2-d slice of laser intensity.
+
+        The plane is evaluated tile_rows rows at a time so the temporary
+        coordinate arrays stay small for large planes, and stored as dtype
+        (np.float32 halves the memory). z is a height, a (rows x columns)
+        array of heights or a function of x and y. Planes at a single height
+        are remembered per extent, z and dtype, and a copy of the remembered
+        plane is returned when the same one is asked for again.
         '''
-        xx, yy = np.meshgrid(np.arange(x_0, x_f), np.arange(y_0, y_f))
-        if callable(z):
-            zz = z(xx, yy)
-        else:
-            zz = z*np.ones_like(xx)
-        image = self.field_intensity(xx.flatten(), yy.flatten(), zz.flatten())
-        image = image.reshape((y_f-y_0, x_f-x_0))
+        key = None
+        if not callable(z) and np.ndim(z) == 0:
+            key = (x_0, x_f, y_0, y_f, z, np.dtype(dtype))
+            if key in self.plane_cache:
+                self.plane_cache.move_to_end(key)
+                return self.plane_cache[key].copy()
+        x = np.arange(x_0, x_f)
+        image = np.empty((y_f-y_0, x_f-x_0), dtype=dtype)
+        for start in range(0, y_f-y_0, tile_rows):
+            stop = min(start + tile_rows, y_f-y_0)
+            y = np.arange(y_0 + start, y_0 + stop)
+            z_tile = z[start:stop] if np.ndim(z) == 2 else z
+            if self.broadcasts and not callable(z):
+                image[start:stop] = self.field_intensity(x[np.newaxis, :],
+                                                         y[:, np.newaxis],
+                                                         z_tile)
+                continue
+            xx, yy = np.meshgrid(x, y)
+            if callable(z):
+                zz = z(xx, yy)
+            else:
+                zz = z_tile*np.ones_like(xx)
+            tile = self.field_intensity(xx.flatten(), yy.flatten(),
+                                        zz.flatten())
+            image[start:stop] = tile.reshape((stop-start, x_f-x_0))
+        if key is not None and self.plane_cache_size > 0:
+            cached = image.copy()
+            cached.flags.writeable = False
+            self.plane_cache[key] = cached
+            while len(self.plane_cache) > self.plane_cache_size:
+                self.plane_cache.popitem(last=False)
         return image
 
 
@@ -88,12 +170,13 @@ class camera(object):
     '''
 
     def __init__(self, efficiency, exposure_time, signal_per_photon,
-                 saturation_level, circuit_noise):
+                 saturation_level, circuit_noise, rng=None):
         self.efficiency = efficiency
         self.exposure_time = exposure_time
         self.signal_per_photon = signal_per_photon
         self.saturation_level = saturation_level
         self.circuit_noise = circuit_noise
+        self.rng = random_source(rng)
 
     def image_cell(self, cell, laser_intensity, duration):
         '''
@@ -101,26 +184,27 @@ class camera(object):
         signal (stochastic).
         '''
         total_photons = cell.total_signal(laser_intensity, duration)
-        photons = np.random.binomial(total_photons,
-                                     min(self.exposure_time/duration,
-                                         1))
-        photons = np.random.binomial(photons, self.efficiency)
+        photons = self.rng.binomial(total_photons,
+                                    min(self.exposure_time/duration,
+                                        1))
+        photons = self.rng.binomial(photons, self.efficiency)
         camera_signal = self.signal_per_photon * photons + \
-            np.random.poisson(self.circuit_noise)
+            self.rng.poisson(self.circuit_noise)
         return min(self.saturation_level, camera_signal)
 
 
-def background(object):
+class background(object):
     '''
     Placeholder. Just has a constant autofluorescence.
     '''
 
-    def __init__(self, autofluorescence):
+    def __init__(self, autofluorescence, rng=None):
         self.autofluorescence = autofluorescence
+        self.rng = random_source(rng)
 
     def total_signal(self, laser_intensity, duration, area):
-        return np.random.poisson(self.autofluorescence * area *
-                                 laser_intensity * duration)
+        return self.rng.poisson(self.autofluorescence * area *
+                                laser_intensity * duration)
 
 
 class cell(object):
@@ -132,17 +216,22 @@ class cell(object):
     '''
 
     def __init__(self, position, area, autofluorescence,
-                 fluorescent_proteins):
+                 fluorescent_proteins, rng=None):
         self.position = position
         self.area = area
         self.autofluorescence = autofluorescence
         self.fluorescent_proteins = fluorescent_proteins
+        self.rng = random_source(rng)
 
     def protein_signal(self, laser_intensity, duration):
         '''
         Emit photons from all proteins in cell with laser and aggregate their
-        signal.
+        signal. The proteins can be a list of fluorescent_protein or a
+        fluorescent_protein_ensemble.
         '''
+        if isinstance(self.fluorescent_proteins,
+                      fluorescent_protein_ensemble):
+            return self.fluorescent_proteins.emit(laser_intensity, duration)
         photons = 0
         for protein in self.fluorescent_proteins:
             photons = photons + protein.emit(laser_intensity, duration)
@@ -152,8 +241,8 @@ class cell(object):
         '''
         Emit photons due to autofluorescence of cell.
         '''
-        return np.random.poisson(self.area * self.autofluorescence *
-                                 laser_intensity * duration)
+        return self.rng.poisson(self.area * self.autofluorescence *
+                                laser_intensity * duration)
 
     def total_signal(self, laser_intensity, duration):
         '''
@@ -170,10 +259,12 @@ class fluorescent_protein(object):
     '''
 
     def __init__(self, photons_per_time_per_intensity,
-                 bleaching_per_time_per_intensity, is_bleached=False):
+                 bleaching_per_time_per_intensity, is_bleached=False,
+                 rng=None):
         self.brightness = photons_per_time_per_intensity
         self.bleaching_rate = bleaching_per_time_per_intensity
         self.is_bleached = is_bleached
+        self.rng = random_source(rng)
 
     def emit(self, laser_intensity, duration):
         '''
@@ -182,31 +273,88 @@ class fluorescent_protein(object):
         unable to fluoresce.
         '''
         if self.is_bleached is False:
-            bleach_time = np.random.exponential(1/(self.bleaching_rate *
-                                                laser_intensity))
+            bleach_time = self.rng.exponential(1/(self.bleaching_rate *
+                                              laser_intensity))
             if bleach_time < duration:
                 emission_time = bleach_time
                 self.is_bleached = True
             else:
                 emission_time = duration
-            return np.random.poisson(self.brightness * emission_time *
-                                     laser_intensity)
+            return self.rng.poisson(self.brightness * emission_time *
+                                    laser_intensity)
         else:
             return 0
 
 
+class fluorescent_protein_ensemble(object):
+    '''
+    Many fluorescent proteins at once, with their brightnesses, bleaching
+    rates and whether they've photobleached stored as arrays. Behaves like a
+    list of fluorescent_protein in a cell, but emits for all proteins with a
+    few vectorized draws instead of a python loop.
+    '''
+
+    def __init__(self, photons_per_time_per_intensity,
+                 bleaching_per_time_per_intensity, count=None,
+                 is_bleached=False, rng=None):
+        if count is None:
+            count = np.broadcast(photons_per_time_per_intensity,
+                                 bleaching_per_time_per_intensity,
+                                 is_bleached).size
+        self.brightness = np.array(np.broadcast_to(
+            photons_per_time_per_intensity, count), dtype=float)
+        self.bleaching_rate = np.array(np.broadcast_to(
+            bleaching_per_time_per_intensity, count), dtype=float)
+        self.is_bleached = np.array(np.broadcast_to(is_bleached, count),
+                                    dtype=bool)
+        self.rng = random_source(rng)
+
+    @classmethod
+    def from_proteins(cls, proteins, rng=None):
+        '''
+        Make an ensemble with the same state as a list of fluorescent_protein.
+        '''
+        return cls([protein.brightness for protein in proteins],
+                   [protein.bleaching_rate for protein in proteins],
+                   len(proteins),
+                   [protein.is_bleached for protein in proteins], rng)
+
+    def __len__(self):
+        return self.brightness.size
+
+    def emit(self, laser_intensity, duration):
+        '''
+        Emit the total stochastic number of photons from all the proteins.
+        Each unbleached protein draws a bleach time like
+        fluorescent_protein.emit and emits until then or the end of the
+        exposure. The total is drawn as one Poisson number, which has the same
+        distribution as the sum of the per protein Poisson draws.
+        '''
+        unbleached = np.flatnonzero(np.logical_not(self.is_bleached))
+        if unbleached.size == 0:
+            return 0
+        bleach_time = self.rng.exponential(
+            1/(self.bleaching_rate[unbleached] * laser_intensity))
+        self.is_bleached[unbleached[bleach_time < duration]] = True
+        emission_time = np.minimum(bleach_time, duration)
+        return self.rng.poisson(np.sum(self.brightness[unbleached] *
+                                       emission_time) * laser_intensity)
+
+
 class fluorescent_bead(object):
     '''
     Fluorescent beads are described by their brightness, position, and area.
     '''
 
-    def __init__(self, position, area, photons_per_time_per_intensity):
+    def __init__(self, position, area, photons_per_time_per_intensity,
+                 rng=None):
         self.position = position
         self.area = area
         self.brightness = photons_per_time_per_intensity
+        self.rng = random_source(rng)
 
     def emit(self, laser_intensity, duration):
-        return np.random.poisson(self.brightness * duration * laser_intensity)
+        return self.rng.poisson(self.brightness * duration * laser_intensity)
 
 
 def photobleach_curve(laser, camera, cell, frame_count):
@@ -220,3 +368,110 @@ def photobleach_curve(laser, camera, cell, frame_count):
         intensity.append(camera.image_cell(cell, laser.intensity_at(cell),
                                            camera.exposure_time))
     return np.array(intensity)
+
+
+def sample_cell_positions(cell_count, x_0, x_f, y_0, y_f, z=0, rng=None):
+    '''
+    Draw cell_count positions uniformly over the rectangle [x_0, x_f) by
+    [y_0, y_f) of the laser field, at height z (a number or a function of x
+    and y for a tilted slide, as in laser.intensity_plane). Returns a
+    (cell_count x 3) array.
+    '''
+    rng = random_source(rng)
+    x = rng.uniform(x_0, x_f, cell_count)
+    y = rng.uniform(y_0, y_f, cell_count)
+    if callable(z):
+        zz = z(x, y)
+    else:
+        zz = z*np.ones_like(x)
+    return np.stack((x, y, zz), axis=1)
+
+
+def protein_emission_times(intensity, copy_numbers,
+                           bleaching_per_time_per_intensity, duration,
+                           frame_count, max_elements=2**24, rng=None):
+    '''
+    Total time the proteins of each cell spend emitting in each of
+    frame_count consecutive exposures of length duration, as a
+    (cells x frame_count) array.
+
+    Because bleaching is memoryless under constant illumination, each
+    protein's bleach time is drawn once up front instead of every frame. How
+    long it emits in frame k is then its bleach time minus k exposures
+    clipped to [0, duration], computed as one array over
+    (cells x proteins x frames) in chunks of cells of at most max_elements
+    entries. intensity is the laser intensity at each cell.
+    '''
+    rng = random_source(rng)
+    intensity = np.atleast_1d(intensity)
+    copy_numbers = np.broadcast_to(np.asarray(copy_numbers, dtype=int),
+                                   intensity.shape)
+    frame_starts = duration*np.arange(frame_count)
+    max_proteins = max(int(np.max(copy_numbers, initial=0)), 1)
+    chunk_size = max(1, max_elements // (max_proteins*frame_count))
+    emission_time = np.zeros((intensity.size, frame_count))
+    for start in range(0, intensity.size, chunk_size):
+        chunk = slice(start, min(start + chunk_size, intensity.size))
+        bleach_time = rng.exponential(
+            1/(bleaching_per_time_per_intensity*intensity[chunk, np.newaxis]),
+            (intensity[chunk].size, max_proteins))
+        # cells with fewer proteins than the most populous one are padded
+        # with proteins that are bleached from the start
+        absent = np.arange(max_proteins) >= copy_numbers[chunk, np.newaxis]
+        bleach_time[absent] = 0
+        emission_time[chunk] = np.sum(np.clip(bleach_time[:, :, np.newaxis] -
+                                              frame_starts, 0, duration),
+                                      axis=1)
+    return emission_time
+
+
+def photobleach_curves(laser, camera, positions, copy_numbers,
+                       photons_per_time_per_intensity,
+                       bleaching_per_time_per_intensity, area,
+                       autofluorescence, frame_count, max_elements=2**24,
+                       rng=None):
+    '''
+    Photobleaching curves for many cells at once, with the same statistics
+    as running photobleach_curve on a cell of fluorescent_protein at each
+    position.
+
+    Emission times come from protein_emission_times, with bleach times drawn
+    up front, and the rest of the camera model is applied to whole arrays.
+    Cells are done in chunks so no intermediate array has more than
+    max_elements entries.
+
+    positions is a (cells x 3) array, e.g. from sample_cell_positions,
+    copy_numbers the number of proteins in each cell, and copy_numbers, area
+    and autofluorescence may each be a single number or one per cell.
+    Returns a (cells x frame_count) array of camera signals. Draws come from
+    rng, or from the camera's own source if rng is None.
+    '''
+    rng = camera.rng if rng is None else random_source(rng)
+    positions = np.asarray(positions, dtype=float)
+    cell_count = len(positions)
+    copy_numbers = np.broadcast_to(np.asarray(copy_numbers, dtype=int),
+                                   cell_count)
+    area = np.broadcast_to(area, cell_count)
+    autofluorescence = np.broadcast_to(autofluorescence, cell_count)
+    duration = camera.exposure_time
+    max_proteins = max(int(np.max(copy_numbers, initial=0)), 1)
+    chunk_size = max(1, max_elements // (max_proteins*frame_count))
+    signal = np.zeros((cell_count, frame_count))
+    for start in range(0, cell_count, chunk_size):
+        chunk = slice(start, min(start + chunk_size, cell_count))
+        intensity = np.atleast_1d(laser.field_intensity(*positions[chunk].T))
+        emission_time = protein_emission_times(
+            intensity, copy_numbers[chunk], bleaching_per_time_per_intensity,
+            duration, frame_count, max_elements, rng)
+        photons = rng.poisson(photons_per_time_per_intensity *
+                              emission_time * intensity[:, np.newaxis])
+        photons = photons + rng.poisson(
+            (area[chunk] * autofluorescence[chunk] * intensity *
+             duration)[:, np.newaxis], photons.shape)
+        # the exposure is the whole duration, so the first binomial step of
+        # camera.image_cell always keeps every photon
+        photons = rng.binomial(photons, camera.efficiency)
+        camera_signal = camera.signal_per_photon * photons + \
+            rng.poisson(camera.circuit_noise, photons.shape)
+        signal[chunk] = np.minimum(camera.saturation_level, camera_signal)
+    return signal
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact storage for masks and label images.
+
+A full frame boolean mask takes a byte per pixel and an int64 label image
+eight, though a mask only needs a bit per pixel and a label image with a few
+hundred cells is almost all runs of zeros. packedMask keeps a mask bit packed
+(8x smaller) and runLengthLabel keeps a label image as runs of the same label
+along each row (usually hundreds of times smaller). Lists of them stand in for
+the lists of masks and labels the notebooks keep per FOV, and
+segmentation.warpIm2Im, segmentation.removeNonCirles and
+spotfinding_prototype.maskBboxesandCoordinates accept them directly.
+
+    masks = [compact(mask) for mask in masks]
+    save_npz('masks.npz', masks)
+    masks = load_npz('masks.npz')
+
+@author: kuhlmanlab
+"""
+
+import numpy as np
+
+# number of set bits in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+class packedMask(object):
+    '''
+    A boolean mask stored as one bit per pixel.
+    '''
+
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.packbits(mask.ravel()), mask.shape)
+
+    def dense(self):
+        size = int(np.prod(self.shape))
+        return np.unpackbits(self.bits, count=size).view(bool).reshape(
+            self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.dense()
+        return mask if dtype is None else mask.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def sum(self):
+        '''
+        Number of True pixels, without unpacking.
+        '''
+        return int(_POPCOUNT[self.bits].sum())
+
+
+class runLengthLabel(object):
+    '''
+    A label image stored as the runs of nonzero labels along each row: run i
+    covers flat (raster order) pixels starts[i] to starts[i] + lengths[i] - 1,
+    all labeled values[i]. Runs never cross the end of a row.
+    '''
+
+    def __init__(self, starts, lengths, values, shape, dtype):
+        self.starts = starts
+        self.lengths = lengths
+        self.values = values
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_dense(cls, label):
+        label = np.asarray(label)
+        flat = label.ravel()
+        width = label.shape[-1] if label.ndim > 0 else 1
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        row_starts = np.arange(width, flat.size, width)
+        starts = np.union1d(np.concatenate([[0], changes]), row_starts)
+        starts = starts[starts < flat.size]
+        lengths = np.diff(np.append(starts, flat.size))
+        values = flat[starts]
+        labeled = values != 0
+        index_type = np.min_scalar_type(max(flat.size, 1))
+        return cls(starts[labeled].astype(index_type),
+                   lengths[labeled].astype(index_type),
+                   values[labeled], label.shape, label.dtype)
+
+    def flat_indices(self):
+        '''
+        Raster order index of every labeled pixel, run by run.
+        '''
+        total = int(np.sum(self.lengths, dtype=np.int64))
+        offsets = np.cumsum(self.lengths, dtype=np.int64) - self.lengths
+        return np.arange(total) + np.repeat(
+            self.starts.astype(np.int64) - offsets, self.lengths)
+
+    def dense(self):
+        label = np.zeros(int(np.prod(self.shape)), dtype=self.dtype)
+        label[self.flat_indices()] = np.repeat(self.values, self.lengths)
+        return label.reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        label = self.dense()
+        return label if dtype is None else label.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.lengths.nbytes + self.values.nbytes
+
+    def labels(self):
+        '''
+        The sorted nonzero labels present.
+        '''
+        return np.unique(self.values)
+
+    def regions(self):
+        '''
+        The labels present (sorted), and for each the (pixels x 2) row and
+        column coordinates it covers in raster order and its bounding box
+        (min_row, min_col, max_row, max_col) with the maxima exclusive, as
+        skimage.measure.regionprops gives them.
+        '''
+        width = self.shape[1]
+        order = np.argsort(self.values, kind='stable')
+        values = self.values[order]
+        starts = self.starts[order].astype(np.int64)
+        lengths = self.lengths[order].astype(np.int64)
+        labels, first_run = np.unique(values, return_index=True)
+        run_bounds = np.append(first_run, values.size)
+        rows = starts // width
+        first_col = starts % width
+        coords = []
+        bboxes = []
+        for k in range(labels.size):
+            runs = slice(run_bounds[k], run_bounds[k + 1])
+            run_lengths = lengths[runs]
+            pixel_count = int(run_lengths.sum())
+            offsets = np.cumsum(run_lengths) - run_lengths
+            cols = np.arange(pixel_count) + \
+                np.repeat(first_col[runs] - offsets, run_lengths)
+            coords.append(np.column_stack(
+                [np.repeat(rows[runs], run_lengths), cols]))
+            bboxes.append((int(rows[runs].min()),
+                           int(first_col[runs].min()),
+                           int(rows[runs].max()) + 1,
+                           int((first_col[runs] + run_lengths).max())))
+        return labels, coords, bboxes
+
+
+def is_compact(image):
+    return isinstance(image, (packedMask, runLengthLabel))
+
+
+def compact(image):
+    '''
+    packedMask of a boolean mask, runLengthLabel of anything else.
+    '''
+    if is_compact(image):
+        return image
+    image = np.asarray(image)
+    if image.dtype == bool:
+        return packedMask.from_dense(image)
+    return runLengthLabel.from_dense(image)
+
+
+def dense(image):
+    '''
+    The full array of a compact mask or label, other arrays as they are.
+    '''
+    if is_compact(image):
+        return image.dense()
+    return image
+
+
+def like(original, image):
+    '''
+    image stored the way original is, so functions given compact inputs give
+    compact outputs.
+    '''
+    if isinstance(original, packedMask):
+        return packedMask.from_dense(image)
+    if isinstance(original, runLengthLabel):
+        return runLengthLabel.from_dense(image)
+    return image
+
+
+def regionCoordinates(label_list):
+    '''
+    Per region FOV, label, coordinates and bounding box of a list of
+    runLengthLabels, in the form (and order) of
+    segmentation.properties2list of regionprops with fields ['coords',
+    'bbox'], without decoding the label images.
+    '''
+    answer = {'FOV': [], 'label': [], 'coords': [], 'bbox': []}
+    for FOV, label in enumerate(label_list):
+        labels, coords, bboxes = label.regions()
+        answer['FOV'].extend([FOV]*labels.size)
+        answer['label'].extend(labels.tolist())
+        answer['coords'].extend(coords)
+        answer['bbox'].extend(bboxes)
+    answer['FOV'] = np.array(answer['FOV'], dtype=int)
+    answer['label'] = np.array(answer['label'], dtype=int)
+    return answer
+
+
+def save_npz(filename, images):
+    '''
+    Save a list of compact masks or labels (dense ones are compacted first,
+    all must end up the same kind) to a .npz file.
+    '''
+    images = [compact(image) for image in images]
+    shapes = np.array([image.shape for image in images], dtype=np.int64)
+    if all(isinstance(image, packedMask) for image in images):
+        sizes = np.array([image.bits.size for image in images])
+        np.savez_compressed(filename, kind='packedMask', shapes=shapes,
+                            sizes=sizes,
+                            bits=np.concatenate([image.bits for image in
+                                                 images] + [np.zeros(0,
+                                                            np.uint8)]))
+    elif all(isinstance(image, runLengthLabel) for image in images):
+        dtype = np.result_type(*[image.dtype for image in images])
+        np.savez_compressed(
+            filename, kind='runLengthLabel', shapes=shapes,
+            dtype=dtype.str,
+            sizes=np.array([image.starts.size for image in images]),
+            starts=np.concatenate([image.starts.astype(np.int64) for image
+                                   in images] + [np.zeros(0, np.int64)]),
+            lengths=np.concatenate([image.lengths.astype(np.int64) for
+                                    image in images] +
+                                   [np.zeros(0, np.int64)]),
+            values=np.concatenate([image.values.astype(dtype) for image in
+                                   images] + [np.zeros(0, dtype)]))
+    else:
+        raise ValueError('images must be all masks or all labels')
+
+
+def load_npz(filename):
+    '''
+    The list of compact masks or labels saved by save_npz.
+    '''
+    with np.load(filename) as data:
+        kind = str(data['kind'])
+        shapes = data['shapes']
+        bounds = np.append(0, np.cumsum(data['sizes']))
+        pieces = [slice(bounds[i], bounds[i + 1]) for i in
+                  range(len(shapes))]
+        if kind == 'packedMask':
+            bits = data['bits']
+            return [packedMask(bits[piece].copy(), shape) for piece, shape
+                    in zip(pieces, shapes)]
+        dtype = np.dtype(str(data['dtype']))
+        starts, lengths, values = data['starts'], data['lengths'], \
+            data['values']
+        images = []
+        for piece, shape in zip(pieces, shapes):
+            index_type = np.min_scalar_type(max(int(np.prod(shape)), 1))
+            images.append(runLengthLabel(starts[piece].astype(index_type),
+                                         lengths[piece].astype(index_type),
+                                         values[piece].copy(), shape, dtype))
+        return images
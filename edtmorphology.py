@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dilation and erosion by a disk through the Euclidean distance transform.
+
+Dilating with skmo.disk(r) costs a pass over the image per pixel of the disk,
+so the radius 10 to 15 dilations in the cell and spot masks make up most of
+their time. A pixel is in the dilation exactly when some mask pixel is within
+distance r of it, i.e. when its distance to the mask is at most r, and the
+distance transform gives that for every pixel at a cost that doesn't depend
+on r. The results are the same as skimage's with disk(r) for whole number
+radii: outside the image counts as background for dilation and as foreground
+for erosion, as it does there.
+
+@author: kuhlmanlab
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+
+import compactmasks
+
+
+def _box(mask, radius):
+    '''
+    The bounding box of a mask grown by radius, cut to the image.
+    '''
+    box = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        present = np.flatnonzero(np.any(mask, axis=other_axes))
+        box.append(slice(max(present[0] - radius, 0),
+                         min(present[-1] + radius + 1, mask.shape[axis])))
+    return tuple(box)
+
+
+def dilate(mask, radius):
+    '''
+    skmo.binary_dilation(mask, skmo.disk(radius)): the pixels within radius
+    of the mask. Only the bounding box of the mask grown by radius is
+    transformed.
+    '''
+    mask = np.asarray(compactmasks.dense(mask), dtype=bool)
+    dilated = np.zeros(mask.shape, dtype=bool)
+    if not mask.any():
+        return dilated
+    box = _box(mask, int(np.ceil(radius)))
+    dilated[box] = ndi.distance_transform_edt(~mask[box]) <= radius
+    return dilated
+
+
+def erode(mask, radius):
+    '''
+    skmo.binary_erosion(mask, skmo.disk(radius)): the pixels of the mask
+    farther than radius from any background pixel in the image.
+    '''
+    mask = np.asarray(compactmasks.dense(mask), dtype=bool)
+    if mask.all():
+        return mask.copy()
+    return ndi.distance_transform_edt(mask) > radius
+
+
+def dilate_labels(label, radius):
+    '''
+    skmo.dilation(label, skmo.disk(radius)) for a label image (no negative
+    labels): every pixel takes the largest label within radius of it. Each
+    label is dilated through the distance transform of its own bounding box
+    grown by radius, and the labels are written in increasing order so the
+    largest wins where they meet.
+    '''
+    label = np.asarray(compactmasks.dense(label))
+    grown = np.zeros_like(label)
+    margin = int(np.ceil(radius))
+    for value, box in enumerate(ndi.find_objects(label), 1):
+        if box is None:
+            continue
+        box = tuple(slice(max(part.start - margin, 0),
+                          min(part.stop + margin, size))
+                    for part, size in zip(box, label.shape))
+        near = ndi.distance_transform_edt(label[box] != value) <= radius
+        grown[box][near] = value
+    return grown
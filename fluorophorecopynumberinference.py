@@ -8,49 +8,277 @@ Created on Thu Jun  7 15:58:12 2018
 Method based upon the work by Nayak and Rutenberg (2011)
 """
 
+import hashlib
+import json
+import os
+import time
+import warnings
 from collections import OrderedDict
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                as_completed, wait)
 import numpy as np
 import scipy.optimize as spopt
 
+# fraction of the camera's full scale a repeated maximum has to reach to be
+# taken for saturation
+SATURATION_FRACTION = .95
+
 
 def exp_plus_constant_ceilinged(x, A, tau, C, ceiling):
     return np.minimum(A*np.exp(-x/tau) + C, ceiling)
 
 
-def fit_photobleach_rate(arg1, arg2=None):
+def exp_plus_constant_ceilinged_jacobian(x, A, tau, C, ceiling):
+    """
+    Derivatives of exp_plus_constant_ceilinged with respect to A, tau, C and
+    ceiling, stacked along the last axis. Parameters may be arrays (one value
+    per cell, as columns) to get the jacobians of many cells at once.
+    """
+    decay = np.exp(-x/tau)
+    unclipped = A*decay + C <= ceiling
+    d_A = decay*unclipped
+    d_tau = A*x/tau**2*decay*unclipped
+    d_C = np.ones_like(decay)*unclipped
+    d_ceiling = np.ones_like(decay)*np.logical_not(unclipped)
+    return np.stack((d_A, d_tau, d_C, d_ceiling), axis=-1)
+
+
+def _photobleach_data(arg1, arg2):
     if arg2 is None:
         y = arg1
-        x = np.arange(len(y))
+        x = np.arange(np.shape(y)[-1])
     else:
         y = arg2
         x = arg1
-    C_initial_guess = np.mean(y[int(3*len(y)/4):len(y)])
-    A_initial_guess = np.mean(y[0:2])-C_initial_guess
-    tau_approx_index = np.argmin(np.abs(y - (A_initial_guess*np.exp(-1) +
-                                             C_initial_guess)))
-    tau_initial_guess = x[tau_approx_index]
-    ceiling_initial_guess = 65000.0
+    return np.asarray(x), np.asarray(y)
+
+
+def _saturation_level(Y, saturation_level=None):
+    """
+    The intensity from which a trace's repeated maximum counts as
+    saturation: saturation_level if given, otherwise SATURATION_FRACTION of
+    the full scale of Y's integer type (of 16 bits for wider types and for
+    floats, as from our cameras).
+    """
+    if saturation_level is not None:
+        return saturation_level
+    dtype = np.asarray(Y).dtype
+    full_scale = 2**16 - 1
+    if np.issubdtype(dtype, np.integer):
+        full_scale = min(np.iinfo(dtype).max, full_scale)
+    return SATURATION_FRACTION*full_scale
+
+
+def _initial_guesses(x, Y, saturated_frames=2, saturation_level=None):
+    """
+    Starting parameters for fitting exp_plus_constant_ceilinged to each row
+    of Y, as a (cells x 4) array.
+
+    C is the mean of the last quarter of the trace. A trace whose maximum is
+    at least saturation_level (see _saturation_level) and is repeated in at
+    least saturated_frames frames is taken to be saturated and its ceiling
+    starts at that maximum, otherwise at 65000 (or twice the maximum for
+    brighter data, out of the way either way). Ties at the peak of dim
+    integer traces are common and don't count. A and tau come from
+    a straight line fit of log(I - C) against time over the unsaturated frames
+    still clearly above C, weighted by (I - C)**2 to undo the log's
+    amplification of noise in the dim frames. Traces where that line doesn't
+    decay fall back to the old guesses: the first two frames for A and the
+    time the trace is closest to A/e + C for tau.
+    """
+    frames = Y.shape[1]
+    C_initial_guess = np.mean(Y[:, int(3*frames/4):frames], axis=1)
+    max_value = np.max(Y, axis=1)
+    saturated = (np.sum(Y == max_value[:, np.newaxis], axis=1) >=
+                 saturated_frames) & \
+        (max_value >= _saturation_level(Y, saturation_level))
+    ceiling_initial_guess = np.where(saturated, max_value,
+                                     np.maximum(65000.0, 2*max_value))
+    A_fallback = np.mean(Y[:, 0:2], axis=1) - C_initial_guess
+    tau_approx_index = np.argmin(np.abs(Y - (A_fallback*np.exp(-1) +
+                                             C_initial_guess)[:, np.newaxis]),
+                                 axis=1)
+    tau_fallback = x[tau_approx_index]
+    decay = Y - C_initial_guess[:, np.newaxis]
+    noise = np.std(Y[:, int(3*frames/4):frames], axis=1)
+    usable = (decay > 2*noise[:, np.newaxis]) & \
+        np.logical_not(saturated[:, np.newaxis] &
+                       (Y == max_value[:, np.newaxis]))
+    weights = np.where(usable, decay, 0)**2
+    with np.errstate(all='ignore'):
+        log_decay = np.where(usable, np.log(np.where(usable, decay, 1)), 0)
+        w_sum = np.sum(weights, axis=1)
+        x_mean = np.sum(weights*x, axis=1)/w_sum
+        z_mean = np.sum(weights*log_decay, axis=1)/w_sum
+        x_dev = x - x_mean[:, np.newaxis]
+        slope = np.sum(weights*x_dev*(log_decay - z_mean[:, np.newaxis]),
+                       axis=1)/np.sum(weights*x_dev**2, axis=1)
+        A_fit = np.exp(z_mean - slope*x_mean)
+        tau_fit = -1/slope
+    good_fit = (np.sum(usable, axis=1) >= 2) & np.isfinite(tau_fit) & \
+        (tau_fit > 0) & np.isfinite(A_fit)
+    A_initial_guess = np.where(good_fit, A_fit, A_fallback)
+    tau_initial_guess = np.where(good_fit, tau_fit, tau_fallback)
+    return np.stack((A_initial_guess, tau_initial_guess, C_initial_guess,
+                     ceiling_initial_guess), axis=1).astype(float)
+
+
+def _fit_outputs(popt, perr):
+    params = OrderedDict()
+    stds = OrderedDict()
+    for i, name in enumerate(['A', 'tau', 'C', 'ceiling']):
+        if np.ndim(popt) == 1:
+            # a single fit gives scalars
+            params[name] = popt[i]
+            stds[name] = perr[i]
+        else:
+            params[name] = popt[..., i]
+            stds[name] = perr[..., i]
+    return params, stds
+
+
+def fit_photobleach_rate(arg1, arg2=None, return_info=False,
+                         saturation_level=None):
+    """
+    Fit exp_plus_constant_ceilinged to a photobleaching trace, given either
+    the intensities alone (one frame per time unit) or times and intensities.
+    saturation_level is where the camera saturates, by default near the full
+    scale of the trace's integer type (see _saturation_level).
+    Returns OrderedDicts of the fit parameters and their standard deviations,
+    NaN if the fit failed. With return_info True it also returns a dict with
+    the number of function ('nfev') and jacobian ('njev') evaluations, the
+    fit time in seconds ('time') and whether the fit converged ('success').
+    """
+    start = time.perf_counter()
+    x, y = _photobleach_data(arg1, arg2)
+    p0 = _initial_guesses(x, y[np.newaxis, :],
+                          saturation_level=saturation_level)[0]
+    info = {'nfev': 0, 'njev': 0, 'success': True}
     try:
-        popt, pcov = spopt.curve_fit(exp_plus_constant_ceilinged, x, y,
-                                     p0=(A_initial_guess, tau_initial_guess,
-                                         C_initial_guess,
-                                         ceiling_initial_guess))
+        popt, pcov, infodict, message, ier = \
+            spopt.curve_fit(exp_plus_constant_ceilinged, x, y, p0=p0,
+                            jac=exp_plus_constant_ceilinged_jacobian,
+                            full_output=True)
+        info['nfev'] = infodict['nfev']
+        info['njev'] = infodict.get('njev', 0)
     except RuntimeError:
         popt = np.array([np.nan]*4)
         pcov = np.ones((4, 4))*np.nan
-    params = OrderedDict()
-    stds = OrderedDict()
-    params['A'] = popt[0]
-    stds['A'] = pcov[0, 0]**.5
-    params['tau'] = popt[1]
-    stds['tau'] = pcov[1, 1]**.5
-    params['C'] = popt[2]
-    stds['C'] = pcov[2, 2]**.5
-    params['ceiling'] = popt[3]
-    stds['ceiling'] = pcov[3, 3]**.5
+        info['success'] = False
+    params, stds = _fit_outputs(popt, np.diag(pcov)**.5)
+    if return_info:
+        info['time'] = time.perf_counter() - start
+        return params, stds, info
     return params, stds
 
 
+def fit_photobleach_rates(arg1, arg2=None, max_iter=200, ftol=1.49012e-8,
+                          xtol=1.49012e-8, return_info=False,
+                          saturation_level=None):
+    """
+    Fit exp_plus_constant_ceilinged to many photobleaching traces at once.
+
+    Takes either a (cells x frames) intensity matrix, or a time vector shared
+    by all cells and the intensity matrix, like fit_photobleach_rate does for
+    one trace. All cells are fit together by a vectorized Levenberg-Marquardt
+    (damped Gauss-Newton) iteration using the analytic jacobian. Returns
+    params and stds OrderedDicts like fit_photobleach_rate, but with one
+    value per cell. Cells that don't converge in max_iter iterations, or
+    are given up on because the damping grew past 1e16 without reducing the
+    cost, get NaN parameters and stds, and cells whose covariance can't be
+    estimated get infinite stds, as curve_fit would give for a single cell.
+    With return_info True it also returns a dict with the number of
+    iterations each cell took ('iterations'), which cells converged
+    ('success') and the total time in seconds ('time'). saturation_level is
+    as for fit_photobleach_rate.
+    """
+    start = time.perf_counter()
+    x, Y = _photobleach_data(arg1, arg2)
+    saturation_level = _saturation_level(Y, saturation_level)
+    Y = np.atleast_2d(Y).astype(float)
+    cells, frames = Y.shape
+    P = _initial_guesses(x, Y, saturation_level=saturation_level)
+    damping = np.full(cells, 1e-3)
+    converged = np.zeros(cells, dtype=bool)
+    iterations = np.zeros(cells, dtype=int)
+
+    def costs(P, Y):
+        model = exp_plus_constant_ceilinged(x, *(P.T[:, :, np.newaxis]))
+        return np.sum((Y - model)**2, axis=1), Y - model
+
+    cost, residuals = costs(P, Y)
+    active = np.flatnonzero(np.isfinite(cost))
+    for iteration in range(max_iter):
+        if active.size == 0:
+            break
+        iterations[active] += 1
+        P_a = P[active]
+        J = exp_plus_constant_ceilinged_jacobian(x, *(P_a.T[:, :, np.newaxis]))
+        JTJ = np.matmul(np.swapaxes(J, 1, 2), J)
+        gradient = np.matmul(np.swapaxes(J, 1, 2),
+                             residuals[active][:, :, np.newaxis])
+        scale = np.diagonal(JTJ, axis1=1, axis2=2)
+        scale = np.maximum(scale, 1e-12*np.max(scale, axis=1, keepdims=True) +
+                           np.finfo(float).tiny)
+        damped = JTJ + (damping[active, np.newaxis] * scale)[:, :, np.newaxis] \
+            * np.identity(4)
+        with np.errstate(all='ignore'):
+            try:
+                step = np.linalg.solve(damped, gradient)[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.matmul(np.linalg.pinv(damped), gradient)[:, :, 0]
+            P_new = P_a + step
+            cost_new, residuals_new = costs(P_new, Y[active])
+        better = np.isfinite(cost_new) & (cost_new <= cost[active])
+        small_reduction = (cost[active] - cost_new) <= ftol*cost[active]
+        small_step = np.all(np.abs(step) <= xtol*(np.abs(P_a) + xtol), axis=1)
+        stuck = damping[active] > 1e16
+        accepted = active[better]
+        P[accepted] = P_new[better]
+        cost[accepted] = cost_new[better]
+        residuals[accepted] = residuals_new[better]
+        damping[active] = np.where(better, damping[active]/10,
+                                   damping[active]*10)
+        finished = better & (small_reduction | small_step)
+        converged[active[finished]] = True
+        active = active[~(finished | stuck)]
+    # covariance as curve_fit computes it, inf where the jacobian is singular
+    J = exp_plus_constant_ceilinged_jacobian(x, *(P.T[:, :, np.newaxis]))
+    perr = np.full((cells, 4), np.inf)
+    with np.errstate(all='ignore'):
+        full_rank = np.linalg.matrix_rank(J) == 4
+        if frames > 4 and np.any(full_rank):
+            cov = np.linalg.inv(np.matmul(np.swapaxes(J[full_rank], 1, 2),
+                                          J[full_rank]))
+            s_sq = cost[full_rank]/(frames - 4)
+            perr[full_rank] = (np.diagonal(cov, axis1=1, axis2=2) *
+                               s_sq[:, np.newaxis])**.5
+    P[~converged] = np.nan
+    perr[~converged] = np.nan
+    params, stds = _fit_outputs(P, perr)
+    if return_info:
+        info = {'iterations': iterations, 'success': converged,
+                'time': time.perf_counter() - start}
+        return params, stds, info
+    return params, stds
+
+
+def copy_number_from_fit(I, time, params):
+    """
+    The copy number estimate of single_cell_inference for traces I (one per
+    row, or a single trace) given their fitted parameters (scalars or one per
+    row).
+    """
+    A, tau, C, ceiling = [np.asarray(value)[..., np.newaxis] for value in
+                          params.values()]
+    p = np.exp(-time/tau)
+    delta_p = -np.diff(p, axis=-1)
+    I_fit = exp_plus_constant_ceilinged(time, A, tau, C, ceiling)
+    I_0 = I_fit[..., 0:1]
+    I_var = (I - I_fit)**2
+    return 6 * np.sum(I_var[..., :-1]/I_0*delta_p, axis=-1)
+
+
 def single_cell_inference(I, time):
     params, stds = fit_photobleach_rate(time, I)
     p = np.exp(-time/params['tau'])
@@ -59,3 +287,145 @@ def single_cell_inference(I, time):
     I_0 = I_fit[0]
     I_var = (I - I_fit)**2
     return 6 * np.sum(I_var[:-1]/I_0*delta_p)
+
+
+def bootstrap_inference(I, time, n_boot=200, confidence=.95, rng=None):
+    """
+    Copy number estimates with residual bootstrap confidence intervals for
+    each row of the (cells x frames) matrix I.
+
+    Every cell is fit with fit_photobleach_rates, then n_boot new traces are
+    made by adding residuals drawn with replacement from that cell's fit back
+    onto the fitted curve, and each is fit and estimated again. Returns a
+    dict of arrays with the copy number, the lower and upper ends of the
+    central confidence interval of the bootstrap estimates, and the fitted
+    parameters. rng is a numpy.random.Generator.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    I = np.atleast_2d(np.asarray(I, dtype=float))
+    cells, frames = I.shape
+    params, stds = fit_photobleach_rates(time, I)
+    copy_number = copy_number_from_fit(I, time, params)
+    I_fit = exp_plus_constant_ceilinged(time, *[value[:, np.newaxis] for
+                                                value in params.values()])
+    residuals = I - I_fit
+    picks = rng.integers(0, frames, size=(cells, n_boot, frames))
+    resampled = np.take_along_axis(residuals[:, np.newaxis, :].repeat(n_boot,
+                                                                      1),
+                                   picks, axis=2)
+    I_boot = (I_fit[:, np.newaxis, :] + resampled).reshape(-1, frames)
+    boot_params, boot_stds = fit_photobleach_rates(time, I_boot)
+    boot_copy_number = \
+        copy_number_from_fit(I_boot, time, boot_params).reshape(cells, n_boot)
+    tail = 100*(1 - confidence)/2
+    with warnings.catch_warnings():
+        # cells whose fits all failed give all NaN rows
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanpercentile(boot_copy_number, [tail, 100 - tail],
+                                        axis=1)
+    results = {'copy_number': copy_number, 'lower': lower, 'upper': upper}
+    for name, value in params.items():
+        results[name] = value
+    return results
+
+
+def _inference_chunk(I, time, n_boot, confidence, seed_sequence):
+    return bootstrap_inference(I, time, n_boot, confidence,
+                               np.random.default_rng(seed_sequence))
+
+
+def experiment_inference(traces, time, n_boot=200, confidence=.95, seed=0,
+                         processes=None, chunk_size=256, results_dir=None):
+    """
+    Run bootstrap_inference over every cell trace of an experiment.
+
+    traces is a (cells x frames) matrix (it can be a memmap, for example from
+    celltraces.extract_traces). Cells are split into chunks of chunk_size
+    which run on a pool of processes worker processes (all cores if None, in
+    this process if 1). Each chunk draws from its own random stream spawned
+    from seed, so results are the same whatever the number of workers.
+
+    If results_dir is given each chunk's results are saved there as soon as
+    it finishes, and running again with the same arguments only computes the
+    chunks that are missing, so an interrupted run picks up where it stopped.
+    A hash of traces and time is saved with the settings, so results of other
+    data in results_dir are refused rather than mixed in.
+    Returns a dict of arrays with one entry per cell, as bootstrap_inference.
+    """
+    cells = len(traces)
+    starts = list(range(0, cells, chunk_size))
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(starts))
+    done = {}
+    if results_dir is not None:
+        os.makedirs(results_dir, exist_ok=True)
+        settings = {'cells': cells, 'frames': int(np.shape(traces)[1]),
+                    'n_boot': n_boot, 'confidence': confidence,
+                    'seed': seed, 'chunk_size': chunk_size,
+                    'data': _data_hash(traces, time, starts, chunk_size)}
+        settings_file = os.path.join(results_dir, 'settings.json')
+        if os.path.exists(settings_file):
+            with open(settings_file) as file:
+                if json.load(file) != settings:
+                    raise ValueError('results_dir holds results of a run '
+                                     'with different settings')
+        else:
+            with open(settings_file, 'w') as file:
+                json.dump(settings, file)
+        for k in range(len(starts)):
+            chunk_file = _chunk_file(results_dir, k)
+            if os.path.exists(chunk_file):
+                with np.load(chunk_file) as saved:
+                    done[k] = {name: saved[name] for name in saved.files}
+
+    def finished(k, results):
+        done[k] = results
+        if results_dir is not None:
+            chunk_file = _chunk_file(results_dir, k)
+            # write then rename so an interruption never leaves half a file
+            with open(chunk_file + '.tmp', 'wb') as file:
+                np.savez(file, **results)
+            os.replace(chunk_file + '.tmp', chunk_file)
+
+    todo = [k for k in range(len(starts)) if k not in done]
+    # each chunk is only read from traces when it is about to run
+    args = ((k, (np.asarray(traces[starts[k]:starts[k] + chunk_size]), time,
+                 n_boot, confidence, seed_sequences[k])) for k in todo)
+    if processes == 1:
+        for k, arg in args:
+            finished(k, _inference_chunk(*arg))
+    elif todo:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # keep a couple of chunks queued per worker rather than all of them
+            max_pending = 2*(processes or os.cpu_count() or 1)
+            futures = {}
+            for k, arg in args:
+                futures[executor.submit(_inference_chunk, *arg)] = k
+                if len(futures) >= max_pending:
+                    finished_futures, _ = wait(futures,
+                                               return_when=FIRST_COMPLETED)
+                    for future in finished_futures:
+                        finished(futures.pop(future), future.result())
+            for future in as_completed(futures):
+                finished(futures[future], future.result())
+    if not starts:
+        return {}
+    return {name: np.concatenate([done[k][name] for k in range(len(starts))])
+            for name in done[0]}
+
+
+def _data_hash(traces, time, starts, chunk_size):
+    """
+    sha256 of the traces and frame times, read a chunk at a time so a memmap
+    of traces isn't loaded whole.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(time, dtype=float).tobytes())
+    for start in starts:
+        digest.update(np.ascontiguousarray(
+            traces[start:start + chunk_size], dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def _chunk_file(results_dir, k):
+    return os.path.join(results_dir, 'chunk_{:06d}.npz'.format(k))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run per-FOV functions on all cores without pickling the images.
+
+The segmentation and spot finding functions are applied to one FOV at a time
+in list comprehensions. map_fovs spreads those calls over worker processes.
+The images are put once into a sharedStack, a (FOVs x rows x columns) array
+in multiprocessing.shared_memory (or an existing .npy memmap), and the workers
+only get its name, so each worker reads the FOV it needs straight out of
+shared memory. Results come back in FOV order, along with how long each
+worker spent on which FOVs.
+
+    with sharedStack.from_images(pc_images) as pc:
+        masks = map_fovs(mseg.thresholdMask, [pc])
+
+@author: kuhlmanlab
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class sharedStack(object):
+    '''
+    A stack of same sized images that worker processes can open by name.
+
+    Make one with sharedStack.from_images (copies the images into shared
+    memory one at a time, so an ImageCollection is never all in memory twice),
+    sharedStack.empty (shared memory for results) or sharedStack.from_memmap
+    (a .npy file on disk, nothing is copied). The process that made the stack
+    owns it and should close it (or use it as a context manager), which frees
+    the shared memory.
+    '''
+
+    def __init__(self, shape, dtype, name=None, filename=None, offset=0,
+                 create=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.filename = filename
+        self.offset = offset
+        self.owner = create
+        self.shm = None
+        if filename is not None:
+            self.array = np.memmap(filename, dtype=self.dtype, mode='r+',
+                                   offset=offset, shape=self.shape)
+        else:
+            size = max(int(np.prod(self.shape))*self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(name=name, create=create,
+                                                  size=size)
+            self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                    buffer=self.shm.buf)
+
+    @classmethod
+    def empty(cls, shape, dtype):
+        return cls(shape, dtype, create=True)
+
+    @classmethod
+    def from_images(cls, images, dtype=None):
+        first = np.asarray(images[0])
+        if dtype is None:
+            dtype = first.dtype
+        stack = cls.empty((len(images),) + first.shape, dtype)
+        stack.array[0] = first
+        for i in range(1, len(images)):
+            stack.array[i] = images[i]
+        return stack
+
+    @classmethod
+    def from_memmap(cls, filename):
+        '''
+        Open a .npy file (e.g. from np.lib.format.open_memmap) as a stack.
+        '''
+        array = np.load(filename, mmap_mode='r')
+        return cls(array.shape, array.dtype, filename=filename,
+                   offset=array.offset)
+
+    def descriptor(self):
+        '''
+        What a worker needs to open the stack, small enough to pickle.
+        '''
+        if self.filename is not None:
+            return ('memmap', self.filename, self.offset, self.shape,
+                    self.dtype.str)
+        return ('shm', self.shm.name, 0, self.shape, self.dtype.str)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def close(self):
+        '''
+        Let go of the stack, freeing the shared memory if this process made
+        it.
+        '''
+        self.array = None
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class perFOV(object):
+    '''
+    Wrap a function that takes a list of images (like
+    spotfinding_prototype.spotfindingLabels) so it takes one image and returns
+    one result, for use with map_fovs. Other arguments are passed through.
+    '''
+
+    def __init__(self, list_function, *args, **kwargs):
+        self.list_function = list_function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, image):
+        return self.list_function([image], *self.args, **self.kwargs)[0]
+
+
+# stacks a worker process has already opened, by descriptor
+_worker_stacks = {}
+
+
+def _open(descriptor):
+    if descriptor not in _worker_stacks:
+        kind, name, offset, shape, dtype = descriptor
+        if kind == 'memmap':
+            stack = sharedStack(shape, dtype, filename=name, offset=offset)
+        else:
+            stack = sharedStack(shape, dtype, name=name)
+        _worker_stacks[descriptor] = stack
+    return _worker_stacks[descriptor]
+
+
+def _run_fovs(func, descriptors, out_descriptor, indices, args, kwargs):
+    '''
+    Run func on a chunk of FOVs in a worker. Returns the results (None for
+    those written to the out stack), the pid and the time spent on each FOV.
+    '''
+    stacks = [_open(descriptor) for descriptor in descriptors]
+    out = None if out_descriptor is None else _open(out_descriptor)
+    results = []
+    seconds = []
+    for index in indices:
+        start = time.perf_counter()
+        result = func(*[stack[index] for stack in stacks], *args, **kwargs)
+        if out is not None:
+            out[index][...] = result
+            result = None
+        results.append(result)
+        seconds.append(time.perf_counter() - start)
+    return results, os.getpid(), seconds
+
+
+def map_fovs(func, stacks, args=(), kwargs=None, out=None, processes=None,
+             chunksize=1, return_timings=False):
+    '''
+    Call func(stack_1[i], stack_2[i], ..., *args, **kwargs) for every FOV i
+    on processes worker processes (all cores if None, 1 to run here).
+
+    Parameters
+    ----------
+    func : function
+        Must be picklable, i.e. defined at module level; bind extra
+        parameters with args and kwargs, functools.partial or perFOV.
+    stacks : list of sharedStack
+        The per-FOV inputs, all the same length.
+    out : sharedStack, optional
+        If given, each result is written to out[i] in the worker and None is
+        returned in its place, so large array results aren't pickled either.
+    chunksize : integer
+        How many FOVs to send to a worker at a time.
+    return_timings : bool
+        Also return a dict with 'wall' (total seconds), 'fov_seconds' (time
+        spent on each FOV) and 'workers' (pid: {'fovs': count, 'seconds':
+        busy time}).
+
+    Returns
+    -------
+    results : list
+        func's result for each FOV, in FOV order.
+    '''
+    if kwargs is None:
+        kwargs = {}
+    start = time.perf_counter()
+    fov_count = len(stacks[0])
+    chunks = [range(i, min(i + chunksize, fov_count)) for i in
+              range(0, fov_count, chunksize)]
+    descriptors = [stack.descriptor() for stack in stacks]
+    out_descriptor = None if out is None else out.descriptor()
+    if processes == 1:
+        _worker_stacks.update({stack.descriptor(): stack for stack in
+                               stacks})
+        if out is not None:
+            _worker_stacks[out_descriptor] = out
+        try:
+            chunk_results = [_run_fovs(func, descriptors, out_descriptor,
+                                       chunk, args, kwargs)
+                             for chunk in chunks]
+        finally:
+            _worker_stacks.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_run_fovs, func, descriptors,
+                                       out_descriptor, chunk, args, kwargs)
+                       for chunk in chunks]
+            chunk_results = [future.result() for future in futures]
+    results = []
+    fov_seconds = np.zeros(fov_count)
+    workers = {}
+    for chunk, (chunk_result, pid, seconds) in zip(chunks, chunk_results):
+        results.extend(chunk_result)
+        fov_seconds[chunk.start:chunk.stop] = seconds
+        worker = workers.setdefault(pid, {'fovs': 0, 'seconds': 0.})
+        worker['fovs'] = worker['fovs'] + len(chunk)
+        worker['seconds'] = worker['seconds'] + sum(seconds)
+    if return_timings:
+        timings = {'wall': time.perf_counter() - start,
+                   'fov_seconds': fov_seconds, 'workers': workers}
+        return results, timings
+    return results
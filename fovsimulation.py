@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic fields of view for benchmarking the image processing pipeline.
+
+Rod shaped cells and beads are placed on a canvas, illuminated by a laser
+from cellularphotobleachingsimulation and imaged through its camera noise
+model, giving uint16 TIRF photobleaching movies together with phase contrast
+and brightfield like images and the ground truth (labels, masks and copy
+numbers) they were made from. Everything is drawn from an explicit
+numpy.random.Generator so a seed reproduces the same experiment.
+
+@author: kuhlmanlab
+"""
+
+import os
+
+import numpy as np
+import scipy.ndimage as ndi
+
+import cellularphotobleachingsimulation as cps
+
+
+def rod_mask(shape, center, length, radius, angle):
+    '''
+    Boolean mask of a rod (a capsule: a line segment of the given length
+    thickened by radius) centered at center = (row, column) and tilted by
+    angle radians from the column axis.
+    '''
+    rows, cols = np.ogrid[0:shape[0], 0:shape[1]]
+    d_row = rows - center[0]
+    d_col = cols - center[1]
+    along = d_col*np.cos(angle) + d_row*np.sin(angle)
+    across = -d_col*np.sin(angle) + d_row*np.cos(angle)
+    along = np.clip(np.abs(along) - length/2, 0, None)
+    return along**2 + across**2 <= radius**2
+
+
+def place_rods(shape, count, length_range=(10, 30), radius_range=(4, 6),
+               spacing=3, rng=None, max_tries=50, occupied=None):
+    '''
+    Label image of up to count non-overlapping rods placed at random, at
+    least spacing pixels apart from each other and from occupied (a boolean
+    mask of pixels already taken). Rods that can't be placed after max_tries
+    attempts are dropped.
+    '''
+    rng = cps.random_source(rng)
+    label = np.zeros(shape, dtype=np.int32)
+    if occupied is None:
+        taken = np.zeros(shape, dtype=bool)
+    else:
+        taken = ndi.binary_dilation(occupied, iterations=spacing)
+    next_label = 1
+    for i in range(count):
+        for attempt in range(max_tries):
+            length = rng.uniform(*length_range)
+            radius = rng.uniform(*radius_range)
+            reach = int(np.ceil(length/2 + radius)) + 1
+            if 2*reach >= min(shape):
+                break
+            center = (rng.uniform(reach, shape[0] - reach),
+                      rng.uniform(reach, shape[1] - reach))
+            # draw the rod only in its bounding box
+            top = int(center[0]) - reach
+            left = int(center[1]) - reach
+            box = (slice(top, top + 2*reach + 1),
+                   slice(left, left + 2*reach + 1))
+            rod = rod_mask((2*reach + 1, 2*reach + 1),
+                           (center[0] - top, center[1] - left), length,
+                           radius, rng.uniform(0, np.pi))
+            if np.any(taken[box] & rod):
+                continue
+            label[box][rod] = next_label
+            taken[box] |= ndi.binary_dilation(rod, iterations=spacing)
+            next_label = next_label + 1
+            break
+    return label
+
+
+def place_beads(shape, count, radius=12, spacing=5, rng=None,
+                occupied=None):
+    '''
+    Label image of up to count round beads, placed like place_rods.
+    '''
+    return place_rods(shape, count, (0, 0), (radius, radius), spacing, rng,
+                      occupied=occupied)
+
+
+def phase_contrast_image(label, beads, background=1000, cell_contrast=.5,
+                         halo=.15, noise=.02, rng=None):
+    '''
+    A phase contrast like image: cells dark with a faint bright halo and
+    beads bright, on an even background with gaussian noise.
+    '''
+    rng = cps.random_source(rng)
+    cells = label > 0
+    image = np.ones(label.shape)
+    ring = ndi.binary_dilation(cells, iterations=2) & ~cells
+    image[ring] = 1 + halo
+    image[cells] = 1 - cell_contrast
+    image[beads > 0] = 1.5
+    image = ndi.gaussian_filter(image, 1)
+    image = background*(image + noise*rng.standard_normal(image.shape))
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def brightfield_image(beads, background=1000, ring_contrast=.5, noise=.02,
+                      rng=None):
+    '''
+    A brightfield like image of beads: a dark ring around each bead on an
+    even background, which is what segmentation.findBeadsBF looks for.
+    '''
+    rng = cps.random_source(rng)
+    bead_mask = beads > 0
+    ring = ndi.binary_dilation(bead_mask, iterations=3) & \
+        ~ndi.binary_erosion(bead_mask, iterations=1)
+    image = np.ones(beads.shape)
+    image[ring] = 1 - ring_contrast
+    image = ndi.gaussian_filter(image, 1)
+    image = background*(image + noise*rng.standard_normal(image.shape))
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def render_fov(shape, laser, camera, frame_count, cell_count=50,
+               bead_count=0, copy_number_mean=100, brightness=1000.,
+               bleaching_rate=.5, autofluorescence=.5, pad_fluorescence=.2,
+               bead_brightness=50., z=0, out=None, rng=None):
+    '''
+    Render one synthetic field of view.
+
+    Parameters
+    ----------
+    shape : (rows, columns)
+        Size of the frame in pixels. Pixel (row, column) sits at laser
+        coordinates x = column, y = row.
+    laser, camera : cellularphotobleachingsimulation laser and camera
+        The illumination field and the camera noise model. Each frame is an
+        exposure of camera.exposure_time.
+    frame_count : integer
+        Number of TIRF frames.
+    cell_count, bead_count : integer
+        How many cells and beads to try to place.
+    copy_number_mean : number
+        Mean of the Poisson distribution of fluorescent proteins per cell.
+    brightness, bleaching_rate : number
+        Photons and bleaching events per time per intensity of each protein.
+    autofluorescence, pad_fluorescence, bead_brightness : number
+        Photons per time per intensity per pixel of cells, of the pad, and of
+        beads (which don't bleach).
+    z : number or function
+        Height of the slide, as in laser.intensity_plane.
+    out : ndarray, optional
+        (frame_count, rows, columns) uint16 array (e.g. a memmap) to render
+        the TIRF movie into.
+    rng : numpy.random.Generator
+
+    Returns
+    -------
+    fov : dict
+        'tirf' the uint16 TIRF movie, 'phase' and 'brightfield' uint16
+        images, 'labels' the cell label image, 'mask' the cell mask,
+        'bead_labels' the bead label image, and 'copy_numbers' the number of
+        proteins in each cell (entry i for label i+1).
+    '''
+    rng = cps.random_source(rng)
+    beads = place_beads(shape, bead_count, rng=rng)
+    label = place_rods(shape, cell_count, rng=rng, occupied=beads > 0)
+    cell_total = int(label.max())
+    copy_numbers = rng.poisson(copy_number_mean, cell_total)
+    illumination = laser.intensity_plane(0, shape[1], 0, shape[0], z)
+    duration = camera.exposure_time
+    # each cell bleaches at the mean illumination over its pixels
+    index = np.arange(1, cell_total + 1)
+    area = ndi.sum_labels(np.ones(shape), label, index)
+    cell_intensity = ndi.mean(illumination, label, index)
+    emission_time = cps.protein_emission_times(cell_intensity, copy_numbers,
+                                               bleaching_rate, duration,
+                                               frame_count, rng=rng)
+    # photons per pixel that don't change from frame to frame
+    steady = illumination*duration*np.where(label > 0, autofluorescence,
+                                            pad_fluorescence)
+    steady = steady + illumination*duration*bead_brightness*(beads > 0)
+    lookup = np.zeros(cell_total + 1)
+    if out is None:
+        out = np.empty((frame_count,) + tuple(shape), dtype=np.uint16)
+    for frame in range(frame_count):
+        # spreading the cell's expected photons evenly over its pixels and
+        # drawing per pixel gives a Poisson total with the right mean
+        lookup[1:] = brightness*emission_time[:, frame]*cell_intensity/area
+        expected = steady + lookup[label]
+        photons = rng.binomial(rng.poisson(expected), camera.efficiency)
+        signal = camera.signal_per_photon*photons + \
+            rng.poisson(camera.circuit_noise, expected.shape)
+        out[frame] = np.minimum(np.minimum(camera.saturation_level, signal),
+                                65535)
+    return {'tirf': out,
+            'phase': phase_contrast_image(label, beads, rng=rng),
+            'brightfield': brightfield_image(beads, rng=rng),
+            'labels': label, 'mask': label > 0, 'bead_labels': beads,
+            'copy_numbers': copy_numbers}
+
+
+def write_fov(fov, directory, index):
+    '''
+    Save a rendered field of view as fov###_tirf.tif (the movie),
+    fov###_phase.tif and fov###_brightfield.tif, plus the ground truth in
+    fov###_truth.npz.
+    '''
+    import tifffile
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.join(directory, 'fov{:03d}_'.format(index))
+    tifffile.imwrite(name + 'tirf.tif', np.asarray(fov['tirf']))
+    tifffile.imwrite(name + 'phase.tif', fov['phase'])
+    tifffile.imwrite(name + 'brightfield.tif', fov['brightfield'])
+    np.savez_compressed(name + 'truth.npz', labels=fov['labels'],
+                        bead_labels=fov['bead_labels'],
+                        copy_numbers=fov['copy_numbers'])
+
+
+def render_experiment(fov_count, shape, laser, camera, frame_count, seed=0,
+                      directory=None, **kwargs):
+    '''
+    Render fov_count fields of view, each from its own random stream spawned
+    from seed, so any one FOV can be regenerated alone. With a directory the
+    FOVs are written there with write_fov as they are made and nothing is
+    kept in memory; otherwise a list of render_fov dicts is returned.
+    Remaining keyword arguments are passed on to render_fov.
+    '''
+    fovs = []
+    generators = cps.spawn_generators(seed, fov_count)
+    for index, rng in enumerate(generators):
+        fov = render_fov(shape, laser, camera, frame_count, rng=rng,
+                         **kwargs)
+        if directory is None:
+            fovs.append(fov)
+        else:
+            write_fov(fov, directory, index)
+    return fovs
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazy, cached access to sequences of images for the inspection widgets.
+
+Scrubbing through an ImageCollection with a slider decodes the tiff again on
+every move. cachedFrames sits in front of any sequence of images (an
+ImageCollection, a list of masks, a list of normalized images, ...), keeps
+the most recently used frames up to a fixed number of bytes, and loads the
+neighbors of the last frame asked for on background threads so the next
+slider step is usually already in memory. The background loads of every
+cachedFrames run on one shared pool of threads, so opening more widgets
+doesn't leave more idle threads behind.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# threads of the pool shared by every cachedFrames for prefetching
+SHARED_WORKERS = 2
+
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+def sharedExecutor():
+    '''
+    The thread pool the cachedFrames prefetch on, started on first use.
+    '''
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(
+                max_workers=SHARED_WORKERS,
+                thread_name_prefix='framecache')
+        return _shared_executor
+
+
+class cachedFrames(object):
+    '''
+    A read only sequence of frames backed by another sequence of images.
+
+    Parameters
+    ----------
+    frames : sequence of ndarray
+        Anything with len() and integer indexing that returns images.
+    max_bytes : integer
+        The most memory the cached frames may use. Least recently used frames
+        are dropped first. A single frame larger than this is returned but
+        not kept.
+    prefetch : integer
+        How many frames on either side of the last one requested to load in
+        the background. 0 turns prefetching off.
+    workers : integer or None
+        Number of background loading threads. None uses the pool shared by
+        all cachedFrames (see sharedExecutor); a number starts a pool for
+        this sequence only, which close() shuts down.
+    downsample : integer
+        Keep only every downsample-th row and column of each frame, for fast
+        previews of large images. 1 keeps the full frames.
+    concurrent_reads : bool
+        Whether frames may be indexed from several threads at once.
+        ImageCollection is not safe for that (it reuses an internal slot when
+        conserving memory), so by default reads of the underlying sequence
+        are serialized and only the caching and downsampling overlap.
+    '''
+
+    def __init__(self, frames, max_bytes=2**28, prefetch=1, workers=None,
+                 downsample=1, concurrent_reads=False):
+        self.frames = frames
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self.downsample = downsample
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.pending = {}
+        self.shapes = {}
+        self.lock = threading.Lock()
+        if concurrent_reads:
+            self.read_lock = None
+        else:
+            self.read_lock = threading.Lock()
+        self.own_executor = prefetch > 0 and workers is not None
+        if self.own_executor:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        elif prefetch > 0:
+            self.executor = sharedExecutor()
+        else:
+            self.executor = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = self._checkIndex(index)
+        frame = self._get(index)
+        self._prefetchAround(index)
+        return frame
+
+    def _checkIndex(self, index):
+        size = len(self)
+        index = int(index)
+        if index < 0:
+            index = index + size
+        if index < 0 or index >= size:
+            raise IndexError('frame index out of range')
+        return index
+
+    def _load(self, index):
+        '''
+        Read one frame from the underlying sequence and downsample it.
+        '''
+        if self.read_lock is None:
+            frame = np.asarray(self.frames[index])
+        else:
+            with self.read_lock:
+                frame = np.asarray(self.frames[index])
+        self.shapes[index] = frame.shape
+        if self.downsample > 1:
+            # copy so the full size frame isn't kept alive by the view
+            frame = np.ascontiguousarray(frame[::self.downsample,
+                                               ::self.downsample])
+        return frame
+
+    def _store(self, index, frame):
+        '''
+        Put a frame in the cache and drop old frames to stay under max_bytes.
+        '''
+        if frame.nbytes > self.max_bytes:
+            return
+        if index in self.cache:
+            return
+        self.cache[index] = frame
+        self.cached_bytes = self.cached_bytes + frame.nbytes
+        while self.cached_bytes > self.max_bytes:
+            old_index, old_frame = self.cache.popitem(last=False)
+            self.cached_bytes = self.cached_bytes - old_frame.nbytes
+
+    def _get(self, index):
+        with self.lock:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return self.cache[index]
+            future = self.pending.get(index)
+        if future is not None:
+            return future.result()
+        frame = self._load(index)
+        with self.lock:
+            self._store(index, frame)
+        return frame
+
+    def _background(self, index):
+        try:
+            frame = self._load(index)
+            with self.lock:
+                self._store(index, frame)
+        finally:
+            with self.lock:
+                self.pending.pop(index, None)
+        return frame
+
+    def _prefetchAround(self, index):
+        if self.executor is None:
+            return
+        size = len(self)
+        neighbors = []
+        for step in range(1, self.prefetch + 1):
+            neighbors.extend([index + step, index - step])
+        with self.lock:
+            for neighbor in neighbors:
+                if (0 <= neighbor < size and neighbor not in self.cache and
+                        neighbor not in self.pending):
+                    self.pending[neighbor] = \
+                        self.executor.submit(self._background, neighbor)
+
+    def fullShape(self, index):
+        '''
+        The shape of frame index before downsampling, remembered from when it
+        was loaded so it doesn't have to be decoded again.
+        '''
+        index = self._checkIndex(index)
+        if index not in self.shapes:
+            self._get(index)
+        return self.shapes[index]
+
+    def clear(self):
+        '''
+        Drop every cached frame.
+        '''
+        with self.lock:
+            self.cache.clear()
+            self.cached_bytes = 0
+
+    def close(self):
+        '''
+        Stop prefetching and drop the cache. Loads not yet started are
+        cancelled, and a pool of this sequence's own is shut down.
+        '''
+        with self.lock:
+            for index, future in list(self.pending.items()):
+                if future.cancel():
+                    del self.pending[index]
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
+        self.executor = None
+        self.clear()
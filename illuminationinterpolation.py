@@ -71,12 +71,13 @@ def createGaussianDistFunc(points, values, sigma):
                                   partial(gaussianWeight, sigma=sigma))
 
 
-def evaluateDistsBox(xmax, ymax, dist_func):
+def evaluateDistsBox(xmax, ymax, dist_func, dtype=np.float64):
     """
     Evaluates a distance function on a grid of points from 0 to xmax-1 in the
-    x-direction and 0 to y-max-1 in the y-direction.
+    x-direction and 0 to y-max-1 in the y-direction. The map is stored as
+    dtype, float32 halves its size for illumination correction of big stacks.
     """
-    answer = np.zeros((xmax, ymax))
+    answer = np.zeros((xmax, ymax), dtype=dtype)
     for i in range(xmax):
         for j in range(ymax):
             answer[i, j] = dist_func(np.array([i, j]))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deferred imports for the heavy or optional dependencies.
+
+OpenCV, matplotlib, ipywidgets and IPython take seconds to import and need a
+display or a notebook to be useful, but most of the analysis functions never
+touch them. lazy_import returns a stand in for a module that imports the real
+one the first time one of its attributes is used, so batch jobs that only run
+the compute functions never load them (or need them installed).
+
+    cv2 = lazy_import('cv2')
+    ...
+    cv2.fastNlMeansDenoising(...)  # OpenCV is imported here
+
+@author: kuhlmanlab
+"""
+
+import importlib
+import sys
+
+
+class lazyModule(object):
+    '''
+    Stand in for the module called name, imported on first attribute access.
+    '''
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            name = self.__dict__['_lazy_name']
+            try:
+                module = importlib.import_module(name)
+            except ImportError as error:
+                raise ImportError('{} is needed for this function but could '
+                                  'not be imported: {}'.format(name, error))
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '{}' (not loaded)>".format(
+                self.__dict__['_lazy_name'])
+        return repr(self.__dict__['_lazy_module'])
+
+
+def lazy_import(name):
+    '''
+    The module called name if it's already imported, otherwise a lazyModule
+    that imports it when first used.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return lazyModule(name)
+
+
+def is_loaded(module):
+    '''
+    Whether a module from lazy_import has actually been imported.
+    '''
+    if isinstance(module, lazyModule):
+        return module.__dict__['_lazy_module'] is not None
+    return True
@@ -5,10 +5,6 @@ Spyder Editor
 This is a temporary script file.
 """
 
-from cv2 import fastNlMeansDenoising as nlMnsDns
-import ipywidgets as ipyw
-import matplotlib.pyplot as plt
-import matplotlib.cm as colormap
 import numpy as np
 # import skimage.transform as sktr
 import skimage.restoration as skre
@@ -25,7 +21,15 @@ import scipy.signal as spsig
 from functools import partial
 from skimage import img_as_ubyte
 
+import edtmorphology as edtm
 import illuminationinterpolation as illint
+from lazyimports import lazy_import
+
+# OpenCV and the notebook plotting libraries load on first use
+cv2 = lazy_import('cv2')
+ipyw = lazy_import('ipywidgets')
+plt = lazy_import('matplotlib.pyplot')
+colormap = lazy_import('matplotlib.cm')
 
 
 def showImages(images, figsize):
@@ -120,7 +124,7 @@ def adjustAlignment(image_list, mask_list, trans):
     def applyTransform(index, dil_size, scale, theta, delta_x, delta_y):
         changeTransform(trans, scale, theta, delta_x, delta_y)
         warp_mask = warpIm2Im(mask_list[index], image_list[index], trans)
-        warp_mask = skmo.binary_dilation(warp_mask, selem=skmo.disk(dil_size))
+        warp_mask = edtm.dilate(warp_mask, dil_size)
         fig = plt.figure(figsize=(24, 16))
         img_view = fig.add_subplot(1, 2, 1)
         align_view = fig.add_subplot(1, 2, 2)
@@ -203,7 +207,9 @@ def normAndDenoisePc(im_col, method='opencv'):
     if method == 'opencv':
         im_col_n_ub = [img_as_ubyte(image/np.max(image)) for image in
                        im_col_norm]
-        im_col_dn = [nlMnsDns(image, None, np.uint8(.95*np.std(image)), 7, 11)
+        im_col_dn = [cv2.fastNlMeansDenoising(image, None,
+                                              np.uint8(.95*np.std(image)), 7,
+                                              11)
                      for image in im_col_n_ub]
     elif method == 'skimage':
         im_col_dn = [skre.denoise_nl_means(image, h=.95*np.std(image))
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless runner for the analysis the example notebooks do by hand.
+
+The chain of notebook cells (bead backgrounds, bead masks, camera alignment,
+illumination correction from the beads, phase contrast normalization, cell
+masks, warping the cell labels onto the TIRF images and measuring them) is
+written out as named stages. Each stage's output is cached on disk under a
+key made from its parameters, its input files, its code (including the
+modules of this folder it uses, so editing segmentation.py reruns the stages
+that call it) and the keys of the stages it uses, so running again only
+redoes the stages whose inputs changed.
+
+From python:
+
+    runner = pipeline('/path/to/experiment')
+    table = runner.run()
+
+or from the command line:
+
+    python pipeline.py /path/to/experiment --out cells.csv
+
+The experiment folder holds a beads and a cells folder by default (see
+DEFAULT_CONFIG); a pipeline.json file in it, or a config passed in, overrides
+any of the defaults.
+
+@author: kuhlmanlab
+"""
+
+import argparse
+import ast
+import copy
+import csv
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import textwrap
+
+import numpy as np
+
+# where the analysis modules are, whose sources go in the stage keys
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CONFIG = {
+    # working type of the illumination corrected images, float32 halves the
+    # memory of every corrected stack
+    'dtype': 'float64',
+    'beads': {'brightfield': 'beads/*c1*c1.tif',
+              'phase': 'beads/*c2*c1.tif',
+              'tirf': 'beads/*c1*c2.tif'},
+    'cells': {'phase': 'cells/*c2*c1.tif',
+              'tirf': 'cells/*c1*c2.tif'},
+    'stages': {
+        'bead_background': {'sigma': 40},
+        'bead_masks': {'bins': 256, 'comparison_width': 5,
+                       'threshold_factor': .9, 'n_mad': 10,
+                       'phase_threshold': 240, 'phase_min_size': 1000},
+        'camera_transform': {'params': None, 'max_distance': 20},
+        'illumination': {'sigma': 40},
+        'cell_normalization': {},
+        'cell_masks': {'comparison_width': 5, 'min_size': 300, 'blank': []},
+        'cell_labels': {},
+        'cell_table': {},
+    },
+}
+
+
+def _load_images(pattern):
+    import skimage.io as skio
+    return [skio.imread(name) for name in sorted(glob.glob(pattern))]
+
+
+def _image_shape(pattern):
+    import skimage.io as skio
+    return np.shape(skio.imread(sorted(glob.glob(pattern))[0]))
+
+
+def _bead_background(files, upstream, params):
+    import segmentation as mseg
+    bf = _load_images(files['beads/brightfield'])
+    pc = _load_images(files['beads/phase'])
+    dtype = params['dtype']
+    bf_bg = mseg.findMedianBg(bf, params['sigma'], dtype)
+    pc_bg = mseg.findMedianBg(pc, params['sigma'], dtype)
+    return {'brightfield': [mseg.correctIllumination(image, bf_bg, dtype)
+                            for image in bf],
+            'phase': [mseg.correctIllumination(image, pc_bg, dtype)
+                      for image in pc]}
+
+
+def _bead_masks(files, upstream, params):
+    import skimage.morphology as skmo
+    import segmentation as mseg
+    bf = upstream['bead_background']['brightfield']
+    pc = upstream['bead_background']['phase']
+    thresholds = [mseg.localMinLeftOfGlobalMax(image, params['bins'],
+                                               params['comparison_width'])
+                  for image in bf]
+    threshold = params['threshold_factor']*np.max(thresholds)
+    bf_masks = [mseg.findBeadsBF(image, threshold) for image in bf]
+    bf_masks = mseg.removeNonCirles(bf_masks, params['n_mad'])
+    pc_masks = [image > params['phase_threshold'] for image in pc]
+    pc_masks = [skmo.remove_small_holes(mask, params['phase_min_size'])
+                for mask in pc_masks]
+    pc_masks = [skmo.remove_small_objects(mask,
+                                          min_size=params['phase_min_size'])
+                for mask in pc_masks]
+    return {'brightfield': bf_masks, 'phase': pc_masks}
+
+
+def matchCenters(centers1, centers2, max_distance):
+    '''
+    Pair up points in two lists that are each other's nearest neighbor and
+    closer than max_distance. Returns the paired points of each list.
+    '''
+    from scipy.spatial import cKDTree
+    if len(centers1) == 0 or len(centers2) == 0:
+        return np.zeros((0, 2)), np.zeros((0, 2))
+    distance12, nearest12 = cKDTree(centers2).query(centers1)
+    distance21, nearest21 = cKDTree(centers1).query(centers2)
+    mutual = (nearest21[nearest12] == np.arange(len(centers1))) & \
+        (distance12 <= max_distance)
+    return centers1[mutual], centers2[nearest12[mutual]]
+
+
+def _camera_transform(files, upstream, params):
+    import skimage.transform as sktr
+    import segmentation as mseg
+    transform = sktr.SimilarityTransform()
+    if params['params'] is not None:
+        # a hand tuned alignment, e.g. from visualization.adjustAlignment
+        transform.params = np.array(params['params'], dtype=float)
+        return {'transform': transform}
+    masks = upstream['bead_masks']
+    pairs = [matchCenters(mseg.findRegionCenters(bf_mask),
+                          mseg.findRegionCenters(pc_mask),
+                          params['max_distance'])
+             for bf_mask, pc_mask in zip(masks['brightfield'],
+                                         masks['phase'])]
+    bf_centers = np.concatenate([pair[0] for pair in pairs])
+    pc_centers = np.concatenate([pair[1] for pair in pairs])
+    if len(bf_centers) < 2:
+        raise RuntimeError('not enough matching beads to align the cameras')
+    transform.estimate(bf_centers, pc_centers)
+    return {'transform': transform}
+
+
+def correct_tirf(image, zero_signal, illumination, dtype):
+    '''
+    Subtract the camera offset from a TIRF image, clip at 0 and divide by the
+    illumination, in dtype.
+    '''
+    corrected = np.subtract(image, zero_signal, dtype=dtype)
+    np.clip(corrected, 0, None, out=corrected)
+    return np.divide(corrected, illumination, out=corrected)
+
+
+def _illumination(files, upstream, params):
+    import skimage.measure as skme
+    import illuminationinterpolation as illint
+    import segmentation as mseg
+    tirf = _load_images(files['beads/tirf'])
+    labels = [skme.label(mask) for mask in
+              upstream['bead_masks']['brightfield']]
+    zero_signal = np.median([np.min(image) for image in tirf])
+    rprops = [skme.regionprops(label, image) for label, image in
+              zip(labels, tirf)]
+    beads = mseg.properties2list(rprops, ['mean_intensity', 'centroid'])
+    dist_func = illint.createGaussianDistFunc(beads['centroid'],
+                                              beads['mean_intensity'] -
+                                              zero_signal, params['sigma'])
+    shape = np.shape(tirf[0])
+    illumination = illint.evaluateDistsBox(shape[0], shape[1], dist_func,
+                                           params['dtype'])
+    illumination = illumination / np.mean(illumination)
+    normalized = [correct_tirf(image, zero_signal, illumination,
+                                params['dtype']) for image in tirf]
+    rprops = [skme.regionprops(label, image) for label, image in
+              zip(labels, normalized)]
+    bead_intensities = mseg.properties2list(rprops,
+                                            ['mean_intensity'])
+    return {'illumination': illumination, 'zero_signal': zero_signal,
+            'bead_mean': np.mean(bead_intensities['mean_intensity'])}
+
+
+def _cell_normalization(files, upstream, params):
+    import segmentation as mseg
+    return {'phase': mseg.normAndDenoisePc(_load_images(files['cells/phase']),
+                                           params['dtype'])}
+
+
+def _cell_masks(files, upstream, params):
+    import segmentation as mseg
+    masks = [mseg.thresholdMask(image,
+                                comparison_width=params['comparison_width'],
+                                min_size=params['min_size'])
+             for image in upstream['cell_normalization']['phase']]
+    for index in params['blank']:
+        masks[index] = np.zeros_like(masks[index])
+    return {'masks': masks}
+
+
+def _cell_labels(files, upstream, params):
+    import skimage.measure as skme
+    import segmentation as mseg
+    tirf_shape = np.zeros(_image_shape(files['cells/tirf']))
+    transform = upstream['camera_transform']['transform']
+    labels = [mseg.warpIm2Im(skme.label(mask), tirf_shape, transform)
+              for mask in upstream['cell_masks']['masks']]
+    return {'labels': labels}
+
+
+def measure_cells(labels, tirf, correction, dtype='float64'):
+    '''
+    Per-cell table of a list of label images measured on their TIRF images,
+    after correcting those with the output of the illumination stage.
+    '''
+    import skimage.measure as skme
+    import segmentation as mseg
+    tirf = [correct_tirf(image, correction['zero_signal'],
+                         correction['illumination'], dtype)
+            for image in tirf]
+    rprops = [skme.regionprops(label, image) for label, image in
+              zip(labels, tirf)]
+    if sum(len(props) for props in rprops) == 0:
+        table = {'FOV': np.zeros(0, int), 'label': np.zeros(0, int),
+                 'area': np.zeros(0), 'mean_intensity': np.zeros(0),
+                 'centroid': np.zeros((0, 2))}
+    else:
+        table = mseg.properties2list(rprops, ['area', 'mean_intensity',
+                                              'centroid'])
+    table['relative_intensity'] = np.asarray(table['mean_intensity']) / \
+        correction['bead_mean']
+    return table
+
+
+def _cell_table(files, upstream, params):
+    return measure_cells(upstream['cell_labels']['labels'],
+                         _load_images(files['cells/tirf']),
+                         upstream['illumination'], params['dtype'])
+
+
+# name: (function, stages it uses, input files it reads)
+STAGES = {
+    'bead_background': (_bead_background, [],
+                        ['beads/brightfield', 'beads/phase']),
+    'bead_masks': (_bead_masks, ['bead_background'], []),
+    'camera_transform': (_camera_transform, ['bead_masks'], []),
+    'illumination': (_illumination, ['bead_masks'], ['beads/tirf']),
+    'cell_normalization': (_cell_normalization, [], ['cells/phase']),
+    'cell_masks': (_cell_masks, ['cell_normalization'], []),
+    'cell_labels': (_cell_labels, ['cell_masks', 'camera_transform'],
+                    ['cells/tirf']),
+    'cell_table': (_cell_table, ['cell_labels', 'illumination'],
+                   ['cells/tirf']),
+}
+
+
+def _imported_modules(tree):
+    '''
+    Top level names of the modules imported (or lazy_import-ed) in a syntax
+    tree.
+    '''
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names.add(node.module.split('.')[0])
+        elif (isinstance(node, ast.Call) and
+              getattr(node.func, 'id', None) == 'lazy_import' and
+              node.args and isinstance(node.args[0], ast.Constant)):
+            names.add(str(node.args[0].value).split('.')[0])
+    return names
+
+
+def code_sources(function):
+    '''
+    The source of a stage function, of the functions of this module it calls
+    and of every module in MODULE_DIR that these import, directly or through
+    each other, by name. Editing any of them changes the stage's key.
+    '''
+    sources = {}
+    modules = set()
+    functions = [function]
+    while functions:
+        function = functions.pop()
+        if function.__name__ in sources:
+            continue
+        source = inspect.getsource(function)
+        sources[function.__name__] = source
+        tree = ast.parse(textwrap.dedent(source))
+        modules |= _imported_modules(tree)
+        functions.extend(globals()[node.id] for node in ast.walk(tree) if
+                         isinstance(node, ast.Name) and
+                         inspect.isfunction(globals().get(node.id)))
+    modules = list(modules)
+    while modules:
+        name = modules.pop()
+        path = os.path.join(MODULE_DIR, name + '.py')
+        if name + '.py' in sources or not os.path.exists(path):
+            continue
+        with open(path) as file:
+            sources[name + '.py'] = file.read()
+        modules.extend(_imported_modules(ast.parse(sources[name + '.py'])))
+    return sources
+
+
+def _merge(defaults, overrides):
+    merged = copy.deepcopy(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class pipeline(object):
+    '''
+    Runs the STAGES on one experiment folder with on disk caching.
+
+    config overrides DEFAULT_CONFIG and a pipeline.json in the experiment
+    folder. Cached stage outputs go in cache_dir, .pipeline_cache in the
+    experiment folder by default. A stage reruns when its parameters, the
+    size or modification time of any of its input files, its code (see
+    code_sources), or any stage it uses changes, or when it or a stage it
+    depends on is forced.
+    '''
+
+    def __init__(self, experiment_dir, config=None, cache_dir=None,
+                 verbose=False):
+        self.experiment_dir = experiment_dir
+        self.config = DEFAULT_CONFIG
+        config_file = os.path.join(experiment_dir, 'pipeline.json')
+        if os.path.exists(config_file):
+            with open(config_file) as file:
+                self.config = _merge(self.config, json.load(file))
+        if config is not None:
+            self.config = _merge(self.config, config)
+        if cache_dir is None:
+            cache_dir = os.path.join(experiment_dir, '.pipeline_cache')
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.results = {}
+        self.keys = {}
+        # stages computed in the current run, so forced ones run only once
+        self.fresh = set()
+
+    def files(self, name):
+        '''
+        The glob patterns, relative to the experiment folder, of the input
+        files a stage reads, by 'group/channel'.
+        '''
+        patterns = {}
+        for file_id in STAGES[name][2]:
+            group, channel = file_id.split('/')
+            patterns[file_id] = os.path.join(self.experiment_dir,
+                                             self.config[group][channel])
+        return patterns
+
+    def params(self, name):
+        '''
+        A stage's parameters, including the working dtype.
+        '''
+        params = dict(self.config['stages'].get(name, {}))
+        params['dtype'] = np.dtype(self.config['dtype']).name
+        return params
+
+    def key(self, name):
+        '''
+        The cache key of a stage.
+        '''
+        if name not in self.keys:
+            function, uses, file_ids = STAGES[name]
+            signature = {'stage': name,
+                         'code': code_sources(function),
+                         'params': self.params(name),
+                         'uses': [self.key(use) for use in uses],
+                         'files': {}}
+            for file_id, pattern in sorted(self.files(name).items()):
+                signature['files'][file_id] = \
+                    [(os.path.basename(path), os.path.getsize(path),
+                      os.path.getmtime(path))
+                     for path in sorted(glob.glob(pattern))]
+            text = json.dumps(signature, sort_keys=True, default=str)
+            self.keys[name] = hashlib.sha256(text.encode()).hexdigest()
+        return self.keys[name]
+
+    def cache_file(self, name):
+        return os.path.join(self.cache_dir, name, self.key(name) + '.pkl')
+
+    def is_cached(self, name):
+        return os.path.exists(self.cache_file(name))
+
+    def forced(self, name, force):
+        '''
+        Whether a stage has to rerun because it or a stage it depends on is
+        in force: the cache key of a stage doesn't change when a stage it
+        uses is rerun with the same inputs.
+        '''
+        return name in force or any(self.forced(use, force) for use in
+                                    STAGES[name][1])
+
+    def result(self, name, force=()):
+        '''
+        The output of a stage, from the cache if it's valid and otherwise by
+        running it (and whatever it uses that isn't cached).
+        '''
+        forced = self.forced(name, force)
+        if name in self.results and (name in self.fresh or not forced):
+            return self.results[name]
+        cache_file = self.cache_file(name)
+        if not forced and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as file:
+                self.results[name] = pickle.load(file)
+            self._report('{}: cached'.format(name))
+            return self.results[name]
+        function, uses, file_ids = STAGES[name]
+        upstream = {use: self.result(use, force) for use in uses}
+        self._report('{}: running'.format(name))
+        output = function(self.files(name), upstream, self.params(name))
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as file:
+            pickle.dump(output, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+        self.results[name] = output
+        self.fresh.add(name)
+        return output
+
+    def run(self, targets=('cell_table',), force=()):
+        '''
+        Make sure the target stages are up to date and return the output of
+        the last one. Stages named in force, and the stages that depend on
+        them, are rerun even if cached.
+        '''
+        self.fresh = set()
+        for target in targets:
+            output = self.result(target, force)
+        return output
+
+    def status(self):
+        '''
+        Whether each stage has a valid cached output.
+        '''
+        return {name: self.is_cached(name) for name in STAGES}
+
+    def _report(self, message):
+        if self.verbose:
+            print(message, file=sys.stderr)
+
+
+def write_table(table, filename, append=False):
+    '''
+    Write a per-cell table (a dict of equal length columns, as from
+    segmentation.properties2list) to a csv file, splitting columns of pairs
+    like centroid into _row and _col columns. append adds the rows to the end
+    of an existing file, writing the header only if the file is new or empty.
+    '''
+    columns = {}
+    for name, values in table.items():
+        values = np.asarray(values)
+        if values.ndim == 2:
+            columns[name + '_row'] = values[:, 0]
+            columns[name + '_col'] = values[:, 1]
+        else:
+            columns[name] = values
+    names = list(columns)
+    header = not append or not os.path.exists(filename) or \
+        os.path.getsize(filename) == 0
+    with open(filename, 'a' if append else 'w', newline='') as file:
+        writer = csv.writer(file)
+        if header:
+            writer.writerow(names)
+        for row in zip(*[columns[name] for name in names]):
+            writer.writerow(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the microscopy analysis pipeline on an experiment '
+                    'folder, reusing cached stage outputs when valid.')
+    parser.add_argument('experiment_dir')
+    parser.add_argument('--config', help='json file overriding the defaults')
+    parser.add_argument('--cache-dir', help='where to keep stage outputs')
+    parser.add_argument('--stage', action='append', choices=list(STAGES),
+                        help='stage to bring up to date (default '
+                             'cell_table), may be repeated')
+    parser.add_argument('--force', action='append', choices=list(STAGES),
+                        default=[], help='rerun this stage even if cached')
+    parser.add_argument('--status', action='store_true',
+                        help='only show which stages are cached')
+    parser.add_argument('--out', help='csv file for the per-cell table')
+    args = parser.parse_args(argv)
+    config = None
+    if args.config is not None:
+        with open(args.config) as file:
+            config = json.load(file)
+    runner = pipeline(args.experiment_dir, config, args.cache_dir,
+                      verbose=True)
+    if args.status:
+        for name, cached in runner.status().items():
+            print('{:20s} {}'.format(name, 'cached' if cached else 'stale'))
+        return 0
+    output = runner.run(args.stage or ('cell_table',), args.force)
+    if args.out is not None and 'label' in output:
+        write_table(output, args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
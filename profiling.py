@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing and memory instrumentation of the analysis modules.
+
+Nothing here runs unless asked for: enable() swaps the public functions of
+the analysis modules for wrappers that record wall time, call counts, the
+shapes and dtypes of the arguments and the peak memory traced by tracemalloc
+during each call, and disable() puts the original functions back. While
+disabled there is no wrapper at all, so there is no overhead.
+
+    with profiling.profiled() as profile:
+        run_analysis()
+    print(profile.summary())
+    profile.save_json('profile.json')
+
+Calls made between the analysis modules (e.g. removeNonCirles calling
+properties2list) are recorded under their caller, which collapsed_stacks()
+writes out in the one-line-per-stack format flamegraph tools read.
+
+@author: kuhlmanlab
+"""
+
+import functools
+import importlib
+import inspect
+import json
+import threading
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+DEFAULT_MODULES = ['segmentation', 'illuminationinterpolation',
+                   'spotfinding_prototype', 'fluorophorecopynumberinference']
+
+# different argument signatures remembered per function
+MAX_SIGNATURES = 20
+
+
+def describe(value):
+    '''
+    Short description of an argument's type, shape and dtype.
+    '''
+    if isinstance(value, np.ndarray):
+        return '{}[{}]'.format(value.dtype,
+                               'x'.join(str(n) for n in value.shape))
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return type(value).__name__ + '[0]'
+        return '{}[{}]*{}'.format(type(value).__name__, len(value),
+                                  describe(value[0]))
+    return type(value).__name__
+
+
+class callStats(object):
+    '''
+    Aggregated measurements of one function or one call stack.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+        self.self_seconds = 0.
+        self.peak_bytes = 0
+        self.signatures = {}
+
+    def add(self, seconds, self_seconds, peak_bytes, signature=None):
+        self.calls = self.calls + 1
+        self.seconds = self.seconds + seconds
+        self.self_seconds = self.self_seconds + self_seconds
+        self.peak_bytes = max(self.peak_bytes, peak_bytes)
+        if signature is not None:
+            if (signature in self.signatures or
+                    len(self.signatures) < MAX_SIGNATURES):
+                self.signatures[signature] = \
+                    self.signatures.get(signature, 0) + 1
+
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds,
+                'self_seconds': self.self_seconds,
+                'peak_bytes': self.peak_bytes,
+                'signatures': self.signatures}
+
+
+class _frame(object):
+
+    def __init__(self, name, start_bytes, peak_bytes):
+        self.name = name
+        self.start_bytes = start_bytes
+        self.peak_bytes = peak_bytes
+        self.child_seconds = 0.
+
+
+class profile(object):
+    '''
+    Collects the measurements from the wrapped functions.
+
+    memory turns tracemalloc on while enabled. Tracing allocations slows
+    numpy-heavy code down noticeably, so turn it off for timing only runs.
+    '''
+
+    def __init__(self, modules=DEFAULT_MODULES, memory=True):
+        self.modules = modules
+        self.memory = memory
+        self.functions = {}
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.originals = []
+        self.started_tracemalloc = False
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _memory(self):
+        if self.memory and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()
+        return 0, 0
+
+    def wrap(self, name, function):
+        '''
+        Return function wrapped to record its calls under name.
+        '''
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stack = self._stack()
+            current, peak = self._memory()
+            if stack:
+                stack[-1].peak_bytes = max(stack[-1].peak_bytes, peak)
+            if self.memory and tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            frame = _frame(name, current, current)
+            stack.append(frame)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                current, peak = self._memory()
+                frame.peak_bytes = max(frame.peak_bytes, peak)
+                stack.pop()
+                if stack:
+                    stack[-1].child_seconds = \
+                        stack[-1].child_seconds + seconds
+                    stack[-1].peak_bytes = max(stack[-1].peak_bytes,
+                                               frame.peak_bytes)
+                path = ';'.join([outer.name for outer in stack] + [name])
+                signature = ', '.join([describe(arg) for arg in args] +
+                                      ['{}={}'.format(key, describe(value))
+                                       for key, value in kwargs.items()])
+                self_seconds = seconds - frame.child_seconds
+                peak_bytes = frame.peak_bytes - frame.start_bytes
+                with self.lock:
+                    self.functions.setdefault(name, callStats()).add(
+                        seconds, self_seconds, peak_bytes, signature)
+                    self.stacks.setdefault(path, callStats()).add(
+                        seconds, self_seconds, peak_bytes)
+        wrapper.__profiled__ = function
+        return wrapper
+
+    def enable(self):
+        '''
+        Wrap the public functions of the modules. Modules that can't be
+        imported (missing optional dependencies) are skipped with a warning.
+        '''
+        if self.originals:
+            return
+        for module_name in self.modules:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError as error:
+                warnings.warn('not profiling {}: {}'.format(module_name,
+                                                            error))
+                continue
+            for name, function in inspect.getmembers(module,
+                                                     inspect.isfunction):
+                if (name.startswith('_') or
+                        function.__module__ != module.__name__ or
+                        hasattr(function, '__profiled__')):
+                    continue
+                self.originals.append((module, name, function))
+                setattr(module, name,
+                        self.wrap(module_name + '.' + name, function))
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def disable(self):
+        '''
+        Put the original functions back.
+        '''
+        for module, name, function in self.originals:
+            setattr(module, name, function)
+        self.originals = []
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def report(self):
+        '''
+        The measurements as a dict of plain python types.
+        '''
+        with self.lock:
+            return {'functions': {name: stats.as_dict() for name, stats in
+                                  self.functions.items()},
+                    'stacks': {path: stats.as_dict() for path, stats in
+                               self.stacks.items()}}
+
+    def save_json(self, filename):
+        with open(filename, 'w') as file:
+            json.dump(self.report(), file, indent=1)
+
+    def collapsed_stacks(self):
+        '''
+        One line per call stack, 'outer;inner self_microseconds', the input
+        format of flamegraph.pl and speedscope.
+        '''
+        with self.lock:
+            lines = ['{} {}'.format(path, int(round(stats.self_seconds*1e6)))
+                     for path, stats in sorted(self.stacks.items())]
+        return '\n'.join(lines)
+
+    def summary(self, sort_by='seconds'):
+        '''
+        A text table of the functions, most expensive first.
+        '''
+        with self.lock:
+            rows = sorted(self.functions.items(),
+                          key=lambda item: getattr(item[1], sort_by),
+                          reverse=True)
+            lines = ['{:50s} {:>7s} {:>10s} {:>10s} {:>10s}'.format(
+                'function', 'calls', 'seconds', 'self', 'peak MB')]
+            for name, stats in rows:
+                lines.append('{:50s} {:7d} {:10.3f} {:10.3f} {:10.1f}'.format(
+                    name, stats.calls, stats.seconds, stats.self_seconds,
+                    stats.peak_bytes/2**20))
+        return '\n'.join(lines)
+
+
+def profiled(modules=DEFAULT_MODULES, memory=True):
+    '''
+    A profile to use as a context manager; the functions are wrapped inside
+    the with block only.
+    '''
+    return profile(modules, memory)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Appendable on-disk store for per-cell measurements.
+
+The notebooks keep the per-cell tables from segmentation.properties2list in
+memory and save thresholds and overlays with np.savez, which rewrites the
+whole file every time. A resultStore is a folder with one raw binary file per
+column, which numpy memory maps, and a manifest.json with the dtypes, the
+number of rows and the row range and FOVs of every appended batch. Appending
+a batch only adds to the end of the files, and reading a column, or the rows
+of a few FOVs or labels, only touches those parts of it.
+
+    store = resultStore('results')
+    store.append(mseg.properties2list(rprops, ['area', 'centroid']))
+    ...
+    table = store.read(['label', 'area'], fov=[3, 4])
+
+Arrays that aren't one value per row, like the image crop of each cell or
+the thresholding overlay of each FOV, go in a side file per name: the arrays
+one after another in a data file with an index of where each starts, its
+shape and the key (row or FOV) it belongs to.
+
+    store.append(table, crops={'crop': crops})
+    crops = store.images('crop', store.rows(fov=3))
+    store.add_images('overlay', overlays, keys=fovs)
+
+A crashed append leaves the manifest as it was; the extra bytes it wrote are
+ignored and cut off by the next append.
+
+@author: kuhlmanlab
+"""
+
+import json
+import os
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+# most dimensions of an array in a side file
+MAX_IMAGE_DIMS = 3
+
+
+def _values(values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        raise ValueError('ragged columns like coords can\'t be stored as a '
+                         'column, store them with add_images')
+    return values
+
+
+def _truncate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+
+class resultStore(object):
+    '''
+    A columnar store in directory, created if it doesn't exist.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        manifest_file = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as file:
+                self.manifest = json.load(file)
+        else:
+            os.makedirs(os.path.join(directory, 'columns'), exist_ok=True)
+            os.makedirs(os.path.join(directory, 'images'), exist_ok=True)
+            self.manifest = {'rows': 0, 'columns': {}, 'batches': [],
+                             'images': {}}
+            self._save_manifest()
+
+    def _save_manifest(self):
+        manifest_file = os.path.join(self.directory, MANIFEST)
+        with open(manifest_file + '.tmp', 'w') as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _column_file(self, name):
+        return os.path.join(self.directory, 'columns', name + '.bin')
+
+    def _image_files(self, name):
+        return (os.path.join(self.directory, 'images', name + '.data'),
+                os.path.join(self.directory, 'images', name + '.index'))
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    @property
+    def columns(self):
+        return list(self.manifest['columns'])
+
+    def append(self, table, fov=None, crops=None):
+        '''
+        Add the rows of a per-cell table (a dict of equal length columns, as
+        from segmentation.properties2list, pairs like centroid as 2 column
+        arrays). fov sets the FOV column for a table of a single FOV, which
+        otherwise has to have one. crops is a dict of name: list of arrays,
+        one per row, for the side files. Returns the indices of the new rows.
+        '''
+        columns = {name: _values(values) for name, values in table.items()}
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) != 1:
+            raise ValueError('columns have different lengths')
+        count = lengths.pop()
+        if fov is not None:
+            columns['FOV'] = np.full(count, fov, dtype=int)
+        if 'FOV' not in columns:
+            raise ValueError('table needs a FOV column, or pass fov')
+        stored = self.manifest['columns']
+        if not stored:
+            for name in columns:
+                if os.sep in name or name.startswith('.'):
+                    raise ValueError('bad column name {}'.format(name))
+            stored = {name: {'dtype': values.dtype.str,
+                             'shape': list(values.shape[1:])}
+                      for name, values in columns.items()}
+        elif set(columns) != set(stored):
+            raise ValueError('columns {} don\'t match the store\'s {}'.format(
+                sorted(columns), sorted(stored)))
+        # check everything before writing anything, so a table that doesn't
+        # fit leaves the files as they were
+        for name, info in stored.items():
+            values = columns[name]
+            if list(values.shape[1:]) != info['shape']:
+                raise ValueError('column {} has shape {}, the store has '
+                                 '{}'.format(name, values.shape[1:],
+                                             tuple(info['shape'])))
+            if not np.can_cast(values.dtype, info['dtype'], 'same_kind'):
+                raise TypeError('column {} is {}, which can\'t be stored as '
+                                '{}'.format(name, values.dtype,
+                                            np.dtype(info['dtype'])))
+        crops = {name: [np.asarray(image) for image in images] for name, images
+                 in (crops or {}).items()}
+        for name, images in crops.items():
+            if len(images) != count:
+                raise ValueError('{} has {} arrays for {} rows'.format(
+                    name, len(images), count))
+            self._check_images(name, images)
+        self.manifest['columns'] = stored
+        start = self.manifest['rows']
+        for name, info in stored.items():
+            dtype = np.dtype(info['dtype'])
+            values = columns[name].astype(dtype, copy=False)
+            path = self._column_file(name)
+            _truncate(path, start*dtype.itemsize*int(np.prod(info['shape'])))
+            with open(path, 'ab') as file:
+                np.ascontiguousarray(values).tofile(file)
+        rows = np.arange(start, start + count)
+        for name, images in crops.items():
+            self._add_images(name, images, rows)
+        if count > 0:
+            self.manifest['batches'].append(
+                [start, start + count, int(np.min(columns['FOV'])),
+                 int(np.max(columns['FOV']))])
+        self.manifest['rows'] = start + count
+        self._save_manifest()
+        return rows
+
+    def column(self, name):
+        '''
+        A whole column, memory mapped read only.
+        '''
+        info = self.manifest['columns'][name]
+        dtype = np.dtype(info['dtype'])
+        shape = (self.manifest['rows'],) + tuple(info['shape'])
+        if self.manifest['rows'] == 0:
+            return np.zeros(shape, dtype)
+        return np.memmap(self._column_file(name), dtype, mode='r',
+                         shape=shape)
+
+    def rows(self, fov=None, label=None):
+        '''
+        Indices of the rows in the FOVs and with the labels given (a number
+        or a list of them, None for any). Only the batches that can hold the
+        FOVs are read.
+        '''
+        if fov is None and label is None:
+            return np.arange(self.manifest['rows'])
+        fovs = None if fov is None else np.atleast_1d(fov)
+        labels = None if label is None else np.atleast_1d(label)
+        FOV = self.column('FOV')
+        label_column = None if labels is None else self.column('label')
+        selected = []
+        for start, stop, fov_min, fov_max in self.manifest['batches']:
+            keep = np.ones(stop - start, dtype=bool)
+            if fovs is not None:
+                if not np.any((fovs >= fov_min) & (fovs <= fov_max)):
+                    continue
+                keep &= np.isin(FOV[start:stop], fovs)
+            if labels is not None:
+                keep &= np.isin(label_column[start:stop], labels)
+            selected.append(start + np.flatnonzero(keep))
+        if not selected:
+            return np.zeros(0, dtype=int)
+        return np.concatenate(selected)
+
+    def read(self, columns=None, fov=None, label=None):
+        '''
+        The selected columns (all by default) of the rows in the FOVs and
+        with the labels given, as a dict of arrays like
+        segmentation.properties2list returns.
+        '''
+        if columns is None:
+            columns = self.columns
+        if fov is None and label is None:
+            return {name: np.array(self.column(name)) for name in columns}
+        rows = self.rows(fov, label)
+        return {name: np.asarray(self.column(name)[rows]) for name in
+                columns}
+
+    def _check_images(self, name, images):
+        '''
+        Raise if the arrays can't go in the side file called name.
+        '''
+        info = self.manifest['images'].get(name)
+        if info is None and (os.sep in name or name.startswith('.')):
+            raise ValueError('bad image name {}'.format(name))
+        for image in images:
+            if image.ndim > MAX_IMAGE_DIMS:
+                raise ValueError('arrays can have at most {} '
+                                 'dimensions'.format(MAX_IMAGE_DIMS))
+            if info is not None and not np.can_cast(image.dtype, info['dtype'],
+                                                    'same_kind'):
+                raise TypeError('{} holds {}, {} arrays can\'t be added'.format(
+                    name, np.dtype(info['dtype']), image.dtype))
+
+    def _add_images(self, name, images, keys):
+        data_file, index_file = self._image_files(name)
+        info = self.manifest['images'].get(name)
+        if info is None:
+            dtype = np.result_type(*images) if images else np.dtype(float)
+            info = {'dtype': dtype.str, 'count': 0, 'size': 0}
+        dtype = np.dtype(info['dtype'])
+        _truncate(data_file, info['size']*dtype.itemsize)
+        _truncate(index_file, info['count']*(3 + MAX_IMAGE_DIMS)*8)
+        index = np.zeros((len(images), 3 + MAX_IMAGE_DIMS), dtype=np.int64)
+        offset = info['size']
+        with open(data_file, 'ab') as file:
+            for i, (key, image) in enumerate(zip(keys, images)):
+                index[i, :3] = key, offset, image.ndim
+                index[i, 3:3 + image.ndim] = image.shape
+                np.ascontiguousarray(image.astype(dtype,
+                                                  copy=False)).tofile(file)
+                offset = offset + image.size
+        with open(index_file, 'ab') as file:
+            index.tofile(file)
+        info['count'] = info['count'] + len(images)
+        info['size'] = offset
+        self.manifest['images'][name] = info
+
+    def add_images(self, name, images, keys):
+        '''
+        Add a list of arrays to the side file called name, each under the
+        key (e.g. the FOV of an overlay) given for it.
+        '''
+        if len(images) != len(keys):
+            raise ValueError('need a key for every array')
+        images = [np.asarray(image) for image in images]
+        self._check_images(name, images)
+        self._add_images(name, images, keys)
+        self._save_manifest()
+
+    def images(self, name, keys=None):
+        '''
+        The arrays in a side file, memory mapped read only: all in the order
+        added, or the last added under each of keys.
+        '''
+        info = self.manifest['images'][name]
+        if info['count'] == 0:
+            if keys is not None and len(keys) > 0:
+                raise KeyError(keys[0])
+            return []
+        data_file, index_file = self._image_files(name)
+        index = np.memmap(index_file, np.int64, mode='r',
+                          shape=(info['count'], 3 + MAX_IMAGE_DIMS))
+        if info['size'] == 0:
+            data = np.zeros(0, np.dtype(info['dtype']))
+        else:
+            data = np.memmap(data_file, np.dtype(info['dtype']), mode='r',
+                             shape=(info['size'],))
+        if keys is None:
+            positions = range(info['count'])
+        else:
+            keys = np.asarray(keys)
+            order = np.argsort(index[:, 0], kind='stable')
+            sorted_keys = np.asarray(index[order, 0])
+            found = np.searchsorted(sorted_keys, keys, side='right') - 1
+            missing = (found < 0) | \
+                (sorted_keys[np.maximum(found, 0)] != keys)
+            if np.any(missing):
+                raise KeyError(keys[missing][0])
+            positions = order[found]
+        answer = []
+        for position in positions:
+            key, offset, ndim = index[position, :3]
+            shape = tuple(index[position, 3:3 + ndim])
+            size = int(np.prod(shape))
+            answer.append(data[offset:offset + size].reshape(shape))
+        return answer
@@ -13,6 +13,8 @@ aligning, labeling regions, etc.
 @author: Nicholas Sherer
 """
 
+import warnings
+
 import numpy as np
 import skimage
 # import skimage.transform as sktr
@@ -27,8 +29,13 @@ import scipy.ndimage.interpolation as ndint
 import scipy.signal as spsig
 # from functools import partial
 from skimage import img_as_ubyte
-from cv2 import fastNlMeansDenoising as nlMnsDns
-from skimage._shared._warnings import expected_warnings
+
+import compactmasks
+import edtmorphology as edtm
+from lazyimports import lazy_import
+
+# OpenCV is only needed by normAndDenoisePc
+cv2 = lazy_import('cv2')
 
 major, minor, patch = [x for x in skimage.__version__.split('.')]
 ski_ver = float(major) + float('.' + minor)
@@ -94,7 +101,12 @@ def warpIm2Im(fr_image, to_image, affine_transform):
     the inverse of the matrix transformation that maps coordinates
     in the fr_im to the to_im which is what the function is doing.
     Don't ask why scipy.ndimage works that way it just does.
+
+    fr_image may be a compactmasks packedMask or runLengthLabel, the warp is
+    then returned compacted the same way.
     """
+    compact_fr_image = fr_image
+    fr_image = compactmasks.dense(fr_image)
     size = np.shape(to_image)
     scaling_and_rotation = affine_transform.params[0:2, 0:2]
     translation = affine_transform.params[0:2, 2]
@@ -103,7 +115,7 @@ def warpIm2Im(fr_image, to_image, affine_transform):
     # bad.
     warp = ndint.affine_transform(fr_image, scaling_and_rotation, translation,
                                   size, order=0)
-    return warp
+    return compactmasks.like(compact_fr_image, warp)
 
 
 def interpNans(im):
@@ -116,24 +128,36 @@ def interpNans(im):
                          im[~mask])
 
 
-def normAndDenoisePc(image_list):
+def normAndDenoisePc(image_list, dtype=np.float64):
     """
     This corrects for unevenness in illumination by summing
     across a collection to get a blurry idea of the illumination
     and then dividing each image by that to correct for
     the uneven illumination. Then it denoises each image (meant
     for phase contrast images).
+
+    The stack is kept in the images' own type (e.g. uint16) and the mean and
+    the normalized images are computed as dtype, float32 uses half the memory
+    of the default.
+    """
+    image_array = np.asarray(image_list)
+    mean_illumination = np.mean(image_array, 0, dtype=dtype)
+    normed_image_list = [np.divide(image, mean_illumination, dtype=dtype)
+                         for image in image_list]
+    return [denoisePc(image) for image in normed_image_list]
+
+
+def denoisePc(normed_image):
+    """
+    Scales one illumination normalized phase contrast image to uint8 and
+    denoises it, the per image half of normAndDenoisePc.
     """
-    image_array = np.array(image_list)
-    mean_illumination = np.mean(image_array, 0)
-    normed_image_list = [image/mean_illumination for image in image_list]
-    with expected_warnings(['precision']):
-        image_ubyte_list = [img_as_ubyte(image/np.max(image)) for image in
-                            normed_image_list]
-    denoised_image_list = \
-        [nlMnsDns(image, None, np.uint8(.95*np.std(image)), 7, 11) for image in
-         image_ubyte_list]
-    return denoised_image_list
+    with warnings.catch_warnings():
+        # older skimage warns about the precision lost going to uint8
+        warnings.filterwarnings('ignore', message='.*precision')
+        image_ubyte = img_as_ubyte(normed_image/np.max(normed_image))
+    return cv2.fastNlMeansDenoising(image_ubyte, None,
+                                    np.uint8(.95*np.std(image_ubyte)), 7, 11)
 
 
 def localMinLeftOfGlobalMax(image, bins, comparison_width):
@@ -148,6 +172,15 @@ def localMinLeftOfGlobalMax(image, bins, comparison_width):
     fluorescent beads in brightfield.
     """
     bins, edges = np.histogram(image, bins)
+    return thresholdFromHistogram(bins, edges, comparison_width)
+
+
+def thresholdFromHistogram(bins, edges, comparison_width):
+    """
+    The localMinLeftOfGlobalMax cutoff from an already computed histogram
+    (counts and edges as np.histogram returns them), e.g. one accumulated
+    over the tiles of an image too big to histogram at once.
+    """
     peak_index = spsig.argrelextrema(bins, np.greater_equal,
                                      order=comparison_width)[0]
     trough_index = spsig.argrelextrema(bins, np.less_equal,
@@ -166,28 +199,43 @@ def localMinLeftOfGlobalMax(image, bins, comparison_width):
 
 
 def thresholdMask(image, bins=np.arange(256), comparison_width=5,
-                  min_size=200):
+                  min_size=200, threshold=None):
     """
     Thresholds an image using localMinLeftofGlobalMax and returns the mask that
-    results from this thresholding.
+    results from this thresholding. A threshold passed in (e.g. one from a
+    histogram accumulated over many images) is used instead.
     """
-    threshold = localMinLeftOfGlobalMax(image, bins, comparison_width)
+    if threshold is None:
+        threshold = localMinLeftOfGlobalMax(image, bins, comparison_width)
     mask = image < threshold
     clean_mask = skmo.remove_small_objects(mask, min_size=min_size)
     return clean_mask
 
 
-def findMedianBg(image_list, sigma=40):
+def findMedianBg(image_list, sigma=40, dtype=np.float64):
     """
     This function calculates a background illumination by taking the median by
     pixel across a stack of images and then blurring the result. It
     returns this background normalized to have a mean intensity of 1 so that it
     won't affect the overall scale of the images to be illumination corrected,
     but will correct for inhomogeneities in illumination.
+
+    The stack is kept in the images' own type and the background is returned
+    as dtype, so correcting with it (see correctIllumination) can stay in
+    float32.
     """
-    background = skf.gaussian(np.median(np.array(image_list), 0), sigma=sigma)
+    background = skf.gaussian(np.median(np.asarray(image_list), 0),
+                              sigma=sigma)
     normalized_background = background / np.mean(background)
-    return normalized_background
+    return normalized_background.astype(dtype, copy=False)
+
+
+def correctIllumination(image, background, dtype=np.float64):
+    """
+    Divide an image by a background from findMedianBg (or an illumination map)
+    computing in dtype, without first converting the raw image to float64.
+    """
+    return np.divide(image, background, dtype=dtype)
 
 
 def properties2list(regionprops_list_list, fields):
@@ -212,7 +260,7 @@ def properties2list(regionprops_list_list, fields):
                 except AttributeError:
                     raise
         FOV = FOV + 1
-    supported_types = set(np.typeDict.values())
+    supported_types = set(np.sctypeDict.values())
     supported_types.update([float, int, complex])
     supported_types.discard(np.object_)
     supported_types.discard(np.void)
@@ -240,8 +288,9 @@ def removeNonCirles(masks, n=np.inf, eccentricity_c=.6, solidity_c=.95):
     regions that aren't sufficiently circular i.e. are too eccentric and not
     solid enough. The parameter n can be set to discard circles whose areas and
     perimeters are n times the median absolute deviation from the median area
-    and perimeter of the regions.'''
-    labels = [skme.label(mask) for mask in masks]
+    and perimeter of the regions. Compact masks (compactmasks.packedMask) are
+    accepted and returned compact.'''
+    labels = [skme.label(compactmasks.dense(mask)) for mask in masks]
     # this silences a deprecation warning in skimage versions 0.14 and 0.15, we
     # don't care about this warning because we don't use the coordinates in
     # regionprops so the behavior change won't matter here from 0.13 to 0.16
@@ -262,7 +311,8 @@ def removeNonCirles(masks, n=np.inf, eccentricity_c=.6, solidity_c=.95):
     label_rejects = prop_list['label'][rejects]
     for FOV, label in zip(FOV_rejects, label_rejects):
         labels[FOV][labels[FOV] == label] = 0
-    return [label > 0 for label in labels]
+    return [compactmasks.like(mask, label > 0) for mask, label in
+            zip(masks, labels)]
 
 
 def findBeadsBF(image, thr):
@@ -291,16 +341,18 @@ def surroundings(label, radius1, radius2):
     as background and radius 2 is the farthest out to count as the local
     background of an object (e. coli).
     '''
-    dilated = skmo.dilation(label, selem=skmo.disk(radius1))
-    label_dilations = {i: skmo.binary_dilation(label==i,
-                                               selem=skmo.disk(radius2))
-                       for i in np.unique(label) if i > 0}
+    near = edtm.dilate(label > 0, radius1)
+    boxes = ndi.find_objects(label)
     surroundings = {}
     for i in np.unique(label):
         if i > 0:
-            value = np.logical_xor(label_dilations[i],
-                                   np.logical_and(label_dilations[i],
-                                                  dilated>0))
+            # only the part of the image within radius2 of the label can be
+            # in its dilation
+            box = tuple(slice(max(side.start - radius2, 0),
+                              min(side.stop + radius2, size))
+                        for side, size in zip(boxes[i - 1], label.shape))
+            value = np.zeros(label.shape, dtype=bool)
+            value[box] = edtm.dilate(label[box] == i, radius2) & ~near[box]
             if np.sum(value) <= 10:
                 raise RuntimeError("unable to find background to label {0}"
                                    "that doesn't overlap with other"
@@ -318,33 +370,36 @@ def surroundings_brightness(image, surroundings):
     '''
     brightnesses = {}
     for i, mask in surroundings.items():
-        brightnesses[i]=np.sum(image*(mask))/np.sum(mask)
+        # only the masked pixels, not a full frame product per object
+        brightnesses[i]=np.sum(image[mask])/np.sum(mask)
     return brightnesses
 
 
-def infill_separated(image, labels, brightnesses):
+def infill_separated(image, labels, brightnesses, dtype=np.float64):
     '''
     Make a copy of image, but where there are labels, replace the pixel values
     in the labeled area with the values looked up from a brightnesses
     dictionary (keys are the label number, values are the pixel value to put
-    in).
+    in). Labeled pixels of labels missing from brightnesses become 0. The
+    copy is of type dtype.
     '''
-    output = np.copy(image)
-    output = output*np.logical_not(labels)
+    lookup = np.zeros(max(np.max(labels), max(brightnesses, default=0)) + 1,
+                      dtype=dtype)
     for i, brightness in brightnesses.items():
-        output = output + (labels==i)*brightness
-    return output
+        lookup[i] = brightness
+    return np.where(labels > 0, lookup[labels], image).astype(dtype,
+                                                               copy=False)
 
 
-def subtract_pad_bg(image, label, r1, r2):
+def subtract_pad_bg(image, label, r1, r2, dtype=np.float64):
     '''
     Given an image and labeled objects, subtract the background intensity from
     the image with inferred background values adding to the original image
     pixel intensities inferred by averaging over nearby background pixels that
     are at least r1 pixels away from the object but not more than r2 pixels
-    away.
+    away. The infilled background is computed as dtype, the result is int32.
     '''
     surrounding_areas = surroundings(label, r1, r2)
     brightnesses = surroundings_brightness(image, surrounding_areas)
-    infilled_bg = infill_separated(image, label, brightnesses)
+    infilled_bg = infill_separated(image, label, brightnesses, dtype)
     return image.astype('int32') - infilled_bg.astype('int32')
@@ -9,29 +9,44 @@ spots manually, and visualization and widget controls to go with all this.
 @author: Nicholas Sherer
 """
 
+import time
+import warnings
+
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
+from itertools import repeat
+import skimage.filters as skf
 import skimage.measure as skme
 import skimage.morphology as skmo
-from skimage._shared._warnings import expected_warnings
-
-import ipywidgets as ipyw
-import matplotlib.pyplot as plt
-import matplotlib.cm as colormap
 
+import compactmasks
+import edtmorphology as edtm
 import segmentation as mseg
 import visualization as mvis
+from lazyimports import lazy_import
+
+# widgets and plotting load on first use
+ipyw = lazy_import('ipywidgets')
+plt = lazy_import('matplotlib.pyplot')
+colormap = lazy_import('matplotlib.cm')
 
 
 def spotfindingLabels(mask_list, target_FOV, camera_transform):
     '''
     Return dilated and filled in labeled masks warped to a particular FOV.
     '''
-    with expected_warnings(['Only one label']):
-        expanded_masks = [skmo.binary_dilation(mask, selem=skmo.disk(10))
-                          for mask in mask_list]
-        expanded_masks = [skmo.remove_small_holes(mask, min_size=2500)
-                          for mask in expanded_masks]
+    with warnings.catch_warnings():
+        # remove_small_objects warns when a warped image has a single label
+        warnings.filterwarnings('ignore', message='Only one label')
+        expanded_masks = [edtm.dilate(mask, 10) for mask in mask_list]
+        if mseg.ski_ver >= .14:
+            expanded_masks = [skmo.remove_small_holes(mask,
+                                                      area_threshold=2500)
+                              for mask in expanded_masks]
+        else:
+            expanded_masks = [skmo.remove_small_holes(mask, min_size=2500)
+                              for mask in expanded_masks]
         expanded_labels = [skme.label(mask) for mask in expanded_masks]
         expanded_labels_w = [mseg.warpIm2Im(label, target_FOV,
                                             camera_transform)
@@ -45,9 +60,15 @@ def maskBboxesandCoordinates(label_list):
     '''
     Return a dictionary mapping unique objects in an image sequence to their
     FOV, the bbox that contains them in that FOV, and the coordinates they
-    occupy.
+    occupy. A list of compactmasks.runLengthLabel is read straight from its
+    runs without making the full label images.
     '''
-    mask_rprops = [skme.regionprops(label) for label in label_list]
+    if len(label_list) > 0 and all(isinstance(label,
+                                              compactmasks.runLengthLabel)
+                                   for label in label_list):
+        return compactmasks.regionCoordinates(label_list)
+    mask_rprops = [skme.regionprops(compactmasks.dense(label)) for label in
+                   label_list]
     mask_coords = mseg.properties2list(mask_rprops, ['coords', 'bbox'])
     return mask_coords
 
@@ -67,12 +88,17 @@ def regionView(label_list, image_list, mask_coords, index):
     Return a view of an object without the rest of the image.
     '''
     FOV = mask_coords['FOV'][index]
-    label = mask_coords['label'][index]
-    mask = label_list[FOV] == label
-    region = mask*image_list[FOV]
+    image = np.asarray(image_list[FOV])
     bbox = mask_coords['bbox'][index]
     min_row, min_col, max_row, max_col = bbox
-    return region[min_row:max_row, min_col:max_col]
+    # fill in just the object's pixels from its coordinates rather than
+    # masking the whole frame (label_list isn't needed for that anymore)
+    coords = mask_coords['coords'][index]
+    region = np.zeros((max_row - min_row, max_col - min_col),
+                      dtype=np.result_type(bool, image.dtype))
+    region[coords[:, 0] - min_row, coords[:, 1] - min_col] = \
+        image[coords[:, 0], coords[:, 1]]
+    return region
 
 
 def regionImagesAndIntensities(label_list, pc_image_list, TIRF_image_list):
@@ -97,15 +123,16 @@ def regionImagesAndIntensities(label_list, pc_image_list, TIRF_image_list):
 def plotHistogramThreshold(data, threshold, subplot):
     '''
     Plot a histogram of some data and draw a vertical line separating the data
-    in two.
+    in two. Returns the line so it can be moved later.
     '''
     nbins = np.sqrt(data.size).astype('int')
     bin_size = ((np.max(data)-np.min(data))/nbins).astype('int')
     subplot.hist(data, bins=nbins)
-    subplot.axvline(threshold, color='red')
+    threshold_line = subplot.axvline(threshold, color='red')
     subplot.set_yscale('log')
     subplot.set_ylabel('frequency')
     subplot.set_label('data, binsize= {: d}'.format(bin_size))
+    return threshold_line
 
 
 def halfSampleMode(sorted_array):
@@ -113,30 +140,113 @@ def halfSampleMode(sorted_array):
     Estimate the mode of a continuous random variable from a sorted array of
     draws of that random variable.
     '''
-    size = sorted_array.size
-    if size == 1:
-        return sorted_array
-    if size == 2:
+    # Each pass keeps the shortest window holding half + 1 of the samples (the
+    # first one on ties, as the old recursive loop did) until two are left.
+    while sorted_array.size > 2:
+        size = sorted_array.size
+        half = int(size / 2) + 1
+        intervals = sorted_array[half-1:size-1] - sorted_array[0:size-half]
+        small_index = np.argmin(intervals) + half - 1
+        sorted_array = sorted_array[small_index-half+1:small_index+1]
+    if sorted_array.size == 2:
         return (sorted_array[0]+sorted_array[1])/2
-    half = np.int(size / 2) + 1
-    small_interval = sorted_array[half-1]-sorted_array[0]
-    small_index = half-1
-    for i in range(half, size-1):
-        new_interval = sorted_array[i] - sorted_array[i-half+1]
-        if new_interval < small_interval:
-            small_interval = new_interval
-            small_index = i
-    return halfSampleMode(sorted_array[small_index-half+1:small_index+1])
+    return sorted_array
+
+
+def spotOverlay(TIRF_region, threshold, min_size=2):
+    '''
+    Return the mask of spots in a region, i.e. the pixels brighter than the
+    threshold in connected groups of at least min_size pixels.
+    '''
+    return skmo.remove_small_objects(TIRF_region > threshold,
+                                     min_size=min_size)
+
+
+def autoSpotThreshold(intensity, method='mad', n_mad=5):
+    '''
+    Return a threshold between the bulk fluorescence of a region and the
+    brightness of its spots from the sorted intensities of the region.
+
+    method is one of 'guess', 'mad' or 'otsu'. 'guess' is the 4*mode - 3*min
+    initial guess manualSpotThresholder has always used. 'mad' puts the
+    threshold n_mad standard deviations above the half sample mode, with the
+    standard deviation estimated from the median absolute deviation of the
+    pixels dimmer than the mode (so spots don't inflate it). 'otsu' uses
+    Otsu's method but never goes below the mode.
+    '''
+    mode = float(np.squeeze(halfSampleMode(intensity)))
+    if method == 'guess':
+        return 4*mode - 3*np.min(intensity)
+    elif method == 'mad':
+        bulk = intensity[intensity <= mode]
+        sigma = 1.4826*np.median(mode - bulk)
+        return mode + n_mad*sigma
+    elif method == 'otsu':
+        if np.min(intensity) == np.max(intensity):
+            return mode
+        return max(skf.threshold_otsu(intensity), mode)
+    else:
+        raise ValueError("method must be 'guess', 'mad' or 'otsu'")
+
+
+def _autoSpotRegion(TIRF_region, intensity, method, n_mad, min_size):
+    '''
+    Threshold one region. Module level so it can be sent to worker processes.
+    '''
+    threshold = autoSpotThreshold(intensity, method, n_mad)
+    return threshold, spotOverlay(TIRF_region, threshold, min_size)
+
+
+def autoSpotThresholds(TIRF_regions, intensities, method='mad', n_mad=5,
+                       min_size=2, processes=None, chunksize=64):
+    '''
+    Threshold every region for spots without any human input.
+
+    Returns the thresholds and overlays lists in the same form
+    manualSpotThresholder keeps them, so they can be saved the same way or
+    passed to it as load_thresholds and load_overlays to review the results.
+    Regions are spread over processes worker processes (all cores if None),
+    set processes to 1 to run in this process.
+    '''
+    args = (TIRF_regions, intensities, repeat(method), repeat(n_mad),
+            repeat(min_size))
+    if processes == 1:
+        results = list(map(_autoSpotRegion, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_autoSpotRegion, *args,
+                                        chunksize=chunksize))
+    thresholds = [result[0] for result in results]
+    overlays = [result[1] for result in results]
+    return thresholds, overlays
+
+
+def thresholdOutliers(intensities, thresholds, n=3):
+    '''
+    Return the indices of regions worth reviewing by hand, those where the
+    fraction of pixels above the threshold is more than n times the median
+    absolute deviation from the median over all regions.
+    '''
+    spot_fraction = np.array([np.mean(intensity > threshold) for
+                              intensity, threshold in
+                              zip(intensities, thresholds)])
+    return np.flatnonzero(mseg.aboveNMADselect(spot_fraction, n))
 
 
 class manualSpotThresholder(object):
     '''
     This code is used for manually setting thresholds between the bulk
     fluorescence of e. coli and the brightness of a fluorescent foci.
+
+    To review automatic thresholds instead of starting from scratch, pass the
+    output of autoSpotThresholds as load_thresholds and load_overlays.
+    The plots are made once and updated in place, timing_hook is passed on to
+    visualization.persistentFigure to report how long each redraw takes.
     '''
 
     def __init__(self, pc_regions, TIRF_regions, intensities, fsize,
-                 load_thresholds=None, load_overlays=None, start_region=0):
+                 load_thresholds=None, load_overlays=None, start_region=0,
+                 timing_hook=None):
         self.pc_regions = pc_regions
         self.TIRF_regions = TIRF_regions
         self.intensities = intensities
@@ -166,8 +276,21 @@ class manualSpotThresholder(object):
                                        step=step_size,
                                        value=self.thresholds[start_region],
                                        continuous_update=False)
-        self.box = ipyw.Box()
-        self.box.children = [self.r_slider, self.t_slider]
+        self.display_fig = mvis.persistentFigure(self.fsize, timing_hook)
+        self.pc_subplot = self.display_fig.fig.add_subplot(131)
+        self.TIRF_subplot = self.display_fig.fig.add_subplot(132)
+        self.hist_subplot = self.display_fig.fig.add_subplot(133)
+        self.pc_artist, self.overlay_artist = \
+            mvis.showOverlay(self.pc_regions[start_region],
+                             self.overlays[start_region], self.pc_subplot)
+        self.TIRF_artist = \
+            self.TIRF_subplot.imshow(self.TIRF_regions[start_region])
+        self.threshold_line = None
+        self.plotted_index = None
+        sliders = ipyw.Box()
+        sliders.children = [self.r_slider, self.t_slider]
+        self.box = ipyw.VBox()
+        self.box.children = [sliders, self.display_fig.output]
         self.updatePlots(self.r_slider.value, self.t_slider.value)
 
         def onRegionChange(region):
@@ -181,23 +304,28 @@ class manualSpotThresholder(object):
         def onThresholdChange(threshold):
             region = self.r_slider.value
             self.thresholds[region] = threshold
-            self.overlays[region] = \
-                skmo.remove_small_objects(self.TIRF_regions[region] >
-                                          threshold, min_size=2)
+            self.overlays[region] = spotOverlay(self.TIRF_regions[region],
+                                                threshold)
             self.updatePlots(region, threshold)
 
         ipyw.interactive(onRegionChange, region=self.r_slider)
         ipyw.interactive(onThresholdChange, threshold=self.t_slider)
 
     def updatePlots(self, index, threshold):
-        fig = plt.figure(figsize=self.fsize)
-        pc_subplot = fig.add_subplot(131)
-        TIRF_subplot = fig.add_subplot(132)
-        hist_subplot = fig.add_subplot(133)
-        mvis.showOverlay(self.pc_regions[index], self.overlays[index],
-                         pc_subplot)
-        TIRF_subplot.imshow(self.TIRF_regions[index])
-        plotHistogramThreshold(self.intensities[index], threshold,
-                               hist_subplot)
-        hist_subplot.vlines(self.modes[index], 0, self.intensities[index].size,
-                            color='green')
+        start = time.perf_counter()
+        if index != self.plotted_index:
+            mvis.updateImage(self.pc_artist, self.pc_regions[index])
+            mvis.updateImage(self.TIRF_artist, self.TIRF_regions[index])
+            self.hist_subplot.cla()
+            self.threshold_line = \
+                plotHistogramThreshold(self.intensities[index], threshold,
+                                       self.hist_subplot)
+            self.hist_subplot.vlines(self.modes[index], 0,
+                                     self.intensities[index].size,
+                                     color='green')
+            self.plotted_index = index
+        else:
+            self.threshold_line.set_xdata([threshold, threshold])
+        mvis.updateImage(self.overlay_artist, self.overlays[index],
+                         rescale=False)
+        self.display_fig.redraw('manualSpotThresholder', start)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: a small synthetic experiment folder rendered with
+fovsimulation, laid out the way pipeline.pipeline expects.
+
+@author: kuhlmanlab
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+EXPERIMENT_CONFIG = {
+    'beads': {'brightfield': 'beads/*_bf.tif', 'phase': 'beads/*_pc.tif',
+              'tirf': 'beads/*_tirf.tif'},
+    'cells': {'phase': 'cells/*_pc.tif', 'tirf': 'cells/*_tirf.tif'},
+    'stages': {'bead_masks': {'phase_threshold': 1200, 'phase_min_size': 100},
+               'illumination': {'sigma': 60}},
+}
+
+
+def render_experiment(directory, bead_fovs=3, cell_fovs=4, shape=(256, 256)):
+    '''
+    Write bead and cell FOVs of a synthetic experiment and its pipeline.json
+    to directory.
+    '''
+    import tifffile
+    import cellularphotobleachingsimulation as cps
+    import fovsimulation as fs
+    laser = cps.laser.gaussian_beam_init(1., 300, 1e4, 1, 0, 0, 128, 128, 0)
+    camera = cps.camera(.8, 1., 2., 60000, 100)
+    os.makedirs(os.path.join(directory, 'beads'))
+    os.makedirs(os.path.join(directory, 'cells'))
+    for i, rng in enumerate(cps.spawn_generators(1, bead_fovs)):
+        fov = fs.render_fov(shape, laser, camera, 1, cell_count=0,
+                            bead_count=6, bead_brightness=500., rng=rng)
+        for channel, image in [('bf', fov['brightfield']),
+                               ('pc', fov['phase']),
+                               ('tirf', fov['tirf'][0])]:
+            tifffile.imwrite(os.path.join(
+                directory, 'beads', 'b{}_{}.tif'.format(i, channel)), image)
+    for i, rng in enumerate(cps.spawn_generators(2, cell_fovs)):
+        fov = fs.render_fov(shape, laser, camera, 1, cell_count=20, rng=rng)
+        for channel, image in [('pc', fov['phase']), ('tirf', fov['tirf'][0])]:
+            tifffile.imwrite(os.path.join(
+                directory, 'cells', 'c{}_{}.tif'.format(i, channel)), image)
+    with open(os.path.join(directory, 'pipeline.json'), 'w') as file:
+        json.dump(EXPERIMENT_CONFIG, file)
+    return directory
+
+
+@pytest.fixture(scope='session')
+def experiment(tmp_path_factory):
+    return render_experiment(str(tmp_path_factory.mktemp('experiment')))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+@author: kuhlmanlab
+"""
+
+import csv
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import acquisitionwatch as aw
+import pipeline as mpipe
+
+
+def _rows_per_fov(filename):
+    with open(filename) as file:
+        fovs = [int(row['FOV']) for row in csv.DictReader(file)]
+    return np.bincount(fovs, minlength=4)
+
+
+def test_every_fov_gives_rows(experiment, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    batch_file = str(tmp_path / 'cells.csv')
+    mpipe.write_table(mpipe.pipeline(experiment, cache_dir=cache_dir).run(),
+                      batch_file)
+    live_file = str(tmp_path / 'cells_live.csv')
+    watcher = aw.acquisitionWatcher(experiment, live_file,
+                                    cache_dir=cache_dir, settle_time=0)
+    # files count as written once they are unchanged between two polls
+    assert watcher.poll() == []
+    assert watcher.poll() == [0, 1, 2, 3]
+    live = _rows_per_fov(live_file)
+    assert np.all(live > 0)
+    np.testing.assert_array_equal(live, _rows_per_fov(batch_file))
+
+
+def test_fovs_wait_for_the_background(experiment, tmp_path):
+    live_dir = tmp_path / 'live'
+    os.makedirs(live_dir / 'cells')
+    shutil.copytree(os.path.join(experiment, 'beads'), live_dir / 'beads')
+    shutil.copy(os.path.join(experiment, 'pipeline.json'), live_dir)
+    live_file = str(tmp_path / 'cells_live.csv')
+    watcher = aw.acquisitionWatcher(str(live_dir), live_file,
+                                    cache_dir=str(tmp_path / 'cache'),
+                                    settle_time=0)
+    done = []
+    for index in range(4):
+        for channel in ('pc', 'tirf'):
+            name = 'c{}_{}.tif'.format(index, channel)
+            shutil.copy(os.path.join(experiment, 'cells', name),
+                        live_dir / 'cells' / name)
+        done.extend(watcher.poll() + watcher.poll())
+        # nothing is segmented until three images are in the background
+        assert len(done) == (0 if index < 2 else index + 1)
+    assert done == [0, 1, 2, 3]
+    assert np.all(_rows_per_fov(live_file) > 0)
+
+
+def test_short_experiment_flushes_queue(experiment, tmp_path):
+    watcher = aw.acquisitionWatcher(experiment, str(tmp_path / 'live.csv'),
+                                    cache_dir=str(tmp_path / 'cache'),
+                                    settle_time=0, min_background=10)
+    watcher.poll()
+    assert watcher.poll() == []
+    assert watcher.flush() == [0, 1, 2, 3]
+    assert np.all(_rows_per_fov(str(tmp_path / 'live.csv')) > 0)
+
+
+def test_min_background_of_one_is_refused(experiment, tmp_path):
+    with pytest.raises(ValueError):
+        aw.acquisitionWatcher(experiment, str(tmp_path / 'live.csv'),
+                              cache_dir=str(tmp_path / 'cache'),
+                              min_background=1)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+@author: kuhlmanlab
+"""
+
+import numpy as np
+import pytest
+import skimage.measure as skme
+import skimage.morphology as skmo
+
+import edtmorphology as edtm
+
+
+def _random_mask(seed, shape=(120, 150), blobs=12):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    for row, col in zip(rng.integers(0, shape[0], blobs),
+                        rng.integers(0, shape[1], blobs)):
+        mask[max(row - 4, 0):row + 4, max(col - 6, 0):col + 6] = True
+    return mask
+
+
+@pytest.mark.parametrize('radius', [1, 3, 10])
+def test_dilate_and_erode_match_skimage(radius):
+    mask = _random_mask(radius)
+    footprint = skmo.disk(radius)
+    np.testing.assert_array_equal(
+        edtm.dilate(mask, radius), skmo.dilation(mask, footprint) > 0)
+    np.testing.assert_array_equal(
+        edtm.erode(mask, radius), skmo.erosion(mask, footprint) > 0)
+
+
+@pytest.mark.parametrize('radius', [2, 5, 10])
+def test_dilate_labels_matches_skimage_on_touching_labels(radius):
+    # neighboring blocks that touch, and cells closer than 2*radius
+    label = np.zeros((80, 90), dtype=np.int32)
+    label[10:30, 10:25] = 3
+    label[10:30, 25:40] = 1
+    label[30:45, 10:40] = 2
+    label[50:60, 45:55] = 5
+    label[50:60, 58:70] = 4
+    label[0:5, 80:90] = 6
+    label = np.maximum(label, skme.label(_random_mask(7, (80, 90), 4)) * 10)
+    np.testing.assert_array_equal(
+        edtm.dilate_labels(label, radius),
+        skmo.dilation(label, skmo.disk(radius)))
+
+
+def test_dilate_labels_of_background_is_background():
+    label = np.zeros((20, 20), dtype=np.uint16)
+    np.testing.assert_array_equal(edtm.dilate_labels(label, 4), label)
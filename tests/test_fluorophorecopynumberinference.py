@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+@author: kuhlmanlab
+"""
+
+import numpy as np
+
+import fluorophorecopynumberinference as fcni
+
+
+def test_tied_peak_of_dim_integer_trace_is_not_saturation():
+    time = np.arange(40.)
+    trace = np.round(30*np.exp(-time/8) + 5).astype(np.uint16)
+    trace[1] = trace[0]
+    assert np.sum(trace == trace.max()) >= 2
+    guesses = fcni._initial_guesses(time, trace[np.newaxis, :])[0]
+    assert guesses[3] == 65000
+    params, stds = fcni.fit_photobleach_rate(time, trace)
+    assert params['ceiling'] > trace.max()
+    assert abs(params['tau'] - 8) < 1
+    batch, batch_stds = fcni.fit_photobleach_rates(time, trace[np.newaxis, :])
+    assert abs(batch['tau'][0] - params['tau']) < 1e-4
+
+
+def test_clipped_trace_is_saturation():
+    time = np.arange(40.)
+    trace = np.minimum(90000*np.exp(-time/10) + 1000,
+                       65535).astype(np.uint16)
+    guesses = fcni._initial_guesses(time, trace[np.newaxis, :])[0]
+    assert guesses[3] == 65535
+    # a 12 bit camera saves into uint16 but saturates at 4095
+    trace = np.minimum(6000*np.exp(-time/10) + 100, 4095).astype(np.uint16)
+    guesses = fcni._initial_guesses(time, trace[np.newaxis, :])[0]
+    assert guesses[3] == 65000
+    guesses = fcni._initial_guesses(time, trace[np.newaxis, :],
+                                    saturation_level=4095)[0]
+    assert guesses[3] == 4095
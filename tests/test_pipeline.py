@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+@author: kuhlmanlab
+"""
+
+import glob
+import os
+import shutil
+
+import numpy as np
+
+import pipeline as mpipe
+
+
+def _copy_modules(directory):
+    for path in glob.glob(os.path.join(mpipe.MODULE_DIR, '*.py')):
+        shutil.copy(path, directory)
+
+
+def _keys(experiment, cache_dir):
+    runner = mpipe.pipeline(experiment, cache_dir=cache_dir)
+    return {name: runner.key(name) for name in mpipe.STAGES}
+
+
+def test_editing_a_module_changes_the_keys_of_its_stages(experiment, tmp_path,
+                                                          monkeypatch):
+    modules = tmp_path / 'modules'
+    modules.mkdir()
+    _copy_modules(str(modules))
+    monkeypatch.setattr(mpipe, 'MODULE_DIR', str(modules))
+    cache_dir = str(tmp_path / 'cache')
+    before = _keys(experiment, cache_dir)
+    with open(modules / 'illuminationinterpolation.py', 'a') as file:
+        file.write('\n# edited\n')
+    after = _keys(experiment, cache_dir)
+    # the illumination stage and the table made with it
+    assert {name for name in before if before[name] != after[name]} == \
+        {'illumination', 'cell_table'}
+    # edtmorphology is only used through segmentation, which every stage uses
+    with open(modules / 'edtmorphology.py', 'a') as file:
+        file.write('\n# edited\n')
+    edited = _keys(experiment, cache_dir)
+    assert all(edited[name] != after[name] for name in mpipe.STAGES)
+    with open(modules / 'resultstore.py', 'a') as file:
+        file.write('\n# edited\n')
+    assert _keys(experiment, cache_dir) == edited
+
+
+def test_edited_dependency_reruns_the_cached_stage(experiment, tmp_path,
+                                                   monkeypatch):
+    modules = tmp_path / 'modules'
+    modules.mkdir()
+    _copy_modules(str(modules))
+    monkeypatch.setattr(mpipe, 'MODULE_DIR', str(modules))
+    cache_dir = str(tmp_path / 'cache')
+    runner = mpipe.pipeline(experiment, cache_dir=cache_dir)
+    first = runner.run(['cell_masks'])
+    assert runner.fresh == {'cell_normalization', 'cell_masks'}
+    runner = mpipe.pipeline(experiment, cache_dir=cache_dir)
+    runner.run(['cell_masks'])
+    assert runner.fresh == set()
+    with open(modules / 'segmentation.py', 'a') as file:
+        file.write('\n# edited\n')
+    runner = mpipe.pipeline(experiment, cache_dir=cache_dir)
+    second = runner.run(['cell_masks'])
+    assert runner.fresh == {'cell_normalization', 'cell_masks'}
+    for mask1, mask2 in zip(first['masks'], second['masks']):
+        np.testing.assert_array_equal(mask1, mask2)
+
+
+def test_forcing_a_stage_reruns_its_dependents(experiment, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    mpipe.pipeline(experiment, cache_dir=cache_dir).run(['cell_masks'])
+    runner = mpipe.pipeline(experiment, cache_dir=cache_dir)
+    runner.run(['cell_masks'], force=['cell_normalization'])
+    assert runner.fresh == {'cell_normalization', 'cell_masks'}
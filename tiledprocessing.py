@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Segmentation of images too big to process whole, like stitched mosaics.
+
+The functions here give the same results as their namesakes in segmentation
+(and skimage.measure.label) but only ever hold a tile of the image, plus a
+margin around it when the operation needs to see past the tile's edge, in
+memory at once. The input can be a memmap (np.load(..., mmap_mode='r')) and
+the outputs can be written into memmaps passed as out. findBeadsBF and
+findRegionCenters also need a whole image intermediate mask, which goes in
+the scratch passed in (a memmap for images too big for memory) or otherwise
+in memory.
+
+How each operation stays exact across tile seams:
+
+- labeling labels each tile, joins labels that touch across a seam with a
+  union find, and renumbers them in raster order the way skimage does.
+- removing small objects or holes uses the areas of those joined labels.
+- thresholdMask accumulates one histogram over all the tiles.
+- distance transforms grow the margin until it is larger than every
+  distance inside the tile, so the nearest background pixel is always seen.
+- findRegionCenters finds peak candidates in tiles with a margin of the peak
+  spacing and then spaces them out over the whole image at once.
+- surroundings use a margin of the outer radius and sum each label's
+  background over all the tiles.
+
+@author: kuhlmanlab
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+import scipy.sparse as spsp
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import skimage.measure as skme
+
+import edtmorphology as edtm
+import segmentation as mseg
+
+
+def tiles(shape, tile_size):
+    '''
+    The tiles of an image as (row index, column index, (row slice, column
+    slice)) in raster order.
+    '''
+    for i, row in enumerate(range(0, shape[0], tile_size)):
+        for j, col in enumerate(range(0, shape[1], tile_size)):
+            yield i, j, (slice(row, min(row + tile_size, shape[0])),
+                         slice(col, min(col + tile_size, shape[1])))
+
+
+def expand(core, shape, margin):
+    '''
+    The tile core grown by margin on every side (clipped to the image), and
+    where the core sits inside that.
+    '''
+    rows, cols = core
+    crop = (slice(max(rows.start - margin, 0),
+                  min(rows.stop + margin, shape[0])),
+            slice(max(cols.start - margin, 0),
+                  min(cols.stop + margin, shape[1])))
+    inner = (slice(rows.start - crop[0].start, rows.stop - crop[0].start),
+             slice(cols.start - crop[1].start, cols.stop - crop[1].start))
+    return crop, inner
+
+
+def _output(out, shape, dtype):
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    return out
+
+
+class _inverted(object):
+    '''
+    Read only view of the logical not of a mask, a tile at a time.
+    '''
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.shape = mask.shape
+
+    def __getitem__(self, key):
+        return ~np.asarray(self.mask[key], dtype=bool)
+
+
+def _touching(a, b, connectivity):
+    '''
+    Pairs of labels facing each other across a seam, a and b being the rows
+    (or columns) either side of it.
+    '''
+    pairs = [(a, b)]
+    if connectivity > 1:
+        pairs.extend([(a[:-1], b[1:]), (a[1:], b[:-1])])
+    firsts = []
+    seconds = []
+    for first, second in pairs:
+        both = (first > 0) & (second > 0)
+        firsts.append(first[both])
+        seconds.append(second[both])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+class components(object):
+    '''
+    Connected components of a mask, found a tile at a time.
+
+    Each tile is labeled on its own, labels touching across the seams are
+    joined, and the joined components are numbered 1, 2, ... by their first
+    pixel in raster order, which is how skimage.measure.label numbers them.
+    area holds the area of each component (area[0] is unused) and count the
+    number of them. Only the seam rows and columns of each tile are kept, so
+    tile_labels labels a tile again to give its final labels.
+    '''
+
+    def __init__(self, mask, tile_size=2048, connectivity=2):
+        self.mask = mask
+        self.tile_size = tile_size
+        self.connectivity = connectivity
+        shape = mask.shape
+        self.offsets = {}
+        first_pixels = [np.zeros(1, dtype=np.int64)]
+        areas = [np.zeros(1, dtype=np.int64)]
+        edges = {}
+        next_id = 0
+        for i, j, core in tiles(shape, tile_size):
+            local = self._local_labels(core)
+            ids, first, counts = np.unique(local, return_index=True,
+                                           return_counts=True)
+            labeled = ids > 0
+            rows, cols = np.divmod(first[labeled], local.shape[1])
+            first_pixels.append((rows + core[0].start)*shape[1] +
+                                cols + core[1].start)
+            areas.append(counts[labeled])
+            provisional = np.where(local > 0, local + next_id, 0)
+            # copies, so the rest of the tile can be freed
+            edges[i, j] = (provisional[0].copy(), provisional[-1].copy(),
+                           provisional[:, 0].copy(), provisional[:, -1].copy())
+            self.offsets[i, j] = next_id
+            next_id = next_id + int(labeled.sum())
+        rows_of_tiles = max(i for i, j in edges) + 1
+        cols_of_tiles = max(j for i, j in edges) + 1
+        firsts = []
+        seconds = []
+        for i in range(1, rows_of_tiles):
+            above = np.concatenate([edges[i - 1, j][1] for j in
+                                    range(cols_of_tiles)])
+            below = np.concatenate([edges[i, j][0] for j in
+                                    range(cols_of_tiles)])
+            pair = _touching(above, below, connectivity)
+            firsts.append(pair[0])
+            seconds.append(pair[1])
+        for j in range(1, cols_of_tiles):
+            left = np.concatenate([edges[i, j - 1][3] for i in
+                                   range(rows_of_tiles)])
+            right = np.concatenate([edges[i, j][2] for i in
+                                    range(rows_of_tiles)])
+            pair = _touching(left, right, connectivity)
+            firsts.append(pair[0])
+            seconds.append(pair[1])
+        firsts = np.concatenate(firsts + [np.zeros(0, dtype=np.int64)])
+        seconds = np.concatenate(seconds + [np.zeros(0, dtype=np.int64)])
+        graph = spsp.coo_matrix((np.ones(firsts.size), (firsts, seconds)),
+                                shape=(next_id + 1, next_id + 1))
+        component_count, component = connected_components(graph,
+                                                          directed=False)
+        first_pixels = np.concatenate(first_pixels)
+        component_first = np.full(component_count, np.iinfo(np.int64).max)
+        np.minimum.at(component_first, component[1:], first_pixels[1:])
+        component_first[component[0]] = -1
+        order = np.argsort(component_first, kind='stable')
+        final = np.empty(component_count, dtype=np.int64)
+        final[order] = np.arange(component_count)
+        # provisional label to final label
+        self.lookup = final[component]
+        self.count = component_count - 1
+        self.area = np.bincount(self.lookup,
+                                weights=np.concatenate(areas),
+                                minlength=component_count).astype(np.int64)
+
+    def _local_labels(self, core):
+        return skme.label(np.asarray(self.mask[core], dtype=bool),
+                          connectivity=self.connectivity)
+
+    def tile_labels(self, i, j, core):
+        '''
+        The final labels of tile (i, j).
+        '''
+        local = self._local_labels(core)
+        return self.lookup[np.where(local > 0, local + self.offsets[i, j],
+                                    0)]
+
+
+def label(mask, tile_size=2048, connectivity=2, out=None, dtype=np.int32):
+    '''
+    skimage.measure.label of a mask, a tile at a time. Returns the label
+    image (out if given).
+    '''
+    found = components(mask, tile_size, connectivity)
+    out = _output(out, mask.shape, dtype)
+    for i, j, core in tiles(mask.shape, tile_size):
+        out[core] = found.tile_labels(i, j, core)
+    return out
+
+
+def remove_small_objects(mask, min_size, tile_size=2048, connectivity=1,
+                         out=None):
+    '''
+    skimage.morphology.remove_small_objects of a boolean mask, a tile at a
+    time. out may be mask itself.
+    '''
+    found = components(mask, tile_size, connectivity)
+    keep = found.area >= min_size
+    keep[0] = False
+    out = _output(out, mask.shape, bool)
+    for i, j, core in tiles(mask.shape, tile_size):
+        out[core] = keep[found.tile_labels(i, j, core)]
+    return out
+
+
+def remove_small_holes(mask, area_threshold, tile_size=2048, connectivity=1,
+                       out=None):
+    '''
+    skimage.morphology.remove_small_holes of a boolean mask, a tile at a
+    time. out may be mask itself.
+    '''
+    found = components(_inverted(mask), tile_size, connectivity)
+    fill = found.area < area_threshold
+    fill[0] = False
+    out = _output(out, mask.shape, bool)
+    for i, j, core in tiles(mask.shape, tile_size):
+        out[core] = np.asarray(mask[core], dtype=bool) | \
+            fill[found.tile_labels(i, j, core)]
+    return out
+
+
+def histogram(image, bins, tile_size=2048):
+    '''
+    np.histogram of an image, accumulated a tile at a time.
+    '''
+    shape = image.shape
+    if np.ndim(bins) == 0:
+        lows = []
+        highs = []
+        for i, j, core in tiles(shape, tile_size):
+            tile = np.asarray(image[core])
+            lows.append(tile.min())
+            highs.append(tile.max())
+        value_range = (min(lows), max(highs))
+    else:
+        value_range = None
+    counts = 0
+    for i, j, core in tiles(shape, tile_size):
+        tile_counts, edges = np.histogram(np.asarray(image[core]), bins,
+                                          range=value_range)
+        counts = counts + tile_counts
+    return counts, edges
+
+
+def thresholdMask(image, bins=np.arange(256), comparison_width=5,
+                  min_size=200, tile_size=2048, out=None):
+    '''
+    segmentation.thresholdMask a tile at a time. The mask is built in out,
+    which is allocated in memory if not given.
+    '''
+    counts, edges = histogram(image, bins, tile_size)
+    threshold = mseg.thresholdFromHistogram(counts, edges, comparison_width)
+    out = _output(out, image.shape, bool)
+    for i, j, core in tiles(image.shape, tile_size):
+        out[core] = np.asarray(image[core]) < threshold
+    return remove_small_objects(out, min_size, tile_size, out=out)
+
+
+def findBeadsBF(image, thr, tile_size=2048, out=None, scratch=None):
+    '''
+    segmentation.findBeadsBF a tile at a time. scratch, a boolean image the
+    size of image, holds the cleaned outline while the beads are built in
+    out.
+    '''
+    clean = _output(scratch, image.shape, bool)
+    for i, j, core in tiles(image.shape, tile_size):
+        clean[core] = np.asarray(image[core]) < thr
+    remove_small_objects(clean, 64, tile_size, out=clean)
+    out = remove_small_holes(clean, 10000, tile_size, out=out)
+    for i, j, core in tiles(image.shape, tile_size):
+        out[core] = np.logical_xor(clean[core], out[core])
+    return remove_small_objects(out, 300, tile_size, out=out)
+
+
+def _exact_edt(mask, region, margin):
+    '''
+    scipy.ndimage.distance_transform_edt of mask over region, computed on the
+    region plus a margin that's doubled until no distance in the region is
+    longer than it (so the nearest background pixel was in view).
+    '''
+    shape = mask.shape
+    while True:
+        crop, inner = expand(region, shape, margin)
+        distances = ndi.distance_transform_edt(np.asarray(mask[crop]))[inner]
+        whole_image = (crop[0].stop - crop[0].start == shape[0] and
+                       crop[1].stop - crop[1].start == shape[1])
+        if whole_image or distances.max(initial=0) <= margin:
+            return distances
+        margin = 2*margin
+
+
+def distance_transform_edt(mask, tile_size=2048, margin=32, out=None):
+    '''
+    scipy.ndimage.distance_transform_edt of a mask, a tile at a time. margin
+    is the starting margin around each tile, it grows as needed.
+    '''
+    out = _output(out, mask.shape, np.float64)
+    for i, j, core in tiles(mask.shape, tile_size):
+        out[core] = _exact_edt(mask, core, margin)
+    return out
+
+
+def _space_out(coords, spacing, inclusive):
+    '''
+    Keep points in order, dropping any closer than spacing (or within spacing
+    if inclusive) to one already kept, by Chebyshev distance. This is the
+    spacing step of skimage.feature.peak_local_max (exclusive) and
+    corner_peaks (inclusive).
+    '''
+    if len(coords) == 0:
+        return coords
+    tree = cKDTree(coords)
+    rejected = np.zeros(len(coords), dtype=bool)
+    for index in range(len(coords)):
+        if rejected[index]:
+            continue
+        for neighbor in tree.query_ball_point(coords[index], r=spacing,
+                                              p=np.inf):
+            if neighbor == index:
+                continue
+            if inclusive or np.max(np.abs(coords[neighbor] -
+                                          coords[index])) < spacing:
+                rejected[neighbor] = True
+    return coords[~rejected]
+
+
+def findRegionCenters(mask, min_size=100, min_separation=10,
+                      min_dist_fr_bg=10, border_size=5, tile_size=2048,
+                      margin=32, scratch=None):
+    '''
+    segmentation.findRegionCenters a tile at a time, following
+    skimage.feature.corner_peaks as of skimage 0.18 and later. scratch, a
+    boolean image the size of mask, holds the cleaned mask.
+    '''
+    shape = mask.shape
+    clean = remove_small_holes(mask, min_size, tile_size, out=scratch)
+    remove_small_objects(clean, min_size, tile_size, out=clean)
+    size = 2*min_separation + 1
+    rows = []
+    cols = []
+    values = []
+    every_pixel_a_max = True
+    for i, j, core in tiles(shape, tile_size):
+        # the maximum filter at the core needs distances min_separation past
+        # it
+        region, inner = expand(core, shape, min_separation)
+        distances = _exact_edt(clean, region, margin)
+        maxima = distances == ndi.maximum_filter(distances, size=size,
+                                                 mode='nearest')
+        maxima = maxima[inner]
+        distances = distances[inner]
+        every_pixel_a_max = every_pixel_a_max and bool(np.all(maxima))
+        peak_rows, peak_cols = np.nonzero(maxima &
+                                          (distances > min_dist_fr_bg))
+        rows.append(peak_rows + core[0].start)
+        cols.append(peak_cols + core[1].start)
+        values.append(distances[peak_rows, peak_cols])
+    if every_pixel_a_max:
+        # skimage finds no peaks in an image that is flat everywhere
+        return np.zeros((0, 2), dtype=np.intp)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    values = np.concatenate(values)
+    if border_size is True:
+        border_size = min_separation
+    border_size = int(border_size)
+    if border_size > 0:
+        inside = ((rows >= border_size) & (rows < shape[0] - border_size) &
+                  (cols >= border_size) & (cols < shape[1] - border_size))
+        rows, cols, values = rows[inside], cols[inside], values[inside]
+    # raster order, then highest first
+    raster = np.argsort(rows*shape[1] + cols, kind='stable')
+    rows, cols, values = rows[raster], cols[raster], values[raster]
+    order = np.argsort(-values, kind='stable')
+    coords = np.column_stack([rows[order], cols[order]]).astype(np.intp)
+    if min_separation > 1:
+        coords = _space_out(coords, min_separation, inclusive=False)
+    return _space_out(coords, min_separation, inclusive=True)
+
+
+def surroundings_brightness(image, label, radius1, radius2, tile_size=2048):
+    '''
+    segmentation.surroundings_brightness(image, segmentation.surroundings(
+    label, radius1, radius2)) a tile at a time: the mean of image over the
+    pixels within radius2 of each object but not within radius1 of any
+    object. Raises RuntimeError like surroundings when an object has 10 or
+    fewer such pixels.
+    '''
+    shape = label.shape
+    margin = max(radius1, radius2)
+    sums = {}
+    counts = {}
+    for i, j, core in tiles(shape, tile_size):
+        crop, inner = expand(core, shape, margin)
+        crop_label = np.asarray(label[crop])
+        crop_image = np.asarray(image[crop])
+        in_core = np.zeros(crop_label.shape, dtype=bool)
+        in_core[inner] = True
+        background = in_core & ~edtm.dilate(crop_label > 0, radius1)
+        for index, box in enumerate(ndi.find_objects(crop_label)):
+            if box is None:
+                continue
+            value = index + 1
+            box = expand(box, crop_label.shape, radius2)[0]
+            surrounding = edtm.dilate(crop_label[box] == value, radius2) & \
+                background[box]
+            pixels = crop_image[box][surrounding]
+            if np.issubdtype(pixels.dtype, np.integer):
+                pixel_sum = int(np.sum(pixels, dtype=np.int64))
+            else:
+                pixel_sum = np.sum(pixels)
+            sums[value] = sums.get(value, 0) + pixel_sum
+            counts[value] = counts.get(value, 0) + int(surrounding.sum())
+    brightnesses = {}
+    for value in sorted(counts):
+        if counts[value] <= 10:
+            raise RuntimeError("unable to find background to label {0}"
+                               "that doesn't overlap with other"
+                               "labels".format(value))
+        brightnesses[value] = sums[value]/counts[value]
+    return brightnesses
+
+
+def subtract_pad_bg(image, label, r1, r2, tile_size=2048, dtype=np.float64,
+                    out=None):
+    '''
+    segmentation.subtract_pad_bg a tile at a time.
+    '''
+    brightnesses = surroundings_brightness(image, label, r1, r2, tile_size)
+    lookup = np.zeros(max(brightnesses, default=0) + 1, dtype=dtype)
+    for value, brightness in brightnesses.items():
+        lookup[value] = brightness
+    out = _output(out, image.shape, np.int32)
+    for i, j, core in tiles(image.shape, tile_size):
+        tile_label = np.asarray(label[core])
+        tile_image = np.asarray(image[core])
+        infilled = np.where(tile_label > 0,
+                            lookup[tile_label],
+                            tile_image).astype(dtype, copy=False)
+        out[core] = tile_image.astype('int32') - infilled.astype('int32')
+    return out
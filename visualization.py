@@ -13,15 +13,23 @@ This file is for the various plotting and graphing I do.
 """
 
 
-import ipywidgets as ipyw
-import matplotlib.pyplot as plt
-import matplotlib
-import matplotlib.cm as colormap
+import time
+
 import numpy as np
-import skimage.morphology as skmo
 
+import edtmorphology as edtm
+from framecache import cachedFrames
+from lazyimports import lazy_import
 from segmentation import warpIm2Im
 
+# the plotting and widget libraries are only imported when a function here is
+# first used, so importing this module doesn't need a display
+ipydisplay = lazy_import('IPython.display')
+ipyw = lazy_import('ipywidgets')
+plt = lazy_import('matplotlib.pyplot')
+matplotlib = lazy_import('matplotlib')
+colormap = lazy_import('matplotlib.cm')
+
 
 def showImages(images, figsize=None):
     """
@@ -37,36 +45,193 @@ def showImages(images, figsize=None):
         plts[index].imshow(image)
 
 
-def inspectImages(image_lists, figsize=None):
+class persistentFigure(object):
+    '''
+    A figure made once for a widget and redrawn in place on every event, so
+    slider moves update existing artists instead of making new figures.
+
+    With an interactive backend (ipympl, %matplotlib widget) the canvas is
+    shown once and only the changed artists are redrawn. With the inline
+    backend the figure is rendered again into the same output area. If
+    timing_hook is given it is called with the event name and the seconds the
+    event took, including a synchronous draw of the canvas.
+    '''
+
+    def __init__(self, figsize=None, timing_hook=None):
+        self.fig = plt.figure(figsize=figsize)
+        self.timing_hook = timing_hook
+        self.output = ipyw.Output()
+        self.live_canvas = isinstance(self.fig.canvas, ipyw.DOMWidget)
+        if self.live_canvas:
+            with self.output:
+                ipydisplay.display(self.fig.canvas)
+        else:
+            # keep pyplot from showing a stray copy when the cell finishes
+            plt.close(self.fig)
+
+    def redraw(self, event, start):
+        '''
+        Push the updated artists to the screen and report the time taken
+        since start (a time.perf_counter value) to the timing hook.
+        '''
+        if self.live_canvas:
+            if self.timing_hook is None:
+                self.fig.canvas.draw_idle()
+            else:
+                self.fig.canvas.draw()
+        else:
+            with self.output:
+                ipydisplay.clear_output(wait=True)
+                ipydisplay.display(self.fig)
+        if self.timing_hook is not None:
+            self.timing_hook(event, time.perf_counter() - start)
+
+
+def updateImage(artist, image, rescale=True):
+    '''
+    Replace the data of an image artist made by imshow, resizing its extent
+    and axes if the new image has a different shape and rescaling the color
+    limits to the new data like a fresh imshow would.
+    '''
+    old_shape = artist.get_array().shape[0:2]
+    artist.set_data(image)
+    if np.shape(image)[0:2] != old_shape:
+        height, width = np.shape(image)[0:2]
+        if artist.origin == 'lower':
+            extent = (-.5, width - .5, -.5, height - .5)
+        else:
+            extent = (-.5, width - .5, height - .5, -.5)
+        artist.set_extent(extent)
+        artist.axes.set_xlim(extent[0:2])
+        artist.axes.set_ylim(extent[2:4])
+    if rescale:
+        artist.set_clim(np.min(image), np.max(image))
+
+
+def inspectImages(image_lists, figsize=None, timing_hook=None,
+                  cache_bytes=2**28, prefetch=1, downsample=1):
     """
     This function is just a quick shortcut to making a slider for inspecting a
     group of related lists of images (such as TIRF and brightfield images of
     the same field of view). To make sense, the lists should contain fields of
-    view in the same order from the same experiment.
+    view in the same order from the same experiment. timing_hook is passed on
+    to persistentFigure to report how long each redraw takes.
+
+    Each list is wrapped in a framecache.cachedFrames sharing cache_bytes
+    between them, so frames already looked at and prefetch frames either side
+    of the current one come from memory. downsample > 1 shows every
+    downsample-th pixel for quick previews of large images. Lists that are
+    already cachedFrames are used as they are.
     """
+    list_bytes = cache_bytes // len(image_lists)
+    image_lists = [image_list if isinstance(image_list, cachedFrames) else
+                   cachedFrames(image_list, list_bytes, prefetch,
+                                downsample=downsample)
+                   for image_list in image_lists]
     sl_min = 0
     sl_max = len(image_lists[0])
     if figsize is None:
         figsize = (len(image_lists)*6, 6)
+    display_fig = persistentFigure(figsize, timing_hook)
+    image_num = len(image_lists)
+    subplots = [display_fig.fig.add_subplot(1, image_num, index+1)
+                for index in range(image_num)]
+    artists = [subplot.imshow(image_list[sl_min]) for subplot, image_list in
+               zip(subplots, image_lists)]
 
     def displayImages(image_num):
-        images = []
-        for image_list in image_lists:
-            images.append(image_list[image_num])
-        showImages(images, figsize)
+        start = time.perf_counter()
+        for artist, image_list in zip(artists, image_lists):
+            updateImage(artist, image_list[image_num])
+        display_fig.redraw('inspectImages', start)
 
     image_num = ipyw.IntSlider(value=sl_min, min=sl_min, max=sl_max-1,
                                continuous_update=False, description='image #')
-    widget = ipyw.interactive(displayImages, image_num=image_num)
+    image_num.observe(lambda change: displayImages(change['new']),
+                      names='value')
+    displayImages(sl_min)
+    widget = ipyw.VBox([image_num, display_fig.output])
     return widget
 
 
+def alignmentMask(mask, image, transform, dil_size):
+    """
+    Warp a mask onto an image at full resolution and dilate it, the way
+    adjustAlignment shows it when not previewing.
+    """
+    warp_mask = warpIm2Im(mask, image, transform)
+    return edtm.dilate(warp_mask, dil_size)
+
+
+class previewWarper(object):
+    """
+    Fast approximate version of alignmentMask for hand tuning alignments.
+
+    The mask is dilated before warping and the dilated mask is kept per
+    dilation size, and the warp is only evaluated on a precomputed grid of
+    every downsample-th output pixel, so a change of the transform parameters
+    only costs one affine map of that grid and a lookup. Dilating before
+    instead of after warping is only exact for a transform scale of 1, which
+    is close enough for the similarity transforms between our cameras.
+    """
+
+    def __init__(self, mask_list, downsample=2):
+        self.mask_list = mask_list
+        self.downsample = downsample
+        self.dilated = {}
+        self.dilated_index = None
+        self.grids = {}
+
+    def dilatedMask(self, index, dil_size):
+        if index != self.dilated_index:
+            # only keep dilations of the mask currently being looked at
+            self.dilated = {}
+            self.dilated_index = index
+        if dil_size not in self.dilated:
+            self.dilated[dil_size] = edtm.dilate(self.mask_list[index],
+                                                 dil_size)
+        return self.dilated[dil_size]
+
+    def grid(self, shape):
+        if shape not in self.grids:
+            rows = np.arange(0, shape[0], self.downsample, dtype=float)
+            cols = np.arange(0, shape[1], self.downsample, dtype=float)
+            self.grids[shape] = (rows[:, np.newaxis], cols[np.newaxis, :])
+        return self.grids[shape]
+
+    def warp(self, index, dil_size, shape, transform):
+        """
+        Return the dilated mask index warped onto the preview grid of an
+        image of the given shape, following the conventions of warpIm2Im.
+        """
+        mask = self.dilatedMask(index, dil_size)
+        rows, cols = self.grid(tuple(shape[0:2]))
+        matrix = transform.params
+        # nearest neighbor, rounding like scipy.ndimage does for order 0
+        from_rows = np.floor(matrix[0, 0]*rows + matrix[0, 1]*cols +
+                             matrix[0, 2] + .5).astype(np.intp)
+        from_cols = np.floor(matrix[1, 0]*rows + matrix[1, 1]*cols +
+                             matrix[1, 2] + .5).astype(np.intp)
+        inside = ((from_rows >= 0) & (from_rows < mask.shape[0]) &
+                  (from_cols >= 0) & (from_cols < mask.shape[1]))
+        warp = np.zeros(inside.shape, dtype=bool)
+        warp[inside] = mask[from_rows[inside], from_cols[inside]]
+        return warp
+
+
 def adjustAlignment(image_list, mask_list, trans, s_err_rel=.01, s_st_rel=.001,
                     theta_err=.005, theta_st=.0001, delta_err=5, delta_st=.1,
-                    figsize=(24, 16)):
+                    figsize=(24, 16), timing_hook=None, preview=False,
+                    preview_downsample=2):
     """
     This function makes the widget for hand tuning the alignment between
-    cameras and returns the value of the hand tuned alignment.
+    cameras and returns the value of the hand tuned alignment. timing_hook is
+    passed on to persistentFigure to report how long each redraw takes.
+
+    With preview True the mask is warped with previewWarper onto every
+    preview_downsample-th pixel of the image for quick feedback while moving
+    the sliders. Tick 'full resolution' to check the final transform with
+    alignmentMask on the full images.
     """
 
     my_cmap = colormap.binary
@@ -101,6 +266,11 @@ def adjustAlignment(image_list, mask_list, trans, s_err_rel=.01, s_st_rel=.001,
                                       max=delta_y_0 + delta_err,
                                       step=delta_st, continuous_update=False,
                                       description='horizontal shift')
+    full_res_box = ipyw.Checkbox(value=not preview,
+                                 description='full resolution')
+    warper = previewWarper(mask_list, preview_downsample)
+    preview_images = cachedFrames(image_list, prefetch=0,
+                                  downsample=preview_downsample)
 
     def changeTransform(transform, scale, theta, delta_x, delta_y):
         """
@@ -114,19 +284,44 @@ def adjustAlignment(image_list, mask_list, trans, s_err_rel=.01, s_st_rel=.001,
         transform.params[0, 2] = delta_x
         transform.params[1, 2] = delta_y
 
-    def applyTransform(index, dil_size, scale, theta, delta_x, delta_y):
+    display_fig = persistentFigure(figsize, timing_hook)
+    img_view = display_fig.fig.add_subplot(1, 2, 1)
+    align_view = display_fig.fig.add_subplot(1, 2, 2)
+    img_artist = img_view.imshow(image_list[0])
+    align_artist = align_view.imshow(image_list[0])
+    mask_artist = align_view.imshow(np.zeros(np.shape(image_list[0])),
+                                    cmap=my_cmap, clim=[0, .1])
+    sliders = {'index': image_sl, 'dil_size': dil_sl, 'scale': scale_slider,
+               'theta': theta_slider, 'delta_x': delta_x_slider,
+               'delta_y': delta_y_slider, 'full_res': full_res_box}
+
+    def applyTransform(index, dil_size, scale, theta, delta_x, delta_y,
+                       full_res):
+        start = time.perf_counter()
         changeTransform(trans, scale, theta, delta_x, delta_y)
-        warp_mask = warpIm2Im(mask_list[index], image_list[index], trans)
-        warp_mask = skmo.binary_dilation(warp_mask, selem=skmo.disk(dil_size))
-        fig = plt.figure(figsize=figsize)
-        img_view = fig.add_subplot(1, 2, 1)
-        align_view = fig.add_subplot(1, 2, 2)
-        img_view.imshow(image_list[index])
-        align_view.imshow(image_list[index])
-        align_view.imshow(warp_mask, cmap=my_cmap, clim=[0, .1])
+        if full_res:
+            image = image_list[index]
+            warp_mask = alignmentMask(mask_list[index], image, trans,
+                                      dil_size)
+        else:
+            image = preview_images[index]
+            warp_mask = warper.warp(index, dil_size,
+                                    preview_images.fullShape(index), trans)
+        updateImage(img_artist, image)
+        updateImage(align_artist, image)
+        updateImage(mask_artist, warp_mask, rescale=False)
+        display_fig.redraw('adjustAlignment', start)
+
+    def onChange(change):
+        applyTransform(**{name: slider.value for name, slider in
+                          sliders.items()})
+
+    for slider in sliders.values():
+        slider.observe(onChange, names='value')
+    onChange(None)
 
     box1 = ipyw.Box()
-    box1.children = [image_sl, dil_sl]
+    box1.children = [image_sl, dil_sl, full_res_box]
     box2 = ipyw.Box()
     box2.children = [scale_slider, theta_slider, delta_x_slider,
                      delta_y_slider]
@@ -134,14 +329,7 @@ def adjustAlignment(image_list, mask_list, trans, s_err_rel=.01, s_st_rel=.001,
     tabwidget.children = [box1, box2]
     tabwidget.set_title(0, 'image # and dilation size')
     tabwidget.set_title(1, 'transformation parameters')
-    interaction = ipyw.interactive_output(applyTransform,
-                                          {'index': image_sl,
-                                           'dil_size': dil_sl,
-                                           'scale': scale_slider,
-                                           'theta': theta_slider,
-                                           'delta_x': delta_x_slider,
-                                           'delta_y': delta_y_slider})
-    return tabwidget, interaction
+    return tabwidget, display_fig.output
 
 
 def plotConnectingLine(fig, coord1, axes1, coord2, axes2):
@@ -205,21 +393,28 @@ def showKeypointpairs(image1, image2, keypoints1, keypoints2, figsize=(18, 9)):
             plotConnectingLine(fig, pair[0], subplot1, pair[1], subplot2)
 
 
-def showOverlay(image, overlay, subplot, cmap=colormap.bwr):
+def showOverlay(image, overlay, subplot, cmap=None):
     '''
-    Plot an overlay of a mask on top an image.
+    Plot an overlay of a mask on top an image. Returns the image and overlay
+    artists so they can be updated later. cmap defaults to bwr.
     '''
-    subplot.imshow(image)
+    image_artist = subplot.imshow(image)
+    if cmap is None:
+        cmap = colormap.bwr
     my_cmap = cmap
     my_cmap.set_under('w', alpha=0)
-    subplot.imshow(overlay, cmap=my_cmap, clim=[.9, 1])
+    overlay_artist = subplot.imshow(overlay, cmap=my_cmap, clim=[.9, 1])
+    return image_artist, overlay_artist
 
 
-def showInverseOverlay(image, overlay, subplot, cmap=colormap.binary):
+def showInverseOverlay(image, overlay, subplot, cmap=None):
     '''
-    Plot the inverse of an overlay of a mask on top of an image.
+    Plot the inverse of an overlay of a mask on top of an image. cmap
+    defaults to binary.
     '''
     subplot.imshow(image)
+    if cmap is None:
+        cmap = colormap.binary
     my_cmap = cmap
     my_cmap.set_over('w', alpha=0)
     subplot.imshow(overlay, cmap=my_cmap, clim=[0, .1])